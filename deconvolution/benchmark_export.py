@@ -0,0 +1,69 @@
+"""
+Compares the csv tree of fif_export.py (raw-<el>/ per electrode) with its arrow export:
+bytes on disk, the time to read one channel of every subject (what deconvolution.jl does per electrode)
+and the time to read all channels of one subject, and checks that both give the same data (float32 precision)
+
+    python benchmark_export.py --csv C:/.../mastoid_ref_csv/ --arrow C:/.../mastoid_ref_arrow/ --channel Oz
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+from fif_export import DESTINATION, ARROW_DESTINATION, outputPaths, readManifest, readChannel, readEvents
+from pyarrow import feather
+
+
+def directorySize(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+
+def timed(read, repeat=3):
+    """
+    Best time of repeat reads (s) and the result of the last one
+    """
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = read()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bytes on disk and read time of the csv and the arrow export')
+    parser.add_argument('--csv', default=DESTINATION)
+    parser.add_argument('--arrow', default=ARROW_DESTINATION)
+    parser.add_argument('--channel', default='Oz')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    manifest = readManifest(args.arrow)
+    subjects = [int(sub) for sub in manifest['subjects']]
+    ch_names = manifest['ch_names']
+    paths = {sub: outputPaths(args.csv, sub, ch_names) for sub in subjects}
+
+    csv_bytes = directorySize([path for raw_paths, events_path in paths.values()
+                               for path in list(raw_paths.values()) + [events_path]])
+    arrow_bytes = directorySize([os.path.join(args.arrow, entry[name]) for entry in manifest['subjects'].values()
+                                 for name in ['data', 'events']])
+    print(f'{len(subjects)} subjects, {len(ch_names)} channels')
+    print(f'on disk:        csv {csv_bytes / 1e6:10.1f} MB   arrow {arrow_bytes / 1e6:8.1f} MB (x{csv_bytes / arrow_bytes:.1f})')
+
+    # One channel of every subject
+    channel = args.channel
+    t_csv, csv_data = timed(lambda: [pd.read_csv(paths[sub][0][channel])[channel].to_numpy() for sub in subjects],
+                            args.repeat)
+    t_arrow, arrow_data = timed(lambda: [readChannel(args.arrow, sub, channel) for sub in subjects], args.repeat)
+    print(f'one channel:    csv {t_csv:10.2f} s    arrow {t_arrow:8.2f} s  (x{t_csv / t_arrow:.0f})')
+    error = max(np.abs(a - c).max() for a, c in zip(arrow_data, csv_data))
+    print(f'largest difference {error:.2e} uV (float32)')
+
+    # All channels and the events of one subject
+    sub = subjects[0]
+    t_csv, _ = timed(lambda: ([pd.read_csv(path) for path in paths[sub][0].values()], pd.read_csv(paths[sub][1])),
+                     args.repeat)
+    t_arrow, _ = timed(lambda: (feather.read_table(os.path.join(args.arrow, manifest['subjects'][str(sub)]['data'])),
+                                readEvents(args.arrow, sub)), args.repeat)
+    print(f'all channels:   csv {t_csv:10.2f} s    arrow {t_arrow:8.2f} s  (x{t_csv / t_arrow:.0f})')
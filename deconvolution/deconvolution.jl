@@ -2,6 +2,7 @@ using Unfold
 using UnfoldSim
 using UnfoldMakie,CairoMakie
 using CSV
+using Arrow
 using DataFrames
 using Effects
 using StatsModels
@@ -16,6 +17,9 @@ el_list = ["Fp1", "AF7", "AF3", "F1", "F3", "F5", "F7",
            "TP8", "CP6", "CP4", "CP2","P2", "P4", "P6", "P8", 
            "P10", "PO8", "PO4", "O2"
            ]
+# Export of fif_export.py --format arrow (one file per subject, all channels), the csv tree otherwise
+arrow_path = "C:/Users/mvmigem/Documents/data/project_1/preprocessed/mastoid_ref_arrow/"
+use_arrow = isfile(arrow_path * "manifest.json")
 for i in el_list
     data_path = "C:/Users/mvmigem/Documents/data/project_1/preprocessed/mastoid_ref_csv/"
     raw_path = data_path * "raw-$i/"
@@ -29,6 +33,10 @@ for i in el_list
         # raw_path = data_path * "raw-selected/"
         
 
+        if use_arrow
+            event_path = arrow_path * "events/"
+            raw_path = arrow_path * "raw/"
+        end
         event_dir_list = readdir(event_path)
         raw_dir_list = readdir(raw_path)
 
@@ -38,8 +46,13 @@ for i in el_list
         for (evp,rawp) in zip(event_dir_list,raw_dir_list)
 
             # Read in the data
-            data = DataFrame(CSV.File(raw_path*rawp))
-            evts = DataFrame(CSV.File(event_path*evp))
+            if use_arrow
+                data = DataFrame(i => Vector{Float64}(getproperty(Arrow.Table(raw_path*rawp), Symbol(i))))
+                evts = DataFrame(Arrow.Table(event_path*evp))
+            else
+                data = DataFrame(CSV.File(raw_path*rawp))
+                evts = DataFrame(CSV.File(event_path*evp))
+            end
             # Change the column names to fit toolbox
             rename!(evts,:sample => :latency)
             filter!(row -> !(row.event_codes == 99),evts)
@@ -0,0 +1,245 @@
+"""
+Export of the cleaned continuous data and events for deconvolution.jl
+Same files as the loop in fif_transform.ipynb (raw-<el>/raw_mastoidref_<el>_<sub>.csv and events/events_<sub>.csv)
+but every subject is read once and all electrodes are written from that one read, subjects run in a process pool
+
+    python fif_export.py --jobs 4
+    python fif_export.py --subjects 3 4 --overwrite
+
+With --format arrow every subject is one zstd compressed Arrow IPC (Feather v2) file with a float32 column per
+channel (uV) in chunks of CHUNK_SECONDS, next to an Arrow file with its events and a manifest.json:
+
+    mastoid_ref_arrow/manifest.json
+    mastoid_ref_arrow/raw/sub_<sub>-raw.arrow
+    mastoid_ref_arrow/events/events_<sub>.arrow
+
+One channel is read without decompressing the others (readChannel() here, Arrow.Table in Julia)
+The arrow format needs pyarrow, the csv export does not
+"""
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+import mne
+from concurrent.futures import ProcessPoolExecutor, as_completed
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:   # only needed for the arrow format
+    pa = None
+
+
+DATA_DIRECTORY = 'C:/Users/mvmigem/Documents/data/project_1/preprocessed/'
+DESTINATION = 'C:/Users/mvmigem/Documents/data/project_1/preprocessed/mastoid_ref_csv/'
+ARROW_DESTINATION = 'C:/Users/mvmigem/Documents/data/project_1/preprocessed/mastoid_ref_arrow/'
+SUBJECTS = [sub for sub in range(1, 26) if sub != 20]   # 20 has no data
+ELECTRODES = mne.channels.make_standard_montage('biosemi64').ch_names
+MANIFEST_VERSION = 1
+CHUNK_SECONDS = 60   # rows per record batch, every column of a batch is compressed on its own
+COMPRESSION = 'zstd'
+JOBS = min(4, os.cpu_count() or 1)   # every process holds a full subject in memory
+
+
+def subjectPaths(data_directory, sub):
+    return (os.path.join(data_directory, f'mastoid_raw/main_clean_mastoidref_{sub:02}-raw.fif'),
+            os.path.join(data_directory, f'mastoid_ref/main_eventset_mastoidref_{sub:02}-epo.fif'))
+
+
+def eventsFrame(epochs):
+    """
+    Event table of a subject for the deconvolution (sample, code, position, sequence, conditions and the
+    positions above and below fixation of its localised quadrant)
+    """
+    events = epochs.events
+    metadata = epochs.metadata
+    subject = metadata['participant'].iloc[1]
+    located_quad = metadata['loc_quad'].iloc[1]
+    if located_quad == 0 or located_quad == 2:
+        setup = "1"
+        setdown = "3"
+    else:
+        setup = "2"
+        setdown = "4"
+    events_df = pd.DataFrame(events[:,0],columns=['sample'])
+    events_df['event_codes'] = events[:,2]
+    events_df['position'] = events_df['event_codes'] // 10
+    events_df['sequence'] = events_df['event_codes'] % 10
+    events_df['attention'] = metadata['attention'].reset_index(drop=True)
+    events_df['expectation'] = metadata['expected'].reset_index(drop=True)
+    events_df['setup'] = setup
+    events_df['setdown'] = setdown
+    events_df['subject'] = subject
+
+    return events_df
+
+
+def outputPaths(destination, sub, electrodes=ELECTRODES):
+    raw_paths = {el: os.path.join(destination, f'raw-{el}/raw_mastoidref_{el}_{sub:02}.csv') for el in electrodes}
+    return raw_paths, os.path.join(destination, f'events/events_{sub:02}.csv')
+
+
+def exportSubject(sub, data_directory=DATA_DIRECTORY, destination=DESTINATION, electrodes=ELECTRODES, overwrite=False):
+    """
+    Read the raw and epoch file of a subject once and write the csv of every electrode and the events
+    Electrodes that are already exported are skipped unless overwrite
+    Returns the subject number, the number of written electrodes and the read and write time (s)
+    """
+    mne.set_log_level('error')
+    raw_paths, events_path = outputPaths(destination, sub, electrodes)
+    todo = [el for el in electrodes if overwrite or not os.path.isfile(raw_paths[el])]
+    if not todo and os.path.isfile(events_path):
+        return sub, 0, 0., 0.
+
+    t0 = time.perf_counter()
+    clean_raw_path, clean_epo_path = subjectPaths(data_directory, sub)
+    raw = mne.io.read_raw_fif(clean_raw_path, preload = True)
+    epochs = mne.read_epochs(clean_epo_path, preload = False)
+    raw.info['bads'] = []
+    # All electrodes in one data frame (time column + one column per electrode, uV)
+    raw_df = raw.to_data_frame(picks = todo, long_format = False)
+    t_read = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    # Same text as raw_df[['time', el]].to_csv(index = False), but the time column is only formatted once
+    # (to_csv ends the lines with os.linesep, so '\r\n' on Windows)
+    time_column = [f'{t!r},' for t in raw_df['time'].tolist()]
+    for el in todo:
+        os.makedirs(os.path.dirname(raw_paths[el]), exist_ok=True)
+        with open(raw_paths[el], 'w', newline='') as f:
+            f.write(f'time,{el}{os.linesep}')
+            f.write(''.join([t + repr(v) + os.linesep for t, v in zip(time_column, raw_df[el].tolist())]))
+    os.makedirs(os.path.dirname(events_path), exist_ok=True)
+    eventsFrame(epochs).to_csv(events_path, index = False)
+
+    return sub, len(todo), t_read, time.perf_counter() - t0
+
+
+####################################################
+#Arrow format
+####################################################
+
+def _writeFeather(table, path, chunksize=None):
+    tmp = path + '.tmp'
+    feather.write_feather(table, tmp, compression=COMPRESSION, chunksize=chunksize)
+    os.replace(tmp, path)
+
+
+def exportSubjectArrow(sub, data_directory=DATA_DIRECTORY, destination=ARROW_DESTINATION, electrodes=ELECTRODES):
+    """
+    Read the raw and epoch file of a subject once and write all electrodes (float32, uV) to one Arrow file
+    and the events to another, returns the subject number, the number of electrodes, the read and write
+    time (s) and the manifest entry of the subject
+    """
+    if pa is None:
+        raise ImportError('the arrow format needs pyarrow (pip install pyarrow)')
+    mne.set_log_level('error')
+    t0 = time.perf_counter()
+    clean_raw_path, clean_epo_path = subjectPaths(data_directory, sub)
+    raw = mne.io.read_raw_fif(clean_raw_path, preload = True)
+    epochs = mne.read_epochs(clean_epo_path, preload = False)
+    raw.info['bads'] = []
+    data = raw.get_data(picks = electrodes, units = 'uV').astype(np.float32)
+    events_df = eventsFrame(epochs)
+    t_read = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    entry = {'data': f'raw/sub_{sub:02}-raw.arrow', 'events': f'events/events_{sub:02}.arrow',
+             'sfreq': float(raw.info['sfreq']), 'n_samples': int(raw.n_times), 'first_samp': int(raw.first_samp),
+             'n_events': len(events_df)}
+    for name in ['raw', 'events']:
+        os.makedirs(os.path.join(destination, name), exist_ok=True)
+    _writeFeather(pa.table({el: data[i] for i, el in enumerate(electrodes)}),
+                  os.path.join(destination, entry['data']), chunksize=int(raw.info['sfreq'] * CHUNK_SECONDS))
+    _writeFeather(pa.Table.from_pandas(events_df, preserve_index=False), os.path.join(destination, entry['events']))
+
+    return sub, len(electrodes), t_read, time.perf_counter() - t0, entry
+
+
+def readManifest(directory):
+    try:
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return manifest if manifest.get('version') == MANIFEST_VERSION else {}
+
+
+def writeManifest(directory, ch_names, subjects):
+    manifest = {'version': MANIFEST_VERSION, 'format': 'arrow', 'compression': COMPRESSION, 'units': 'uV',
+                'ch_names': list(ch_names), 'subjects': {str(sub): subjects[sub] for sub in sorted(subjects)}}
+    path = os.path.join(directory, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def readChannel(directory, sub, channel):
+    """
+    One channel (float32, uV) of a subject from the arrow export, the other channels are not decompressed
+    """
+    entry = readManifest(directory)['subjects'][str(sub)]
+    table = feather.read_table(os.path.join(directory, entry['data']), columns=[channel], memory_map=True)
+    return table.column(0).to_numpy()
+
+
+def readEvents(directory, sub):
+    entry = readManifest(directory)['subjects'][str(sub)]
+    return feather.read_table(os.path.join(directory, entry['events']), memory_map=True).to_pandas()
+
+
+####################################################
+#Batch
+####################################################
+
+def exportSubjects(data_directory=DATA_DIRECTORY, destination=DESTINATION, subjects=SUBJECTS, electrodes=ELECTRODES,
+                   jobs=JOBS, overwrite=False, fmt='csv'):
+    """
+    exportSubject() (or exportSubjectArrow() with fmt 'arrow') for every subject in a process pool,
+    prints the time per subject
+    In the arrow format the subjects that are in the manifest are skipped unless overwrite, the manifest
+    is written when all subjects are done
+    """
+    start = time.perf_counter()
+    if fmt == 'arrow':
+        manifest = readManifest(destination)
+        entries = {int(sub): entry for sub, entry in manifest.get('subjects', {}).items()}
+        if manifest and manifest['ch_names'] != list(electrodes):
+            entries = {}   # other channels, the existing files are replaced
+        todo = [sub for sub in subjects if overwrite or sub not in entries]
+        submit = lambda pool, sub: pool.submit(exportSubjectArrow, sub, data_directory, destination, electrodes)
+    else:
+        todo = subjects
+        submit = lambda pool, sub: pool.submit(exportSubject, sub, data_directory, destination, electrodes, overwrite)
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {submit(pool, sub): sub for sub in todo}
+        for future in as_completed(futures):
+            try:
+                sub, n_written, t_read, t_write, *entry = future.result()
+                print(f'subject {sub}: {n_written} electrodes, read {t_read:.1f} s, write {t_write:.1f} s')
+                if entry:
+                    entries[sub] = entry[0]
+            except Exception as error:
+                print(f'subject {futures[future]} failed: {error!r}')
+    if fmt == 'arrow':
+        writeManifest(destination, electrodes, entries)
+    print(f'{len(todo)} subjects in {time.perf_counter() - start:.1f} s with {jobs} processes')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the cleaned raw data and events of all subjects for deconvolution.jl')
+    parser.add_argument('--data-directory', default=DATA_DIRECTORY)
+    parser.add_argument('--destination', help=f'default {DESTINATION} (csv) or {ARROW_DESTINATION} (arrow)')
+    parser.add_argument('--format', choices=['csv', 'arrow'], default='csv')
+    parser.add_argument('--subjects', type=int, nargs='*', default=SUBJECTS)
+    parser.add_argument('--electrodes', nargs='*', default=ELECTRODES)
+    parser.add_argument('--jobs', type=int, default=JOBS, help='number of processes (each holds a subject in memory)')
+    parser.add_argument('--overwrite', action='store_true', help='also write the electrodes/subjects that are already exported')
+    args = parser.parse_args()
+
+    destination = args.destination or (ARROW_DESTINATION if args.format == 'arrow' else DESTINATION)
+    exportSubjects(args.data_directory, destination, args.subjects, args.electrodes, args.jobs, args.overwrite,
+                   args.format)
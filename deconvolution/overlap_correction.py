@@ -0,0 +1,429 @@
+"""
+Overlap correction (FIR deconvolution) in python, the same model as deconvolution.jl:
+
+    0 ~ 1 + sequence + position + expectation*attention, firbasis(τ=(-0.1,1), sfreq=512), EffectsCoding()
+
+at the sampling rate of the export (sfreq in the arrow manifest, the time column of the csv tree)
+
+The time-expanded design of a subject is built once as a scipy.sparse CSC matrix (samples x terms*lags) from the
+events of fif_export.py and all channels are solved at once (normal equations, one factorisation for every channel)
+instead of one fit per electrode. The effects are the predictions for the same design as effects() in Julia and are
+written as overlap_corrected_python/<el>/corrected_<el>_evoked_<sub>.csv, next to the overlap_corrected/ of
+deconvolution.jl (--compare refuses to run when both are the same directory)
+
+    python overlap_correction.py --subjects 1 2 --jobs 2
+    python overlap_correction.py --subjects 1 --compare C:/Users/mvmigem/Documents/data/project_1/overlap_corrected/
+
+The data is read from the arrow export when it exists (one file with all channels), otherwise from the csv tree
+
+The Cholesky factor of X'X is kept with the model and the models are cached per subject, formula, basis window and
+events (cachedModel()), so another channel, another baseline or a rerun only costs the triangular solves
+Artifact samples (the 'bad_calibration_gap' and 'bad blink' annotations, --mask-artifacts) are left out as deleted
+rows: a low rank correction of the cached factor instead of a new factorisation
+"""
+
+import argparse
+import hashlib
+import os
+import time
+import numpy as np
+import pandas as pd
+import scipy.linalg
+import mne
+from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from fif_export import (DESTINATION, ARROW_DESTINATION, SUBJECTS, ELECTRODES, outputPaths, readManifest,
+                        readEvents, subjectPaths, DATA_DIRECTORY)
+
+
+OVERLAP_DESTINATION = 'C:/Users/mvmigem/Documents/data/project_1/overlap_corrected_python/'
+# Output of deconvolution.jl
+JULIA_DESTINATION = 'C:/Users/mvmigem/Documents/data/project_1/overlap_corrected/'
+TAU = (-0.1, 1)
+# 1 + sequence + position + expectation*attention, a tuple is an interaction
+TERMS = ['sequence', 'position', 'expectation', 'attention', ('expectation', 'attention')]
+CATEGORICAL = ['sequence', 'position', 'expectation', 'attention']
+# deconvolution.jl uses the event sample as (1-based) index in the data vector, so sample s is data[s - 1] here
+LATENCY_OFFSET = -1
+ARTIFACT_DESCRIPTIONS = ['bad_calibration_gap', 'bad blink']
+
+
+####################################################
+#Design
+####################################################
+
+def firLags(sfreq, tau=TAU):
+    """
+    Sample lags of the FIR basis at sfreq (both ends of tau included, rounded to samples like firbasis)
+    """
+    return np.arange(int(round(tau[0] * sfreq)), int(round(tau[1] * sfreq)) + 1)
+
+
+def prepareEvents(events_df):
+    """
+    The events as deconvolution.jl uses them: without the 99 codes and with the categorical columns as text
+    """
+    events = events_df[events_df['event_codes'] != 99].reset_index(drop=True)
+    for column in CATEGORICAL + ['setup', 'setdown']:
+        if column in events:
+            events[column] = events[column].astype(str)
+    return events
+
+
+def effectsCoding(values, levels):
+    """
+    EffectsCoding() of StatsModels: a column per level except the first, the first level is -1 in all columns
+    """
+    values = np.asarray(values)
+    coding = (values[:, np.newaxis] == np.asarray(levels[1:])[np.newaxis]).astype(float)
+    coding[values == levels[0]] = -1.
+    return coding
+
+
+class EventDesign:
+    """
+    Coding of the terms: the levels of every categorical column (sorted, the first is the reference)
+    and the names of the model columns
+    """
+    def __init__(self, events, terms=TERMS):
+        self.terms = terms
+        self.levels = {}
+        for term in terms:
+            for column in (term if isinstance(term, tuple) else (term,)):
+                self.levels[column] = sorted(events[column].unique())
+        self.names = ['(Intercept)']
+        for term in terms:
+            columns = term if isinstance(term, tuple) else (term,)
+            names = ['']
+            for column in columns:
+                names = [f'{name} & {column}: {level}' if name else f'{column}: {level}'
+                         for name in names for level in self.levels[column][1:]]
+            self.names += names
+
+    def matrix(self, rows):
+        """
+        Model matrix (rows x columns) of a DataFrame with the categorical columns
+        """
+        codings = {column: effectsCoding(rows[column].astype(str), levels) for column, levels in self.levels.items()}
+        blocks = [np.ones((len(rows), 1))]
+        for term in self.terms:
+            columns = term if isinstance(term, tuple) else (term,)
+            block = np.ones((len(rows), 1))
+            for column in columns:
+                block = (block[:, :, np.newaxis] * codings[column][:, np.newaxis, :]).reshape(len(rows), -1)
+            blocks.append(block)
+        return np.hstack(blocks)
+
+
+def timeExpand(event_matrix, latencies, lags, n_samples):
+    """
+    Sparse (n_samples x columns*lags) CSC design, column c * len(lags) + j is model column c at lag j
+    Built column by column: the rows of a column are the sorted latencies shifted by its lag
+    """
+    order = np.argsort(latencies, kind='stable')
+    latencies = np.asarray(latencies)[order]
+    event_matrix = event_matrix[order]
+    indices, data, counts = [], [], []
+    for c in range(event_matrix.shape[1]):
+        nonzero = event_matrix[:, c] != 0
+        rows = latencies[nonzero][np.newaxis] + lags[:, np.newaxis]   # (lags, events)
+        inside = (rows >= 0) & (rows < n_samples)
+        indices.append(rows[inside])
+        data.append(np.broadcast_to(event_matrix[nonzero, c], rows.shape)[inside])
+        counts.append(inside.sum(axis=1))
+    indptr = np.concatenate([[0], np.cumsum(np.concatenate(counts))])
+    design = sparse.csc_matrix((np.concatenate(data), np.concatenate(indices), indptr),
+                               shape=(n_samples, event_matrix.shape[1] * len(lags)))
+    design.sum_duplicates()   # events with the same latency
+
+    return design
+
+
+####################################################
+#Fit
+####################################################
+
+class OverlapModel:
+    """
+    FIR deconvolution of all channels of one subject
+    beta is (model columns, lags, channels)
+    The Cholesky factor of X'X is computed on the first fit and kept, the correction for every artifact mask too
+    """
+    def __init__(self, events_df, n_samples, sfreq, tau=TAU, terms=TERMS, latency_offset=LATENCY_OFFSET):
+        self.events = prepareEvents(events_df)
+        self.sfreq = sfreq
+        self.lags = firLags(sfreq, tau)
+        self.times = self.lags / sfreq
+        self.design = EventDesign(self.events, terms)
+        latencies = self.events['sample'].to_numpy(dtype=int) + latency_offset
+        self.X = timeExpand(self.design.matrix(self.events), latencies, self.lags, n_samples)
+        self.beta = None
+        self._gram = None
+        self._factor = None
+        self._rows = None
+        self._corrections = {}
+
+    def factor(self):
+        """
+        Cholesky factor of X'X (computed once), None when X'X is singular (a level without events)
+        The normal equations X'X of a FIR design are practically dense, so the factor is dense
+        """
+        if self._gram is None:
+            self._gram = (self.X.T @ self.X).toarray()
+            try:
+                self._factor = scipy.linalg.cho_factor(self._gram)
+            except np.linalg.LinAlgError:
+                self._factor = None
+        return self._factor
+
+    def _correction(self, mask):
+        """
+        Deleting the masked rows R from X makes X'X - R'R = U'(I - WW')U with W = U^-T R' (U the cached factor),
+        solved with the k x k matrix I - W'W (Woodbury), k the masked rows that are in the design
+        When k is large (or the factor is singular) X'X - R'R is factorised instead, that is cheaper then
+        Cached per mask
+        """
+        key = hashlib.sha1(np.packbits(mask).tobytes()).hexdigest()
+        if key not in self._corrections:
+            if self._rows is None:
+                self._rows = self.X.tocsr()
+            removed = self._rows[np.flatnonzero(mask)]
+            removed = removed[np.flatnonzero(removed.getnnz(axis=1))]
+            factor = self.factor()
+            if factor is not None and removed.shape[0] < self.X.shape[1] // 3:
+                W = scipy.linalg.solve_triangular(factor[0], removed.T.toarray(), trans='T', lower=factor[1])
+                try:
+                    self._corrections[key] = ('woodbury', W,
+                                              scipy.linalg.cho_factor(np.eye(W.shape[1]) - W.T @ W))
+                except np.linalg.LinAlgError:   # the remaining rows do not determine the model
+                    self._corrections[key] = ('gram', self._gram - (removed.T @ removed).toarray(), None)
+            else:
+                gram = self._gram - (removed.T @ removed).toarray()
+                try:
+                    self._corrections[key] = ('cholesky', scipy.linalg.cho_factor(gram), None)
+                except np.linalg.LinAlgError:
+                    self._corrections[key] = ('gram', gram, None)
+        return self._corrections[key]
+
+    def fit(self, data, mask=None):
+        """
+        Least squares for all channels at once, data is (samples, channels), mask (samples,) marks the
+        samples to leave out (see annotationMask())
+        Every channel is a right hand side of the same triangular solves
+        """
+        data = np.asarray(data, dtype=float)
+        if mask is not None and mask.any():
+            data = np.where(mask[:, np.newaxis], 0., data)
+        cross = self.X.T @ data
+        factor = self.factor()
+
+        if mask is None or not mask.any():
+            if factor is None:
+                beta = np.linalg.lstsq(self._gram, cross, rcond=None)[0]
+            else:
+                beta = scipy.linalg.cho_solve(factor, cross)
+        else:
+            kind, first, second = self._correction(mask)
+            if kind == 'woodbury':
+                U, lower = factor
+                z = scipy.linalg.solve_triangular(U, cross, trans='T', lower=lower)
+                z += first @ scipy.linalg.cho_solve(second, first.T @ z)
+                beta = scipy.linalg.solve_triangular(U, z, lower=lower)
+            elif kind == 'cholesky':
+                beta = scipy.linalg.cho_solve(first, cross)
+            else:
+                beta = np.linalg.lstsq(first, cross, rcond=None)[0]
+        self.beta = beta.reshape(len(self.design.names), len(self.lags), data.shape[1])
+
+        return self
+
+    def effects(self, grid, ch_names, baseline=None):
+        """
+        Predicted response (like effects() in Julia) for every row of grid (DataFrame with the categorical
+        columns), long format: the grid columns, yhat, channel and time
+        baseline (tmin, tmax) subtracts the mean yhat of that window per row and channel (None is the start/end)
+        """
+        grid = grid.reset_index(drop=True)
+        prediction = np.einsum('gc,clh->ghl', self.design.matrix(grid), self.beta)   # (grid, channels, lags)
+        if baseline is not None:
+            start = self.times[0] if baseline[0] is None else baseline[0]
+            stop = self.times[-1] if baseline[1] is None else baseline[1]
+            window = (self.times >= start) & (self.times <= stop)
+            prediction = prediction - prediction[..., window].mean(axis=-1, keepdims=True)
+        n_grid, n_channels, n_lags = prediction.shape
+        effects = grid.loc[np.repeat(np.arange(n_grid), n_channels * n_lags)].reset_index(drop=True)
+        effects['yhat'] = prediction.ravel()
+        effects['channel'] = np.tile(np.repeat(np.asarray(ch_names), n_lags), n_grid)
+        effects['time'] = np.tile(self.times, n_grid * n_channels)
+
+        return effects
+
+
+_models = {}
+
+
+def cachedModel(sub, events_df, n_samples, sfreq, tau=TAU, terms=TERMS, latency_offset=LATENCY_OFFSET,
+                max_models=4):
+    """
+    The OverlapModel of a subject, formula and basis window, reused (with its factor) as long as the
+    events and the number of samples are the same, at most max_models are kept (least recently used is dropped)
+    The key hashes the whole prepareEvents() frame (column names, samples, codes and every categorical column
+    including setup/setdown), so a changed condition label gives a new design
+    """
+    events = prepareEvents(events_df)
+    events_hash = hashlib.sha1(repr(list(events.columns)).encode())
+    events_hash.update(pd.util.hash_pandas_object(events, index=False).to_numpy().tobytes())
+    key = (sub, tuple(terms), tuple(tau), sfreq, latency_offset, n_samples, events_hash.hexdigest())
+    if key in _models:
+        _models[key] = _models.pop(key)
+    else:
+        while len(_models) >= max_models:
+            _models.pop(next(iter(_models)))
+        _models[key] = OverlapModel(events_df, n_samples, sfreq, tau, terms, latency_offset)
+    return _models[key]
+
+
+def annotationMask(raw, descriptions=ARTIFACT_DESCRIPTIONS):
+    """
+    (samples,) mask of the samples of raw (index 0 is its first sample) in the annotations with these descriptions
+    Onsets follow the annotateBlinks() convention: relative to the first sample when orig_time is None
+    """
+    sfreq = raw.info['sfreq']
+    mask = np.zeros(raw.n_times, dtype=bool)
+    for annot in raw.annotations:
+        if annot['description'] not in descriptions:
+            continue
+        start = annot['onset'] * sfreq
+        if raw.annotations.orig_time is not None:
+            start -= raw.first_samp
+        start = max(int(round(start)), 0)
+        mask[start:max(int(round(start + annot['duration'] * sfreq)) + 1, start)] = True
+    return mask
+
+
+def effectsGrid(events):
+    """
+    The design of deconvolution.jl: sequence 2 at the positions above and below fixation of the localised
+    quadrant, both attention and expectation conditions
+    """
+    setup, setdown = str(events['setup'].iloc[0]), str(events['setdown'].iloc[0])
+    return pd.MultiIndex.from_product([['2'], [setup, setdown], ['attended', 'unattended'], ['regular', 'odd']],
+                                      names=['sequence', 'position', 'attention', 'expectation']).to_frame(index=False)
+
+
+####################################################
+#Subjects
+####################################################
+
+def loadSubject(sub, arrow_directory=ARROW_DESTINATION, csv_directory=DESTINATION, electrodes=ELECTRODES):
+    """
+    (samples, channels) data in uV, the events and the sampling rate of a subject from the arrow export
+    (sfreq of the manifest) or else the csv tree (from the time column)
+    """
+    manifest = readManifest(arrow_directory)
+    if str(sub) in manifest.get('subjects', {}):
+        from pyarrow import feather
+        entry = manifest['subjects'][str(sub)]
+        table = feather.read_table(os.path.join(arrow_directory, entry['data']), columns=list(electrodes))
+        data = np.column_stack([table.column(el).to_numpy() for el in electrodes])
+        return data, readEvents(arrow_directory, sub), entry['sfreq']
+    raw_paths, events_path = outputPaths(csv_directory, sub, electrodes)
+    frames = [pd.read_csv(raw_paths[el]) for el in electrodes]
+    data = np.column_stack([frame[el].to_numpy() for frame, el in zip(frames, electrodes)])
+    sfreq = float(np.round(1 / np.median(np.diff(frames[0]['time'].to_numpy())), 3))
+    return data, pd.read_csv(events_path), sfreq
+
+
+def artifactMask(sub, data_directory=DATA_DIRECTORY, descriptions=ARTIFACT_DESCRIPTIONS):
+    """
+    annotationMask() of the cleaned raw file of a subject (only the annotations are read)
+    """
+    raw = mne.io.read_raw_fif(subjectPaths(data_directory, sub)[0], preload = False, verbose = 'error')
+    return annotationMask(raw, descriptions)
+
+
+def correctSubject(sub, arrow_directory=ARROW_DESTINATION, csv_directory=DESTINATION,
+                   destination=OVERLAP_DESTINATION, electrodes=ELECTRODES, mask_artifacts=False,
+                   data_directory=DATA_DIRECTORY, baseline=None):
+    """
+    Fit all channels of a subject and write the effects of every electrode
+    mask_artifacts leaves out the annotated artifact samples of the cleaned raw file
+    Returns the subject number and the load, design and solve time (s)
+    """
+    t0 = time.perf_counter()
+    data, events_df, sfreq = loadSubject(sub, arrow_directory, csv_directory, electrodes)
+    mask = artifactMask(sub, data_directory) if mask_artifacts else None
+    t_load = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    model = cachedModel(sub, events_df, len(data), sfreq)
+    model.factor()
+    t_design = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    model.fit(data, mask)
+    t_solve = time.perf_counter() - t0
+
+    effects = model.effects(effectsGrid(model.events), electrodes, baseline)
+    effects['subject'] = model.events['subject'].iloc[0]
+    effects['selected_electrode'] = effects['channel']
+    subject_num = f'{int(model.events["subject"].iloc[0]):02}'
+    for el, el_effects in effects.groupby('channel', sort=False):
+        os.makedirs(os.path.join(destination, el), exist_ok=True)
+        el_effects.to_csv(os.path.join(destination, el, f'corrected_{el}_evoked_{subject_num}.csv'), index=False)
+
+    return sub, t_load, t_design, t_solve
+
+
+def compareJulia(python_directory, julia_directory, sub, electrodes=ELECTRODES):
+    """
+    Largest absolute difference and correlation of yhat between the python and the Julia output of a subject
+    per electrode (electrodes without a Julia file are left out)
+    """
+    keys = ['time', 'position', 'attention', 'expectation']
+    differences = {}
+    for el in electrodes:
+        name = f'{el}/corrected_{el}_evoked_{sub:02}.csv'
+        if not os.path.isfile(os.path.join(julia_directory, name)):
+            continue
+        frames = [pd.read_csv(os.path.join(directory, name)) for directory in [python_directory, julia_directory]]
+        for frame in frames:
+            frame['time'] = frame['time'].round(6)
+        merged = frames[0].merge(frames[1], on=keys, suffixes=('_python', '_julia'))
+        differences[el] = (np.abs(merged['yhat_python'] - merged['yhat_julia']).max(),
+                           np.corrcoef(merged['yhat_python'], merged['yhat_julia'])[0, 1], len(merged))
+    return differences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Overlap correction of all channels per subject')
+    parser.add_argument('--arrow', default=ARROW_DESTINATION, help='arrow export of fif_export.py')
+    parser.add_argument('--csv', default=DESTINATION, help='csv export, used when the arrow export is missing')
+    parser.add_argument('--destination', default=OVERLAP_DESTINATION)
+    parser.add_argument('--subjects', type=int, nargs='*', default=SUBJECTS)
+    parser.add_argument('--jobs', type=int, default=1, help='number of processes (each holds a subject in memory)')
+    parser.add_argument('--compare', nargs='?', const=JULIA_DESTINATION,
+                        help='directory with the Julia output to compare with (default: %(const)s)')
+    parser.add_argument('--mask-artifacts', action='store_true',
+                        help="leave out the 'bad_calibration_gap' and 'bad blink' samples of the cleaned raw files")
+    parser.add_argument('--data-directory', default=DATA_DIRECTORY, help='preprocessed data (for --mask-artifacts)')
+    parser.add_argument('--baseline', type=float, nargs=2, help='baseline window (s) subtracted from the effects')
+    args = parser.parse_args()
+    same_directory = [os.path.normcase(os.path.realpath(path)) for path in [args.compare or '', args.destination]]
+    if args.compare and same_directory[0] == same_directory[1]:
+        parser.error(f'--compare and --destination are the same directory ({args.destination}), '
+                     'the python output would be compared with itself')
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(correctSubject, sub, args.arrow, args.csv, args.destination, ELECTRODES,
+                               args.mask_artifacts, args.data_directory, args.baseline): sub
+                   for sub in args.subjects}
+        for future in as_completed(futures):
+            try:
+                sub, t_load, t_design, t_solve = future.result()
+                print(f'subject {sub}: load {t_load:.1f} s, design + factor {t_design:.1f} s, solve {t_solve:.1f} s')
+            except Exception as error:
+                print(f'subject {futures[future]} failed: {error!r}')
+
+    if args.compare:
+        for sub in args.subjects:
+            for el, (difference, r, n) in compareJulia(args.destination, args.compare, sub).items():
+                print(f'subject {sub} {el}: max |python - julia| {difference:.3g} uV, r = {r:.6f} ({n} points)')
@@ -0,0 +1,85 @@
+"""
+Tests of the python overlap correction (overlap_correction.py) on simulated data
+
+    python -m pytest test_overlap_correction.py
+"""
+import numpy as np
+import pandas as pd
+from overlap_correction import OverlapModel, cachedModel, firLags
+
+
+def simulatedEvents(n_events=400, sfreq=128, seed=0):
+    # Events every 0.3 to 0.5 s (the responses of 1.1 s overlap) with random conditions
+    rng = np.random.default_rng(seed)
+    samples = 200 + np.cumsum(rng.integers(int(.3 * sfreq), int(.5 * sfreq), n_events))
+    position = rng.integers(1, 5, n_events)
+    sequence = rng.integers(1, 5, n_events)
+    events_df = pd.DataFrame({'sample': samples, 'event_codes': position * 10 + sequence,
+                              'position': position, 'sequence': sequence,
+                              'attention': rng.choice(['attended', 'unattended'], n_events),
+                              'expectation': rng.choice(['regular', 'odd'], n_events),
+                              'setup': '1', 'setdown': '3', 'subject': 1})
+    return events_df, int(samples[-1] + 2 * sfreq)
+
+
+def simulatedData(model, n_channels=3, noise=0., seed=1):
+    rng = np.random.default_rng(seed)
+    beta = rng.standard_normal((model.X.shape[1], n_channels))
+    data = model.X @ beta + noise * rng.standard_normal((model.X.shape[0], n_channels))
+    return data, beta.reshape(len(model.design.names), len(model.lags), n_channels)
+
+
+def refit(model, data, mask):
+    # Normal equations of the design without the masked rows, factorised from scratch
+    kept = model.X[np.flatnonzero(~mask)]
+    return np.linalg.solve((kept.T @ kept).toarray(), kept.T @ data[~mask])
+
+
+def test_lags_follow_the_sampling_rate():
+    assert firLags(512).tolist() == list(range(-51, 513))
+    assert firLags(256).tolist() == list(range(-26, 257))
+    assert firLags(128, tau=(-.5, .5)).tolist() == list(range(-64, 65))
+
+
+def test_overlapping_responses_are_recovered():
+    events_df, n_samples = simulatedEvents()
+    model = OverlapModel(events_df, n_samples, 128)
+    data, beta = simulatedData(model)
+    model.fit(data)
+    assert np.allclose(model.beta, beta)
+    assert np.allclose(model.times, model.lags / 128)
+
+
+def test_masked_samples_are_deleted_rows():
+    # The Woodbury correction of the cached factor is the least squares fit without the masked samples
+    events_df, n_samples = simulatedEvents()
+    model = OverlapModel(events_df, n_samples, 128)
+    data, beta = simulatedData(model, noise=1.)
+    mask = np.zeros(n_samples, dtype=bool)
+    mask[3000:3040] = True
+    mask[9000:9010] = True
+    model.fit(data, mask)
+    assert model._correction(mask)[0] == 'woodbury'
+    expected = refit(model, data, mask)
+    assert np.allclose(model.beta.reshape(expected.shape), expected)
+
+
+def test_large_mask_is_refactorised():
+    events_df, n_samples = simulatedEvents()
+    model = OverlapModel(events_df, n_samples, 128)
+    data, beta = simulatedData(model, noise=1.)
+    mask = np.zeros(n_samples, dtype=bool)
+    mask[2000:6000] = True
+    model.fit(data, mask)
+    assert model._correction(mask)[0] == 'cholesky'
+    expected = refit(model, data, mask)
+    assert np.allclose(model.beta.reshape(expected.shape), expected)
+
+
+def test_cached_model_depends_on_the_events_and_the_rate():
+    events_df, n_samples = simulatedEvents()
+    model = cachedModel(1, events_df, n_samples, 128)
+    assert cachedModel(1, events_df.copy(), n_samples, 128) is model
+    assert cachedModel(1, events_df, n_samples, 256) is not model
+    relabelled = events_df.assign(attention=events_df['attention'].iloc[::-1].to_numpy())
+    assert cachedModel(1, relabelled, n_samples, 128) is not model
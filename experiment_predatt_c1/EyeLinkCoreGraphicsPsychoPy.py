@@ -31,7 +31,6 @@ from __future__ import print_function
 
 import os
 import platform
-import array
 import string
 import pylink
 import numpy
@@ -39,7 +38,6 @@ import psychopy
 from psychopy import visual, event, core, logging, prefs, monitors
 from psychopy.tools.coordinatetools import pol2cart
 from math import sin, cos, pi
-from PIL import Image, ImageDraw
 from psychopy.sound import Sound
 
 
@@ -85,7 +83,11 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
             self._display.setUnits('pix')
 
         # Camera image set up
-        self._imagebuffer = array.array('I')
+        self._frame = None  # (height, width) uint32 camera frame, filled line by line
+        self._frameRGB = None  # the same frame as floats for the texture
+        self._cameraStim = None  # one ImageStim, only its texture is updated every frame
+        self._overlayPoints = []  # crosshair/search limit pixels of the current frame
+        self._overlayColors = []
         self._pal = None  # color pallete to use for camera image drawing
         self._size = (384, 320)
 
@@ -175,7 +177,9 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
 
         # The tracker is running in mouse simulation mode?
         self._mouse_simulation = False
-        self.imgResize = None
+
+        # Wait for every beep to finish like the original library (slower calibration)
+        self.blockingBeeps = False
 
     def __str__(self):
         """ Overwrite __str__ to show some information about the
@@ -430,20 +434,26 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
                 pass
             else:
                 if beepid in [pylink.CAL_TARG_BEEP, pylink.DC_TARG_BEEP]:
-                    if self._target_beep is not None:
-                        self._target_beep.play()
-                        core.wait(0.5)
+                    self._playBeep(self._target_beep, 0.5)
                 elif beepid in [pylink.CAL_ERR_BEEP, pylink.DC_ERR_BEEP]:
-                    if self._error_beep is not None:
-                        self._error_beep.play()
-                        core.wait(1.2)
+                    self._playBeep(self._error_beep, 1.2)
                 elif beepid in [pylink.CAL_GOOD_BEEP, pylink.DC_GOOD_BEEP]:
-                    if self._done_beep is not None:
-                        self._done_beep.play()
-                        core.wait(0.5)
+                    self._playBeep(self._done_beep, 0.5)
                 else:
                     pass
 
+    def _playBeep(self, beep, duration):
+        """ Start a beep without waiting for it to finish (sound plays in the background)
+        A beep that is still playing is restarted
+        With blockingBeeps the old behaviour (wait for duration) is kept, e.g. to compare calibration times""" 
+
+        if beep is None:
+            return
+        beep.stop()
+        beep.play()
+        if self.blockingBeeps:
+            core.wait(duration)
+
     def getColorFromIndex(self, colorindex):
         """ Return psychopy colors for elements in the camera image""" 
 
@@ -461,12 +471,11 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
             return (128, 128, 128)
 
     def draw_line(self, x1, y1, x2, y2, colorindex):
-        """ Draw a line. This is used for drawing crosshairs/squares""" 
-
-        color = self.getColorFromIndex(colorindex)
+        """ Draw a line. This is used for drawing crosshairs/squares
+        The points are collected and drawn into the camera frame all at once""" 
 
+        h, w = self._frame.shape
         if self._size[0] > 192:
-            w, h = self._img.im.size
             x1 = int((float(x1) / 192) * w)
             x2 = int((float(x2) / 192) * w)
             y1 = int((float(y1) / 160) * h)
@@ -474,44 +483,62 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
 
         # draw the line
         if not any([x < 0 for x in [x1, x2, y1, y2]]):
-            self._img.line([(x1, y1), (x2, y2)], color)
+            self._addOverlay(_linePoints(x1, y1, x2, y2), colorindex)
 
     def draw_lozenge(self, x, y, width, height, colorindex):
         """ Draw a lozenge to show the defined search limits
         (x,y) is top-left corner of the bounding box
         """ 
 
-        color = self.getColorFromIndex(colorindex)
-
+        h, w = self._frame.shape
         if self._size[0] > 192:
-            w, h = self._img.im.size
             x = int((float(x) / 192) * w)
             y = int((float(y) / 160) * h)
             width = int((float(width) / 192) * w)
             height = int((float(height) / 160) * h)
 
+        # Angles in degrees clockwise from 3 o'clock, like PIL ImageDraw.arc
         if width > height:
             rad = int(height / 2.)
             if rad == 0:
                 return
             else:
-                self._img.line([(x + rad, y), (x + width - rad, y)], color, 1)
-                self._img.line([(x + rad, y + height),
-                                (x + width - rad, y + height)], color, 1)
-                self._img.arc([x, y, x + rad*2, y + rad*2], 90, 270, color, 1)
-                self._img.arc([x + width - rad*2, y, x + width, y + height],
-                              270, 90, color, 1)
+                points = [_linePoints(x + rad, y, x + width - rad, y),
+                          _linePoints(x + rad, y + height, x + width - rad, y + height),
+                          _arcPoints(x, y, x + rad*2, y + rad*2, 90, 270),
+                          _arcPoints(x + width - rad*2, y, x + width, y + height, 270, 90)]
         else:
             rad = int(width / 2.)
             if rad == 0:
                 return
             else:
-                self._img.line([(x, y + rad), (x, y + height - rad)], color, 1)
-                self._img.line([(x + width, y + rad),
-                                (x + width, y + height - rad)], color, 1)
-                self._img.arc([x, y, x + rad*2, y + rad*2], 180, 360, color, 1)
-                self._img.arc([x, y + height-rad*2, x + rad*2, y + height],
-                              0, 180, color, 1)
+                points = [_linePoints(x, y + rad, x, y + height - rad),
+                          _linePoints(x + width, y + rad, x + width, y + height - rad),
+                          _arcPoints(x, y, x + rad*2, y + rad*2, 180, 360),
+                          _arcPoints(x, y + height-rad*2, x + rad*2, y + height, 0, 180)]
+        self._addOverlay(numpy.concatenate(points), colorindex)
+
+    def _addOverlay(self, points, colorindex):
+        """ Add the (n, 2) x, y pixels of a crosshair/lozenge to the overlay of this frame""" 
+
+        r, g, b = self.getColorFromIndex(colorindex)
+        self._overlayPoints.append(points)
+        self._overlayColors.append(numpy.full(len(points), (b << 16) | (g << 8) | r, dtype=numpy.uint32))
+
+    def _drawOverlay(self):
+        """ Draw the crosshairs and search limits of this frame into the camera frame in one go""" 
+
+        self._overlayPoints = []
+        self._overlayColors = []
+        # pylink calls draw_line() and draw_lozenge() for every primitive
+        self.draw_cross_hair()
+        if not self._overlayPoints:
+            return
+        points = numpy.concatenate(self._overlayPoints)
+        colors = numpy.concatenate(self._overlayColors)
+        h, w = self._frame.shape
+        inside = (points[:, 0] >= 0) & (points[:, 0] < w) & (points[:, 1] >= 0) & (points[:, 1] < h)
+        self._frame[points[inside, 1], points[inside, 0]] = colors[inside]
 
     def get_mouse_state(self):
         """ Get the current mouse position and status""" 
@@ -650,56 +677,77 @@ class EyeLinkCoreGraphicsPsychoPy(pylink.EyeLinkCustomDisplay):
     def image_title(self, text):
         """ Draw title text below the camera image""" 
 
-        if self.imgResize is not None:
-            im_w, im_h = self.imgResize.size
+        if self._cameraStim is not None:
+            im_w, im_h = self._cameraStim.size
             self._title.pos = (0, - im_h/2.0 - self._msgHeight)
         else:
             self._title.pos = (0, -self._size[1]/2 - self._msgHeight)
         self._title.text = text
 
     def draw_image_line(self, width, line, totlines, buff):
-        """ Display image pixel by pixel, line by line""" 
+        """ Display image line by line, the palette lookup is done with numpy
+        and the complete frame is uploaded to the texture of one ImageStim""" 
 
-        i = 0
-        for i in range(width):
-            try:
-                self._imagebuffer.append(self._pal[buff[i]])
-            except:
-                pass
+        if self._frame is None or self._frame.shape != (totlines, width):
+            self._frame = numpy.zeros((totlines, width), dtype=numpy.uint32)
+            self._frameRGB = numpy.zeros((totlines, width, 3), dtype=numpy.float32)
+        # Indices outside of the palette get its last color
+        self._frame[line-1] = self._pal.take(numpy.asarray(buff[:width]), mode='clip')
 
         if line == totlines:
-            bufferv = self._imagebuffer.tostring()
-            img = Image.frombytes("RGBX", (width, totlines), bufferv)
-            self._img = ImageDraw.Draw(img)
-            self.draw_cross_hair()
-            self.imgResize = img.resize((width*2, totlines*2))
-            imgResizeVisual = visual.ImageStim(self._display,
-                                               image=self.imgResize,
-                                               units='pix')
-            imgResizeVisual.draw()
+            self._drawOverlay()
+            # RGBX bytes to psychopy rgb (-1 to 1), numpy images are drawn bottom row first
+            rgbx = self._frame.view(numpy.uint8).reshape(totlines, width, 4)
+            numpy.multiply(rgbx[::-1, :, :3], 2/255., out=self._frameRGB)
+            self._frameRGB -= 1
+            # The image is shown at twice its size, scaled on the GPU
+            if self._cameraStim is None:
+                self._cameraStim = visual.ImageStim(self._display,
+                                                    image=self._frameRGB,
+                                                    size=(width*2, totlines*2),
+                                                    units='pix')
+            else:
+                self._cameraStim.image = self._frameRGB
+                if tuple(self._cameraStim.size) != (width*2, totlines*2):
+                    self._cameraStim.size = (width*2, totlines*2)
+            self._cameraStim.draw()
             # Change the position of the camera title
             self._title.pos = (0, - totlines*2/2.0 - self._msgHeight)
             self._display.flip()
-            self._imagebuffer = array.array('I')
 
     def set_image_palette(self, r, g, b):
-        """ Given a set of RGB colors, create a list of 24bit numbers
+        """ Given a set of RGB colors, create an array of 24bit numbers
         representing the pallet.
 
-        i.e., RGB of (1,64,127) would be saved as 82047,
-        or the number 00000001 01000000 011111111""" 
+        i.e., RGB of (1,64,127) would be saved as 8339457,
+        or the number 01111111 01000000 00000001 (blue, green, red
+        so the little-endian bytes of a pixel are R, G, B, X)""" 
+
+        r = numpy.asarray(r, dtype=numpy.uint32)
+        g = numpy.asarray(g, dtype=numpy.uint32)
+        b = numpy.asarray(b, dtype=numpy.uint32)
+        self._pal = (b << 16) | (g << 8) | r
+
+
+def _linePoints(x1, y1, x2, y2):
+    """ (n, 2) integer pixels of a one pixel wide line""" 
+
+    n = max(abs(x2 - x1), abs(y2 - y1)) + 1
+    t = numpy.linspace(0, 1, n)
+    return numpy.stack([numpy.rint(x1 + (x2 - x1)*t), numpy.rint(y1 + (y2 - y1)*t)], axis=1).astype(int)
+
 
-        self._imagebuffer = array.array('I')
+def _arcPoints(x0, y0, x1, y1, start, end):
+    """ (n, 2) integer pixels of an arc of the ellipse in the box (x0, y0, x1, y1)
+    from start to end degrees, clockwise from 3 o'clock (PIL ImageDraw.arc)""" 
 
-        sz = len(r)
-        i = 0
-        self._pal = []
-        while i < sz:
-            rf = int(b[i])
-            gf = int(g[i])
-            bf = int(r[i])
-            self._pal.append((rf << 16) | (gf << 8) | (bf))
-            i = i+1
+    if end <= start:
+        end += 360
+    rx, ry = (x1 - x0) / 2., (y1 - y0) / 2.
+    # about one point per pixel of arc length
+    n = int(numpy.ceil(max(rx, ry) * numpy.radians(end - start))) + 1
+    t = numpy.radians(numpy.linspace(start, end, n))
+    return numpy.stack([numpy.rint(x0 + rx + rx*numpy.cos(t)), numpy.rint(y0 + ry + ry*numpy.sin(t))], axis=1).astype(int)
 
 
 # A short testing script showing the basic usage of this library
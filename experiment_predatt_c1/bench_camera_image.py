@@ -0,0 +1,77 @@
+"""
+Frames per second of the camera image in EyeLinkCoreGraphicsPsychoPy.draw_image_line
+Compares the old pixel by pixel path (array.array, PIL resize and a new ImageStim every frame)
+with the current one (numpy palette lookup into one ImageStim texture)
+Needs psychopy and pylink but no tracker, random frames of the EyeLink camera size are used
+
+    python bench_camera_image.py --frames 200
+"""
+
+import argparse
+import array
+import time
+import numpy as np
+from PIL import Image, ImageDraw
+from psychopy import visual
+from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy
+
+
+def oldDrawImageLine(genv, width, line, totlines, buff):
+    """
+    draw_image_line as it was before the numpy version
+    """
+    for i in range(width):
+        try:
+            genv._imagebuffer.append(genv._oldPal[buff[i]])
+        except:
+            pass
+
+    if line == totlines:
+        bufferv = genv._imagebuffer.tobytes()   # tostring() is gone in recent python versions
+        img = Image.frombytes("RGBX", (width, totlines), bufferv)
+        genv._img = ImageDraw.Draw(img)
+        genv.draw_cross_hair()
+        imgResize = img.resize((width*2, totlines*2))
+        imgResizeVisual = visual.ImageStim(genv._display, image=imgResize, units='pix')
+        imgResizeVisual.draw()
+        genv._display.flip()
+        genv._imagebuffer = array.array('I')
+
+
+def framesPerSecond(draw_line, frames, width, height):
+    """
+    Feed the frames line by line (1-based like pylink) and return the frames per second
+    """
+    t0 = time.perf_counter()
+    for frame in frames:
+        for line in range(height):
+            draw_line(width, line+1, height, frame[line])
+
+    return len(frames) / (time.perf_counter() - t0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the camera image of the calibration graphics')
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--width', type=int, default=384)
+    parser.add_argument('--height', type=int, default=320)
+    args = parser.parse_args()
+
+    win = visual.Window((1280, 720), units='pix', fullscr=False, waitBlanking=False)
+    genv = EyeLinkCoreGraphicsPsychoPy(None, win)
+    # The crosshair is drawn through the tracker connection, there is none here
+    genv.draw_cross_hair = lambda: None
+
+    rng = np.random.default_rng(0)
+    r, g, b = rng.integers(0, 256, (3, 256))
+    genv.set_image_palette(r, g, b)
+    genv._oldPal = [int(v) for v in genv._pal]
+    genv._imagebuffer = array.array('I')
+    # pylink hands over each line as a list of palette indices
+    frames = [[list(row) for row in rng.integers(0, 256, (args.height, args.width))] for i in range(args.frames)]
+
+    before = framesPerSecond(lambda *a: oldDrawImageLine(genv, *a), frames, args.width, args.height)
+    after = framesPerSecond(genv.draw_image_line, frames, args.width, args.height)
+    print('camera image %dx%d: before %.1f frames/s, after %.1f frames/s (x%.1f)'
+          % (args.width, args.height, before, after, after / before))
+    win.close()
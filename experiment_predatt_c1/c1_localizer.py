@@ -6,14 +6,13 @@ Created on Tue Oct 24 2023
 import numpy as np
 import os
 import time
-import random
 import sys
 import pylink #the last is to communicate with the eyetracker
 from psychopy import parallel, visual, gui, data, event, core, monitors
 from psychopy.visual import ShapeStim
 from psychopy import logging
-from math import fabs
 from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy
+from predatt_tools import cachedStimPositions, generateQuadLocalizerTrials, FakePort, TriggerDispatcher, writeTriggerLatencies, writeCalibrationTimes, GazeMonitor, runLocalizerTrials #helpers that do not need a window
 
 ####################SELECT THE RIGHT LAB & Mode####################
 lab = 'biosemi'   #'actichamp'/'biosemi'/'none'
@@ -23,6 +22,10 @@ mode = 'default'   #'default'/'DemoMode' #affects nr of trials per block (50%)
 eye_tracking = True #True/False
 
 sub = 1
+
+trigger_pulse_width = .01 # seconds a trigger code stays on the port
+trigger_diagnostics = False # True/False keeps the flip-to-trigger delay of every stimulus trigger
+calibration_blocking_beeps = False # True waits for every calibration beep like before (slower), to compare calibration durations
 ###################################################################
 
 # Define a monitor
@@ -77,132 +80,23 @@ teststim = ShapeStim(win, vertices=[(0.5,1.0), (1.0,1.0), (0.5,1.0), (1.0,1.0)],
 #Functions for generating the stimulus
 ####################################################
 
-def generateStimCoordinates(gridcol, gridrow, jitter):
-    """
-    Generates coordinates used to draw the stimulus lines
-    """
-    # Calculate spacing of grid
-    x_spacing = 1.0 / (gridcol)
-    y_spacing = 1.0 / (gridrow)
-
-    # Create an array to store coordinates: every point (x,y) of the grid for every quadrant (4) 
-    coord_array = np.empty(shape = (gridcol,gridrow,2,4),dtype= 'object')
-    quadrant_set = [[-1,1],[1,1],[1,-1],[-1,-1]]
-
-    # Generate grid coord per quadrant
-    for i,quad in enumerate(quadrant_set):
-        # Per row
-        for row in range(gridrow):
-            # Per column
-            for col in range (gridcol):
-
-                grid_x = col * x_spacing  # grid points
-                grid_y = row * y_spacing  
-
-                grid_x = grid_x * quad[0]   # quadrant position
-                grid_y = grid_y * quad[1]   # quadrant position
-
-                coord_array[col,row,0,i] = grid_x  # Store them in big ass array
-                coord_array[col,row,1,i] = grid_y
-
-    # flip the matrices so that they have the 'orientation' corresponding to the quadrant 
-    coord_array[:,:,0,0] = np.flip(coord_array[:,:,0,0], axis=0) 
-    coord_array[:,:,1,0] = np.flip(coord_array[:,:,1,0], axis=0) 
-
-    coord_array[:,:,0,2] = np.flip(coord_array[:,:,0,2], axis=1) 
-    coord_array[:,:,1,2] = np.flip(coord_array[:,:,1,2], axis=1) 
-
-    coord_array[:,:,0,3] = np.flip(coord_array[:,:,0,3], axis=(0,1)) 
-    coord_array[:,:,1,3] = np.flip(coord_array[:,:,1,3], axis=(0,1)) 
-
-    #  Add jitter
-    for i in range(4):
-        coord_array[:,:,:,i] =  coord_array[:,:,:,i] + jitter[:gridcol,:gridrow,:]
-  
-    return coord_array
-
-
-def generateLocalizerStimCoordinates(gridcol, gridrow, jitter):
-    """
-    Generates coordinates used to draw the localizer stimulus lines
-    This is partically the same function as generateStimCoordinates() but for upper and lower visual field
-    instead of quandrant
-    """
-    # Calculate spacing of grid
-    x_spacing = 2.0 / (gridcol)
-    y_spacing = 1.0 / (gridrow)
-
-    # Create an array to store coordinates: every point (x,y) of the grid for every quadrant (4) 
-    coord_array = np.empty(shape = (gridcol,gridrow,2,2),dtype= 'object')
-    field_set = [1,-1]
-
-    # Generate grid coord per quadrant
-    for i,field in enumerate(field_set):
-        # Per row
-        for row in range(gridrow):
-            # Per column
-            for col in range (gridcol):
-
-                grid_x = -1 + col * x_spacing  # grid points
-                grid_y = row * y_spacing
-
-                grid_y = grid_y * field   # which visual field up/down
-
-                coord_array[col,row,0,i] = grid_x  # Store them in big ass array
-                coord_array[col,row,1,i] = grid_y
-
-    # flip the matrices so that they have the 'orientation' corresponding to the quadrant 
-    coord_array[:,:,0,0] = np.flip(coord_array[:,:,0,0], axis=0) 
-    coord_array[:,:,1,0] = np.flip(coord_array[:,:,1,0], axis=0) 
-
-
-    #  Add jitter
-    for i in range(2):
-        coord_array[:,:,:,i] =  coord_array[:,:,:,i] + jitter[:gridcol,:gridrow,:]
-  
-    return coord_array
-
-
-def generateStim(linelength, linewidth ,coord_array, colour, catch_colour, size, fixdistance, localizer = False ):
+def generateStim(linelength, linewidth, gridcol, gridrow, jitter, colour, catch_colour, size, fixdistance, localizer = False ):
     """ 
     Generate an ElementArrayStim object consisting of lines on the coordinates for stimulus for each quadrant
     Then four more arrays are created each representing a catch trial in a separate quadrant
-    Returns a 5x4 array of lists with each list containing the line stimuli for a quadrant
+    Returns a 2x4 array with each element containing the line stimuli for a quadrant
     If localizer is set to True then it generates a grid in the upper or lower visual field instead of quadrants
     """
-    # This 
-    if localizer:
-        sections = 2
-        dist = fixdistance
-        quads = [[0,1],[0,-1]]
-    else:
-        sections = 4
-        # This is to calculate the distance to the fixation cross
-        dist = np.sqrt(np.square(fixdistance)/2) #pythagoras
-        quads = [[-1,1],[1,1],[1,-1],[-1,-1]]
-
-    # Get size of grid
-    gridcol = np.shape(coord_array)[0]
-    gridrow = np.shape(coord_array)[1]
+    # Positions of every line for every quadrant (or field), computed once and cached
+    all_xys = cachedStimPositions(gridcol, gridrow, jitter, size, fixdistance, localizer=localizer)
+    sections, n_lines = np.shape(all_xys)[:2]
 
     # Init arrays to store line objects per quadrant and also for every possible catch trial 
     line_stimuli = np.empty((2,sections), dtype=object)   # 2 types (0 is normal white lines, 1 is catch stim ) and 4 quadrants
+    sizes = np.atleast_2d([linelength,linewidth]).repeat(repeats=n_lines, axis=0)
  
     for quad in range(sections):
-        n_lines = gridcol*gridrow
-        xys = np.empty((n_lines,2)) #coordinates to pass to elementArrayStim
-        it_count = 0 # idk man... this is a work around because im too lazy to completely change the structure that I used before i.e. two nested loops per column (below)
-        for row in range(gridrow):
-            for col in range(gridcol):
-
-                # Define stim coordinates
-                the_x = (coord_array[col,row,0,quad] * size) + (quads[quad][0]*dist)  # size and distance from fixation are all in here 
-                the_y = (coord_array[col,row,1,quad] * size) + (quads[quad][1]*dist)              
-                                                                              
-                xys[it_count,0] = the_x
-                xys[it_count,1] = the_y
-                it_count += 1
-        sizes = np.atleast_2d([linelength,linewidth]).repeat(repeats=n_lines, axis=0)
+        xys = all_xys[quad]
         # Normal stimuli
         line_stimuli[0,quad] = visual.ElementArrayStim(win, units='pix',elementTex=None, elementMask='sqr', xys= xys,
                                            nElements=n_lines, sizes=sizes, colors=(1.0, 1.0, 1.0), colorSpace='rgb')
@@ -229,52 +123,13 @@ def drawStim(line_stimuli, quad, catch):
 #Trial display functions
 ####################################################
 
-def fieldLocalizer(field,line_stim, stim_dur, isi_dur, lab=lab):
+def onsetDiagnostics(trigger, stim_onset):
     """
-    Function for the presentation of localizer which tries to differentiate the C1 for upper and lower visual field
+    Keeps the flip-to-trigger delay of a stimulus trigger in diagnostic mode
+    The localizer trials themselves are presentLocalizerTrial() in predatt_tools.py (also run by headless_run.py)
     """
-    # Check timing
-    stim_clock = core.Clock()
-    win.flip()
-    stim_clock.reset()
-    # Set eeg trigger here 80 means upper field and 81 means lower field
-    trigger = int(80 + field)
-    # Drawing stim, this should be generated with generateStim() with localizer set to True
-    drawStim(line_stim, field, 0)
-    wait = isi_dur/2-stim_clock.getTime()
-    core.wait(wait)
-    win.flip()
-    eegTriggerSend(trigger,lab)  # Send trigger
-    stim_clock.reset() # keep track of stim timing
-    core.wait(stim_dur)
-    win.flip()
-    stim_timing =stim_clock.getTime() * 1000
-    core.wait(isi_dur/2)
-
-    return stim_timing
-
-
-####################################################
-#Trial sequence functions
-####################################################
-
-def generateQuadLocalizerTrials(quad_reps, asynchronous=False, isi=.500 , jitter=.050):
-    """
-    Generate triallist for the C1 localizer in the beginning of the experiment this time for each quadrant
-    Also provides a list of timings to insert into presentation function when you want an asynchronous onset
-    """
-    # Make the proportions and randomize
-    localizer_prelist = [0,1,2,3]
-    localizer_list = np.repeat(localizer_prelist,quad_reps)
-    random.shuffle(localizer_list)
-    # Timing lists
-    isi_list = np.repeat([isi],quad_reps*4)
-    jitter_list = np.random.default_rng().uniform(-jitter,jitter,quad_reps)
-    if asynchronous:
-        for ind,t in enumerate(jitter_list):
-            isi_list[ind] = (isi_list[ind] + t)
-
-    return localizer_list, isi_list
+    if trigger_diagnostics:
+        trigger_latencies.append([trigger, stim_onset, eeg_triggers.log[-1][2]])
 
 
 ####################################################
@@ -282,16 +137,13 @@ def generateQuadLocalizerTrials(quad_reps, asynchronous=False, isi=.500 , jitter
 ####################################################
 
 #EEGTriggerSend#
-def eegTriggerSend(eeg_trigger, lab): #need to elaborate
+def eegTriggerSend(eeg_trigger, lab, flip_time=None):
     """
     Sends trigger to EEG recording
+    The port is set right away (or at flip_time) and reset to 0 by the trigger thread, so this does not block
+    With lab = 'none' the triggers go to a FakePort that prints them
     """
-    if not lab == 'none':
-        gsr_port.setData(eeg_trigger)
-        core.wait(0.01)
-        gsr_port.setData(0)
-    else:
-        print(eeg_trigger)
+    eeg_triggers.send(eeg_trigger, flip_time=flip_time)
 
 # Select EEG stimulus trigger
 def selectEEGStimulusTrigger(start,pos):
@@ -308,6 +160,12 @@ if lab == 'actichamp':
     gsr_port = parallel.ParallelPort(address=0xCFB8)
 elif lab == 'biosemi':
     gsr_port = parallel.ParallelPort(address=0x3FB8)
+else:
+    gsr_port = FakePort(clock=core.monotonicClock.getTime)
+# Resets the port to 0 after trigger_pulse_width on a separate thread
+# (same clock as the win.flip() time stamps, so trigger and flip times can be compared)
+trigger_latencies = [] # [code, flip time, trigger time] per stimulus when trigger_diagnostics is True
+eeg_triggers = TriggerDispatcher(gsr_port, pulse_width=trigger_pulse_width, clock=core.monotonicClock.getTime)
 
 ####################################################
 #Eye-tracker set-up
@@ -380,6 +238,10 @@ if eye_tracking:
     genv = EyeLinkCoreGraphicsPsychoPy(el_tracker, win)
     print(genv)  # print out the version number of the CoreGraphics library
 
+    # Link samples of the tracked eye, used for the fixation check (120 x 120 pixels around the screen centre)
+    gaze_monitor = GazeMonitor(el_tracker, eye_used=0, centre=(scn_width/2.0, scn_height/2.0), radius=60,
+                               sample_type=pylink.SAMPLE_TYPE, missing=pylink.MISSING_DATA)
+
     # Set background and foreground colors for the calibration target
     # in PsychoPy, (-1, -1, -1)=black, (1, 1, 1)=white, (0, 0, 0)=mid-gray
     foreground_color = (1, 1, 1)
@@ -401,19 +263,32 @@ if eye_tracking:
     #     error -- sound to play on failure or interruption
     # Each parameter could be ''--default sound, 'off'--no sound, or a wav file
     genv.setCalibrationSounds('', '', '')
+    genv.blockingBeeps = calibration_blocking_beeps
 
     # Request Pylink to use the PsychoPy window we opened above for calibration
     pylink.openGraphicsEx(genv)
         
-if eye_tracking:
-    message.text = 'Setting up the tracker, please wait\n' #show calibration message
-    message.draw()
-    win.flip()
+# Calibration/validation with timing
+calibration_times = [] # seconds per tracker setup, see writeCalibrationTimes()
+
+def trackerSetup():
+    """
+    Calibration/validation screen of the tracker (doTrackerSetup), the duration of every setup is kept in calibration_times
+    """
+    setup_start = core.getTime()
     try:
         el_tracker.doTrackerSetup()
     except RuntimeError as err:
         print('ERROR:', err)
-        el_tracker.exitCalibration() #calibrate the tracker #once you are happy with the calibration and validation (!), you are ready to run the experiment. 
+        el_tracker.exitCalibration()
+    calibration_times.append(core.getTime() - setup_start)
+
+
+if eye_tracking:
+    message.text = 'Setting up the tracker, please wait\n' #show calibration message
+    message.draw()
+    win.flip()
+    trackerSetup()
 
 # Eye-tracker termination function
 def terminate_task():
@@ -449,81 +324,54 @@ def terminate_task():
         el_tracker.close()
 
 def checkGazeOnFix():
-    # Here we implement a gaze trigger, so the target only comes up when
-    # the subject direct gaze to the fixation cross
+    """
+    Gaze trigger, the trial only starts when the participant fixates the cross for 300 ms
+    All link samples go through gaze_monitor so none are missed between polls
+    Returns 'yes' when the tracker should be recalibrated ('no' otherwise, or the error of isRecording())
+    and the dwell statistics of the check (with the 'wait' until it ended on every path)
+    """
     event.clearEvents()  # clear cached PsychoPy events
-    # determine which eye(s) is/are available
-    # 0- left, 1-right, 2-binocular
-    eye_used = el_tracker.eyeAvailable()
-    new_sample = None
-    old_sample = None
-    trigger_fired = False
-    in_hit_region = False
     should_recali = 'no'
     trigger_start_time = core.getTime()
     # fire the trigger following a 300-ms gaze
     minimum_duration = 0.3
-    gaze_start = -1
-    while not trigger_fired:
+    # determine which eye(s) is/are available
+    # 0- left, 1-right, 2-binocular
+    gaze_monitor.eye_used = el_tracker.eyeAvailable()
+    # Only samples from after the start of the check count
+    gaze_monitor.poll()
+    since = gaze_monitor.n_total
+    while True:
         # abort the current trial if the tracker is no longer recording
         error = el_tracker.isRecording()
         if error is not pylink.TRIAL_OK:
             el_tracker.sendMessage('tracker_disconnected')
-            return error
+            should_recali = error
+            break
 
-        # if the trigger did not fire in 30 seconds, abort trial
+        # if the trigger did not fire in 10 seconds, abort trial
         if core.getTime() - trigger_start_time >= 10.0:
             el_tracker.sendMessage('trigger_timeout_recal')
             # re-calibrate before trial
             should_recali = 'yes'
-            return should_recali
+            break
 
         # check for keyboard events, skip a trial if ESCAPE is pressed
-        # terminate the task is Ctrl-C is pressed
-        for keycode, modifier in event.getKeys(modifiers=True):
-            # Abort a trial and recalibrate if "ESCAPE" is pressed
-            if keycode == 'escape':
-                el_tracker.sendMessage('abort_and_recal')
-                # re-calibrate now trial
-                should_recali = 'yes'
-                return should_recali
-
-        # Do we have a sample in the sample buffer?
-        # and does it differ from the one we've seen before?
-        new_sample = el_tracker.getNewestSample()
-        if new_sample is not None:
-            if old_sample is not None:
-                if new_sample.getTime() != old_sample.getTime():
-                    # check if the new sample has data for the eye
-                    # currently being tracked; if so, we retrieve the current
-                    # gaze position and PPD (how many pixels correspond to 1
-                    # deg of visual angle, at the current gaze position)
-                    if eye_used == 1 and new_sample.isRightSample():
-                        g_x, g_y = new_sample.getRightEye().getGaze()
-                    if eye_used == 0 and new_sample.isLeftSample():
-                        g_x, g_y = new_sample.getLeftEye().getGaze()
-
-                    # break the while loop if the current gaze position is
-                    # in a 120 x 120 pixels region around the screen centered
-                    fix_x, fix_y = (scn_width/2.0, scn_height/2.0)
-                    if fabs(g_x - fix_x) < 60 and fabs(g_y - fix_y) < 60:
-                        # record gaze start time
-                        if not in_hit_region:
-                            if gaze_start == -1:
-                                gaze_start = core.getTime()
-                                in_hit_region = True
-                        # check the gaze duration and fire
-                        if in_hit_region:
-                            gaze_dur = core.getTime() - gaze_start
-                            if gaze_dur > minimum_duration:
-                                trigger_fired = True
-                    else:  # gaze outside the hit region, reset variables
-                        in_hit_region = False
-                        gaze_start = -1
-
-            # update the "old_sample"
-            old_sample = new_sample
-    return should_recali
+        if 'escape' in event.getKeys():
+            el_tracker.sendMessage('abort_and_recal')
+            # re-calibrate now trial
+            should_recali = 'yes'
+            break
+
+        # gaze has to stay in a 120 x 120 pixels region around the screen centre
+        gaze_monitor.poll()
+        if gaze_monitor.dwell(since)['dwell'] > minimum_duration:
+            break
+        core.wait(.001, hogCPUperiod=0) # yield the CPU until the next samples arrive
+
+    stats = gaze_monitor.dwell(since)
+    stats['wait'] = core.getTime() - trigger_start_time
+    return should_recali, stats
 
 
 ####################################################
@@ -531,11 +379,10 @@ def checkGazeOnFix():
 ####################################################
 
 # Generate main stimuli
-grid = generateStimCoordinates(gridcol=12, gridrow=10, jitter=linejitter_arr)
-stimset = generateStim(linelength=35,linewidth=2, coord_array=grid, colour='white',catch_colour='red',
+stimset = generateStim(linelength=35,linewidth=2, gridcol=12, gridrow=10, jitter=linejitter_arr, colour='white',catch_colour='red',
                         size=276, fixdistance=134)
 
-quad_loc_trials, quad_timings = generateQuadLocalizerTrials(quad_reps=n_quadreps,asynchronous=True,isi= .52,jitter=.070) 
+quad_loc_trials, quad_timings = generateQuadLocalizerTrials(quad_reps=n_quadreps,asynchronous=True,isi= .52,jitter=.070,rng=rng) 
 
 # Intermediate message    
 cross.autoDraw = False
@@ -567,21 +414,16 @@ if eye_tracking:
         # The 1,1,1,1 just has to do with whether samples and events etcetera needs to be written to EDF file. Recording needs to be started for each block
         pylink.pumpDelay(100) #wait for 100 ms to cache some samples
 
-for i in range(n_trials):
-    win.flip()
+def beforeTrial():
     if eye_tracking:
         # Check if gaze is on fixation and if not start recallibration
-        should_recal = checkGazeOnFix()
+        should_recal, fix_stats = checkGazeOnFix()
         if should_recal == 'yes':
             cross.autoDraw = False
             message.text = 'Please press ENTER twice to recalibrate the tracker'
             message.draw()
             win.flip()
-            try:
-                el_tracker.doTrackerSetup()
-            except RuntimeError as err:
-                print('ERROR:', err)
-                el_tracker.exitCalibration()
+            trackerSetup()
             should_recal = 'no'
             el_tracker.setOfflineMode() #this is called before start_recording() to make sure the eye tracker has enough time to switch modes (to start recording)
             pylink.pumpDelay(100)
@@ -591,19 +433,29 @@ for i in range(n_trials):
             pylink.pumpDelay(100) #wait for 100 ms to cache some samples
             cross.autoDraw =True
     event.clearEvents(eventType = 'keyboard')
-    fieldLocalizer(quad_loc_trials[i],stimset,.1,quad_timings[i])
+
+def afterTrial():
     # Exit
     keys = event.getKeys()
     if 'escape' in keys:
         if eye_tracking:
             terminate_task()
-        break
+        return True
+    return False
+
+# The trial loop is runLocalizerTrials() in predatt_tools.py (also run by headless_run.py)
+runLocalizerTrials(win, lambda trigger: eegTriggerSend(trigger, lab), quad_loc_trials[:n_trials], quad_timings[:n_trials],
+                   .1, core.wait, core.monotonicClock.getTime, draw_stim=lambda field: drawStim(stimset, field, 0),
+                   on_onset=onsetDiagnostics, before_trial=beforeTrial, after_trial=afterTrial)
 # End eye_tracker recording
 if eye_tracking:
     el_tracker.stopRecording() #this is typically done for each bloc
     
 # End EEG recording
 eegTriggerSend(int(201),lab=lab) # 200 is the end-recording command in the biosemi config file
+eeg_triggers.close()
+if trigger_diagnostics:
+    print(writeTriggerLatencies(os.getcwd() + '/data/' + f'c1_localizer_{sub}_trigger_latency.csv', trigger_latencies))
 
 # Intermediate message 
 cross.autoDraw = False
@@ -614,6 +466,8 @@ start_key = event.waitKeys(keyList = ['space','escape'])
 
 # Disconnect then terminate the task
 if eye_tracking:
+    print(writeCalibrationTimes(os.getcwd() + '/data/' + f'c1_localizer_{sub}_calibration.csv',
+                                calibration_times, blocking_beeps=calibration_blocking_beeps))
     terminate_task()
 
 # Close the window
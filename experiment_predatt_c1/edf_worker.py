@@ -0,0 +1,216 @@
+"""
+EDF download and conversion after an eye-tracking session
+EdfTransfer downloads the EDF from the Host PC on a background thread (so terminate_task() returns right away)
+and then starts a separate process that converts it, so the next session can be started in the meantime
+
+The conversion uses edf2asc (EyeLink Developers Kit) and writes the samples, fixations, saccades, blinks,
+messages and trials (TRIALID ... TRIAL_END) as columns of one .npz file next to the EDF:
+
+    python edf_worker.py data/pp_001_2026_10_18_10_00/pp_001_2026_10_18_10_00.EDF
+
+Load it with loadGazeData(), the trial numbers match the 'trial' column of the trial log
+"""
+
+import os
+import sys
+import time
+import shutil
+import threading
+import subprocess
+import numpy as np
+
+
+####################################################
+#Transfer
+####################################################
+
+class EdfTransfer(threading.Thread):
+    """
+    Downloads edf_file from the Host PC to local_edf and closes the link afterwards
+    Progress (MB received) is printed every report_interval seconds
+    When convert is True the conversion is started in its own process once the file is complete
+    The thread is not a daemon, so core.quit() waits for the download to finish
+    """
+    def __init__(self, tracker, edf_file, local_edf, convert=True, report_interval=1.):
+        super().__init__(name='edf_transfer')
+        self.tracker = tracker
+        self.edf_file = edf_file
+        self.local_edf = local_edf
+        self.convert = convert
+        self.report_interval = report_interval
+        self.error = None
+        self.converter = None   # subprocess.Popen of the conversion
+
+    def run(self):
+        done = threading.Event()
+        reporter = threading.Thread(target=self._report, args=(done,), daemon=True)
+        reporter.start()
+        try:
+            # parameters: source_file_on_the_host, destination_file_on_local_drive
+            self.tracker.receiveDataFile(self.edf_file, self.local_edf)
+        except RuntimeError as error:
+            self.error = error
+            print('ERROR:', error)
+        done.set()
+        reporter.join()
+        # Close the link to the tracker
+        self.tracker.close()
+        if self.error is None and self.convert and os.path.isfile(self.local_edf):
+            self.converter = startConversion(self.local_edf)
+
+    def progress(self):
+        """
+        Size of the local EDF so far (MB)
+        """
+        if not os.path.isfile(self.local_edf):
+            return 0.
+        return os.path.getsize(self.local_edf) / 1e6
+
+    def _report(self, done):
+        t0 = time.time()
+        while not done.wait(self.report_interval):
+            print('EDF transfer: %.1f MB (%.0f s)' % (self.progress(), time.time() - t0))
+        print('EDF transfer finished: %.1f MB in %.1f s' % (self.progress(), time.time() - t0))
+
+
+def startConversion(edf_path):
+    """
+    Convert an EDF in a separate process that keeps running after the experiment closes
+    """
+    kwargs = {}
+    if sys.platform == 'win32':
+        kwargs['creationflags'] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), edf_path], **kwargs)
+
+
+####################################################
+#Conversion
+####################################################
+
+FIX_DTYPE = [('eye','U1'), ('start','f8'), ('end','f8'), ('duration','f8'), ('x','f8'), ('y','f8'), ('pupil','f8')]
+SACC_DTYPE = [('eye','U1'), ('start','f8'), ('end','f8'), ('duration','f8'), ('x_start','f8'), ('y_start','f8'),
+              ('x_end','f8'), ('y_end','f8'), ('amplitude','f8'), ('peak_velocity','f8')]
+BLINK_DTYPE = [('eye','U1'), ('start','f8'), ('end','f8'), ('duration','f8')]
+MSG_DTYPE = [('time','f8'), ('text','U200')]
+TRIAL_DTYPE = [('trial','i4'), ('start','f8'), ('end','f8')]
+
+
+def edfToAsc(edf_path, edf2asc='edf2asc'):
+    """
+    Run edf2asc on an EDF and return the path of the ASC file
+    """
+    if shutil.which(edf2asc) is None:
+        raise FileNotFoundError('%s not found, install the EyeLink Developers Kit' % edf2asc)
+    # -y overwrites an existing ASC, -t uses tabs only
+    subprocess.run([edf2asc, '-y', '-t', edf_path], check=True, stdout=subprocess.DEVNULL)
+
+    return os.path.splitext(edf_path)[0] + '.asc'
+
+
+def _number(value):
+    try:
+        return float(value)
+    except ValueError:   # '.' for missing data
+        return np.nan
+
+
+def parseAsc(asc_path):
+    """
+    Parse an ASC file into structured arrays: samples (time, x, y, pupil), fixations, saccades,
+    blinks, messages and trials, times are tracker time stamps (ms)
+    Binocular samples keep the left eye
+    """
+    sample_lines = []
+    fixations, saccades, blinks, messages = [], [], [], []
+    with open(asc_path) as f:
+        for line in f:
+            if not line or not line[0].isalnum():
+                continue
+            if line[0].isdigit():
+                sample_lines.append(line)
+                continue
+            parts = line.split()
+            kind = parts[0]
+            if kind == 'EFIX':
+                fixations.append((parts[1],) + tuple(_number(v) for v in parts[2:8]))
+            elif kind == 'ESACC':
+                saccades.append((parts[1],) + tuple(_number(v) for v in parts[2:11]))
+            elif kind == 'EBLINK':
+                blinks.append((parts[1],) + tuple(_number(v) for v in parts[2:5]))
+            elif kind == 'MSG':
+                time_stamp, text = (line.split(None, 2)[1:] + [''])[:2]
+                messages.append((_number(time_stamp), text.strip()))
+
+    # Samples: time, x, y, pupil (left eye for binocular recordings)
+    samples = np.zeros(len(sample_lines), dtype=[('time','f8'), ('x','f8'), ('y','f8'), ('pupil','f8')])
+    if sample_lines:
+        columns = [line.split('\t', 4)[:4] for line in sample_lines]
+        values = np.array([[_number(v) for v in row] for row in columns])
+        for i, name in enumerate(samples.dtype.names):
+            samples[name] = values[:,i]
+
+    messages = np.array(messages, dtype=MSG_DTYPE)
+    # Trials are the TRIALID n ... TRIAL_END messages of the experiment
+    trials = []
+    for time_stamp, text in messages:
+        if text.startswith('TRIALID'):
+            trials.append([int(text.split()[1]), time_stamp, np.nan])
+        elif text.startswith('TRIAL_END') and trials:
+            trials[-1][2] = time_stamp
+
+    return {'samples': samples,
+            'fixations': np.array(fixations, dtype=FIX_DTYPE),
+            'saccades': np.array(saccades, dtype=SACC_DTYPE),
+            'blinks': np.array(blinks, dtype=BLINK_DTYPE),
+            'messages': messages,
+            'trials': np.array([tuple(trial) for trial in trials], dtype=TRIAL_DTYPE)}
+
+
+def saveGazeData(path, tables):
+    """
+    Save the tables of parseAsc() column by column ('<table>/<column>') in one .npz file
+    """
+    columns = {}
+    for table, data in tables.items():
+        for name in data.dtype.names:
+            columns[table + '/' + name] = data[name]
+    np.savez(path, **columns)
+
+
+def loadGazeData(path):
+    """
+    Load a file written by saveGazeData() back into a dict of structured arrays
+    """
+    tables = {}
+    with np.load(path) as npz:
+        for key in npz.files:
+            table, name = key.split('/', 1)
+            tables.setdefault(table, {})[name] = npz[key]
+    for table, columns in tables.items():
+        n = len(next(iter(columns.values())))
+        data = np.zeros(n, dtype=[(name, column.dtype) for name, column in columns.items()])
+        for name, column in columns.items():
+            data[name] = column
+        tables[table] = data
+
+    return tables
+
+
+def convertEdf(edf_path, out_path=None):
+    """
+    EDF -> ASC -> <edf name>_gaze.npz, returns the path of the npz file
+    """
+    out_path = out_path or os.path.splitext(edf_path)[0] + '_gaze.npz'
+    asc_path = edfToAsc(edf_path)
+    saveGazeData(out_path, parseAsc(asc_path))
+
+    return out_path
+
+
+if __name__ == '__main__':
+    for edf_path in sys.argv[1:]:
+        t0 = time.time()
+        print('converted', convertEdf(edf_path), 'in %.1f s' % (time.time() - t0))
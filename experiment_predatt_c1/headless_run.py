@@ -0,0 +1,252 @@
+"""
+Headless version of predatt_exp_psychopy.py and c1_localizer.py
+Runs the session design, the trial procedures of the scripts (presentTrial() and runLocalizerTrials()),
+trigger and logging code with a virtual clock, a fake window and a synthetic participant instead of psychopy,
+the lab hardware and the eye tracker
+Used to benchmark trial generation and logging and to check the hit/miss scoring offline
+
+    python headless_run.py --participant 1 --out sim_data
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+from predatt_tools import (buildSessionDesign, validateSessionDesign, scheduleSessionDesign, sessionCounterbalance,
+                           generateQuadLocalizerTrials, scoreTrial, FakePort, TriggerDispatcher,
+                           TRIAL_FIELDS, TrialWriter, expandTrialLog, presentTrial, runLocalizerTrials)
+
+
+####################################################
+#Options (same as the experiment scripts)
+####################################################
+
+n_trials = 28 # per block
+n_odd = 7  # per block
+n_catch = 13 # per section
+n_blocks = 15  # per section
+n_sections = 2
+isi_duration = .52
+stim_onset_jitter = .07
+iti_duration = .5
+stim_duration = .1
+frame_rate = 60.0
+counter_dict = {0:2,1:3,2:0,3:1} # counter balance start quad
+n_quadreps = 6 # per quad in the localizer
+
+
+####################################################
+#Fake hardware
+####################################################
+
+class VirtualClock:
+    """
+    Clock that only moves when it is told to, stands in for core.monotonicClock and core.wait
+    A wait stops at every due time of the attached trigger dispatchers, so their pulses are set and reset
+    at the virtual times they would have in the lab
+    """
+    def __init__(self):
+        self.t = 0.
+        self._dispatchers = []
+
+    def getTime(self):
+        return self.t
+
+    def attach(self, dispatcher):
+        self._dispatchers.append(dispatcher)
+        return dispatcher
+
+    def wait(self, secs):
+        end = self.t + max(secs, 0.)
+        while True:
+            dues = [due for due in (dispatcher.poll() for dispatcher in self._dispatchers)
+                    if due is not None and due <= end]
+            if not dues:
+                break
+            self.t = min(dues)
+        self.t = end
+        for dispatcher in self._dispatchers:
+            dispatcher.poll()
+
+
+class FakeWindow:
+    """
+    Stands in for visual.Window, every flip advances the clock by one frame
+    Functions passed to callOnFlip run right after the swap like in psychopy
+    """
+    def __init__(self, clock, frame_rate=60.):
+        self.clock = clock
+        self.frame_rate = frame_rate
+        self.n_flips = 0
+        self._on_flip = []
+
+    def getActualFrameRate(self):
+        return self.frame_rate
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._on_flip.append((function, args, kwargs))
+
+    def flip(self):
+        self.clock.wait(1. / self.frame_rate)
+        self.n_flips += 1
+        flip_time = self.clock.getTime()
+        on_flip, self._on_flip = self._on_flip, []
+        for function, args, kwargs in on_flip:
+            function(*args, **kwargs)
+        return flip_time
+
+
+class SyntheticParticipant:
+    """
+    Presses a key after a catch stimulus with a normal RT distribution (s), misses it with miss_rate
+    and presses on trials without a catch with false_alarm_rate
+    Also returns the outcome the key press should be scored as
+    """
+    def __init__(self, rt_mean=.35, rt_sd=.08, miss_rate=.1, false_alarm_rate=.02, max_rt=.5, rng=None):
+        self.rt_mean = rt_mean
+        self.rt_sd = rt_sd
+        self.miss_rate = miss_rate
+        self.false_alarm_rate = false_alarm_rate
+        self.max_rt = max_rt
+        self.rng = np.random.default_rng(rng)
+
+    def respond(self, catch, stim_onsets, trial_dur):
+        """
+        Returns the key press time (s relative to the first flip of the trial, None for no press)
+        and the true outcome of the trial
+        """
+        if catch > 0:
+            if self.rng.random() < self.miss_rate:
+                return None, 'miss'
+            rt = max(self.rng.normal(self.rt_mean, self.rt_sd), .1)
+            return stim_onsets[catch-1] + rt, 'hit' if rt < self.max_rt else 'late'
+        if self.rng.random() < self.false_alarm_rate:
+            return self.rng.uniform(0, trial_dur), 'false_alarm'
+        return None, 'correct_rejection'
+
+
+####################################################
+#Sessions
+####################################################
+
+def virtualTriggers(clock):
+    """
+    TriggerDispatcher on a FakePort that runs on the virtual clock (no worker thread)
+    """
+    return clock.attach(TriggerDispatcher(FakePort(clock=clock.getTime, verbose=False), clock=clock.getTime,
+                                          wait=clock.wait))
+
+
+def runSession(participant_id, out_folder, participant=None, rng=None):
+    """
+    Run a full main experiment session (n_sections x n_blocks x n_trials)
+    Writes the trial log and the trigger log to out_folder and returns a summary dict
+    with the number of trials where scoreTrial() disagrees with the synthetic participant
+    """
+    rng = np.random.default_rng(rng)
+    participant = participant or SyntheticParticipant(rng=rng)
+    clock = VirtualClock()
+    win = FakeWindow(clock, frame_rate)
+    triggers = virtualTriggers(clock)
+    timings = {}
+
+    t0 = time.perf_counter()
+    subject_odd, subject_section_order, attention_cond = sessionCounterbalance(participant_id)
+    localised_quad = counter_dict[int(participant_id) % 4]
+    design = buildSessionDesign(n_sections=n_sections, n_blocks=n_blocks, n_trials=n_trials, n_odd=n_odd, n_catch=n_catch,
+                                isi_dur=isi_duration, jitter=stim_onset_jitter, localised_quad=localised_quad,
+                                subject_odd=subject_odd, section_order=subject_section_order,
+                                attention_cond=attention_cond, rng=rng)
+    validateSessionDesign(design, n_odd=n_odd, n_catch=n_catch, isi_dur=isi_duration, jitter=stim_onset_jitter)
+    stim_frames = scheduleSessionDesign(design, stim_dur=stim_duration, frame_rate=win.getActualFrameRate())
+    timings['design_s'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    file_name = os.path.join(out_folder, 'predatt_participant_' + str(participant_id))
+    trial_log = TrialWriter(file_name + '_stream.csv', TRIAL_FIELDS,
+                            header={'lab': 'headless', 'participant': participant_id, 'subject_odd': subject_odd})
+    counts = {'hit': 0, 'late': 0, 'miss': 0, 'false_alarm': 0, 'correct_rejection': 0}
+    mismatches = 0
+    triggers.send(200)
+    for trial_count, this_trial in enumerate(design, start=1):
+        stim_times, trial_time, trial_start = presentTrial(win, triggers.send, stim_frames, this_trial['isi_frames'],
+                                                           iti_duration, this_trial['start_quad'], this_trial['direction'],
+                                                           clock.wait, clock.getTime)
+        stim_times = np.asarray(stim_times) / 1000
+        press, truth = participant.respond(this_trial['catch'], stim_times, trial_time / 1000)
+        outcome = scoreTrial(this_trial['catch'], press, stim_times)
+        counts[outcome] += 1
+        mismatches += outcome != truth
+
+        rec = trial_log.record()
+        rec['LocalTime_DDMMYY_HMS'] = time.strftime('%d/%m/%Y_%H:%M:%S')
+        rec['trial'] = trial_count
+        rec['start_position'] = this_trial['start_quad']
+        rec['trial_direction'] = this_trial['direction']
+        rec['catch_trial'] = this_trial['catch']
+        rec['t_stim_1'], rec['t_stim_2'], rec['t_stim_3'], rec['t_stim_4'] = stim_times * 1000
+        rec['t_stim_1_planned'], rec['t_stim_2_planned'], rec['t_stim_3_planned'], rec['t_stim_4_planned'] = this_trial['planned_onsets'] * 1000
+        rec['frame_rate'] = frame_rate
+        rec['experiment_time_s'] = clock.getTime()
+        if press is not None:
+            rec['key_pressed'] = 'space'
+            rec['press_time'] = press * 1000
+        else:
+            rec['press_time'] = np.nan
+        rec['t_trial'] = trial_time
+        rec['block'] = this_trial['block'] + 1
+        rec['attention'] = this_trial['attention']
+        rec['expected'] = this_trial['expected']
+        trial_log.commit()
+        if this_trial['trial'] == n_trials - 1:
+            trial_log.flush()
+    triggers.send(201)
+    triggers.close() # lets the last pulses run out on the virtual clock
+    trial_log.close()
+    expandTrialLog(file_name + '_stream.csv', file_name + '.csv')
+    triggers.saveLog(file_name + '_triggers.csv')
+    timings['run_s'] = time.perf_counter() - t0
+
+    return {'trials': len(design), 'flips': win.n_flips, 'triggers': len(triggers.log),
+            'virtual_duration_s': clock.getTime(), 'scoring_mismatches': int(mismatches), **counts, **timings}
+
+
+def runLocalizer(participant_id, out_folder, rng=None):
+    """
+    Run the quadrant localizer of c1_localizer.py and write its trigger log to out_folder
+    """
+    rng = np.random.default_rng(rng)
+    clock = VirtualClock()
+    win = FakeWindow(clock, frame_rate)
+    triggers = virtualTriggers(clock)
+
+    t0 = time.perf_counter()
+    quad_loc_trials, quad_timings = generateQuadLocalizerTrials(quad_reps=n_quadreps, asynchronous=True, isi=.52, jitter=.070, rng=rng)
+    triggers.send(200)
+    triggers.send(99)
+    runLocalizerTrials(win, triggers.send, quad_loc_trials, quad_timings, stim_duration, clock.wait, clock.getTime)
+    triggers.send(201)
+    triggers.close()
+    triggers.saveLog(os.path.join(out_folder, f'c1_localizer_{participant_id}_triggers.csv'))
+
+    return {'trials': len(quad_loc_trials), 'triggers': len(triggers.log),
+            'virtual_duration_s': float(clock.getTime()), 'run_s': time.perf_counter() - t0}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the predatt experiment and C1 localizer without a window or lab hardware')
+    parser.add_argument('--participant', default='1', help='participant id, sets the counterbalancing')
+    parser.add_argument('--out', default='sim_data', help='folder for the simulated data files')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--rt-mean', type=float, default=.35)
+    parser.add_argument('--rt-sd', type=float, default=.08)
+    parser.add_argument('--miss-rate', type=float, default=.1)
+    parser.add_argument('--false-alarm-rate', type=float, default=.02)
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+    participant = SyntheticParticipant(rt_mean=args.rt_mean, rt_sd=args.rt_sd, miss_rate=args.miss_rate,
+                                       false_alarm_rate=args.false_alarm_rate, rng=rng)
+    print('localizer', runLocalizer(args.participant, args.out, rng=rng))
+    print('session', runSession(args.participant, args.out, participant=participant, rng=rng))
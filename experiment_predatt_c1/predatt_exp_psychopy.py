@@ -5,14 +5,14 @@ Created on Tue Oct 24 2023
 import numpy as np
 import os
 import time
-import sys
 import pylink #the last is to communicate with the eyetracker
 import pickle
-from psychopy import parallel, visual, gui, data, event, core, monitors
+from psychopy import parallel, visual, gui, event, core, monitors
 from psychopy.visual import ShapeStim
 from psychopy import logging
-from math import fabs
 from EyeLinkCoreGraphicsPsychoPy import EyeLinkCoreGraphicsPsychoPy #this are functions used to run the eyetracker calibration and validation
+from edf_worker import EdfTransfer #downloads and converts the EDF in the background
+from predatt_tools import cachedStimPositions, buildSessionDesign, validateSessionDesign, scheduleSessionDesign, sessionCounterbalance, scoreTrial, FakePort, TriggerDispatcher, writeTriggerLatencies, writeCalibrationTimes, GazeMonitor, TRIAL_FIELDS, TrialWriter, expandTrialLog, presentTrial #helpers that do not need a window
 
 
 ####################################################
@@ -35,8 +35,9 @@ n_catch = 13 # per section
 n_blocks = 15  # per section        
 n_sections = 2 # divides experiment into attended vs unattended sections 
 
-#to check problem
-trigger_time_list = []
+trigger_pulse_width = .01 # seconds a trigger code stays on the port
+trigger_diagnostics = False # True/False keeps the flip-to-trigger delay of every stimulus trigger
+calibration_blocking_beeps = False # True waits for every calibration beep like before (slower), to compare calibration durations
 
 isi_duration = .52
 stim_onset_jitter = .07
@@ -60,7 +61,7 @@ while already_exists:   #keep asking for a new name when the data file already e
      if not dlg.OK:
          core.quit()
 
-     if not os.path.isfile((file_name + '.csv')):  #only escape the while loop if ParticipantNr is unique
+     if not os.path.isfile((file_name + '.csv')) and not os.path.isfile((file_name + '_stream.csv')):  #only escape the while loop if ParticipantNr is unique
          already_exists = False
      else:
          dlg2 = gui.Dlg(title = 'Warning')  #if the suggested_participant_nr is not unique, present a warning msg
@@ -95,6 +96,21 @@ session_folder = os.path.join(os.getcwd() + '/data/', session_identifier)
 if not os.path.exists(session_folder):
     os.makedirs(session_folder)
 
+####################################################
+#Session design
+####################################################
+
+# Counterbalancing on subject number (odd direction and attention section order)
+subject_odd, subject_section_order, attention_cond = sessionCounterbalance(info['Participant ID (***)'])
+
+# Every trial of the session (start quadrant, direction, catch, timings, ...) as one structured array
+# trial i of the session is design[i], the file in the session folder can be checked offline
+design = buildSessionDesign(n_sections=n_sections, n_blocks=n_blocks, n_trials=n_trials, n_odd=n_odd, n_catch=n_catch,
+                            isi_dur=isi_duration, jitter=stim_onset_jitter, localised_quad=localised_quad,
+                            subject_odd=subject_odd, section_order=subject_section_order,
+                            attention_cond=attention_cond, rng=rng)
+validateSessionDesign(design, n_odd=n_odd, n_catch=n_catch, isi_dur=isi_duration, jitter=stim_onset_jitter)
+
 # Define a monitor
 system_monitor = monitors.Monitor('cap_lab_monitor')   
 # # This is to set a new configuration for your monitor
@@ -106,6 +122,13 @@ system_monitor = monitors.Monitor('cap_lab_monitor')
 # #initialize window#
 win = visual.Window(fullscr=True,color= (-1, -1, -1), colorSpace = 'rgb', units = 'pix', monitor= system_monitor)
 win.mouseVisible = False
+# Measured refresh rate, all stimulus timings are converted to flip counts with this
+frame_rate = win.getActualFrameRate()
+if frame_rate is None:
+    frame_rate = 60.0
+# Flip counts of every trial, after this the design is complete
+stim_frames = scheduleSessionDesign(design, stim_dur=stim_duration, frame_rate=frame_rate)
+np.save(os.path.join(session_folder, session_identifier + '_design.npy'), design)
 
 
 ####################################################
@@ -158,92 +181,23 @@ teststim = ShapeStim(win, vertices=[(0.5,1.0), (1.0,1.0), (0.5,1.0), (1.0,1.0)],
 #Functions for generating the stimulus
 ####################################################
 
-def generateStimCoordinates(gridcol, gridrow, jitter):
-    """
-    Generates coordinates used to draw the stimulus lines
-    """
-    # Calculate spacing of grid
-    x_spacing = 1.0 / (gridcol)
-    y_spacing = 1.0 / (gridrow)
-
-    # Create an array to store coordinates: every point (x,y) of the grid for every quadrant (4) 
-    coord_array = np.empty(shape = (gridcol,gridrow,2,4),dtype= 'object')
-    quadrant_set = [[-1,1],[1,1],[1,-1],[-1,-1]]
-
-    # Generate grid coord per quadrant
-    for i,quad in enumerate(quadrant_set):
-        # Per row
-        for row in range(gridrow):
-            # Per column
-            for col in range (gridcol):
-
-                grid_x = col * x_spacing  # grid points
-                grid_y = row * y_spacing  
-
-                grid_x = grid_x * quad[0]   # quadrant position
-                grid_y = grid_y * quad[1]   # quadrant position
-
-                coord_array[col,row,0,i] = grid_x  # Store them in big ass array
-                coord_array[col,row,1,i] = grid_y
-
-    # flip the matrices so that they have the 'orientation' corresponding to the quadrant 
-    coord_array[:,:,0,0] = np.flip(coord_array[:,:,0,0], axis=0) 
-    coord_array[:,:,1,0] = np.flip(coord_array[:,:,1,0], axis=0) 
-
-    coord_array[:,:,0,2] = np.flip(coord_array[:,:,0,2], axis=1) 
-    coord_array[:,:,1,2] = np.flip(coord_array[:,:,1,2], axis=1) 
-
-    coord_array[:,:,0,3] = np.flip(coord_array[:,:,0,3], axis=(0,1)) 
-    coord_array[:,:,1,3] = np.flip(coord_array[:,:,1,3], axis=(0,1)) 
-
-    #  Add jitter
-    for i in range(4):
-        coord_array[:,:,:,i] =  coord_array[:,:,:,i] + jitter[:gridcol,:gridrow,:]
-  
-    return coord_array
-
-
-
-def generateStim(linelength, linewidth ,coord_array, colour, catch_colour, size, fixdistance, localizer = False ):
+def generateStim(linelength, linewidth, gridcol, gridrow, jitter, colour, catch_colour, size, fixdistance, localizer = False ):
     """ 
     Generate an ElementArrayStim object consisting of lines on the coordinates for stimulus for each quadrant
     Then four more arrays are created each representing a catch trial in a separate quadrant
-    Returns a 5x4 array of lists with each list containing the line stimuli for a quadrant
+    Returns a 2x4 array with each element containing the line stimuli for a quadrant
     If localizer is set to True then it generates a grid in the upper or lower visual field instead of quadrants
     """
-    # This 
-    if localizer:
-        sections = 2
-        dist = fixdistance
-        quads = [[0,1],[0,-1]]
-    else:
-        sections = 4
-        # This is to calculate the distance to the fixation cross
-        dist = np.sqrt(np.square(fixdistance)/2) #pythagoras
-        quads = [[-1,1],[1,1],[1,-1],[-1,-1]]
-
-    # Get size of grid
-    gridcol = np.shape(coord_array)[0]
-    gridrow = np.shape(coord_array)[1]
+    # Positions of every line for every quadrant (or field), computed once and cached
+    all_xys = cachedStimPositions(gridcol, gridrow, jitter, size, fixdistance, localizer=localizer)
+    sections, n_lines = np.shape(all_xys)[:2]
 
     # Init arrays to store line objects per quadrant and also for every possible catch trial 
     line_stimuli = np.empty((2,sections), dtype=object)   # 2 types (0 is normal white lines, 1 is catch stim ) and 4 quadrants
+    sizes = np.atleast_2d([linelength,linewidth]).repeat(repeats=n_lines, axis=0)
  
     for quad in range(sections):
-        n_lines = gridcol*gridrow
-        xys = np.empty((n_lines,2)) #coordinates to pass to elementArrayStim
-        it_count = 0 # idk man... this is a work around because im too lazy to completely change the structure that I used before i.e. two nested loops per column (below)
-        for row in range(gridrow):
-            for col in range(gridcol):
-
-                # Define stim coordinates
-                the_x = (coord_array[col,row,0,quad] * size) + (quads[quad][0]*dist)  # size and distance from fixation are all in here 
-                the_y = (coord_array[col,row,1,quad] * size) + (quads[quad][1]*dist)              
-                                                                              
-                xys[it_count,0] = the_x
-                xys[it_count,1] = the_y
-                it_count += 1
-        sizes = np.atleast_2d([linelength,linewidth]).repeat(repeats=n_lines, axis=0)
+        xys = all_xys[quad]
         # Normal stimuli
         line_stimuli[0,quad] = visual.ElementArrayStim(win, units='pix',elementTex=None, elementMask='sqr', xys= xys,
                                            nElements=n_lines, sizes=sizes, colors=(1.0, 1.0, 1.0), colorSpace='rgb')
@@ -275,51 +229,35 @@ def drawStim(line_stimuli, quad, catch, task):
     line_stim.draw()
 
 
-def stimPresentation(stimulus, stim_dur, isi_dur,iti_dur, start_quad, direction, q_catch, task, lab=lab): 
+def stimPresentation(stimulus, stim_frames, isi_frames, planned_onsets, iti_dur, start_quad, direction, q_catch, task, lab=lab): 
     """
     Stimulus presentation for regular (clockwise) and odd (anticlockwise) trials
+    The flips, waits and triggers are presentTrial() in predatt_tools.py (also run by headless_run.py)
+    Returns the achieved and planned stimulus onsets (ms relative to the first flip of the trial),
+    the trial duration (ms) and the time stamp of the first flip
     """
-    # Check timing
-    stim_clock = core.Clock()
-    trial_clock = core.Clock()
-    stim_times = []
-
-    stimpos_ls = np.roll(np.arange(4), -start_quad, axis=0)   # select the starting point of the stimulus
-
-    # This is to select the presentation direction
-    dir_list = np.arange(4)
-    if direction == 0:
-        stimpos_ls = np.roll(dir_list, -start_quad, axis=0)   # select the starting point of the stimulus
-    elif direction == 1:
-        stimpos_ls = np.roll(dir_list[::-1], 1+start_quad, axis=0)   # select the starting point of the stimulus and reverse direction
-    
     # This is for the catch trials
     catch_ls = np.zeros(4,dtype=int) 
     if not q_catch == 0:
         catch_ls[q_catch-1] = 1   # We do q_catch-1 because the catch trial list gives a value of 0 to 5 with 0 being no catch 
 
+    def onOnset(trigger, stim_onset):
+        if trigger_diagnostics:
+            trigger_latencies.append([trigger, stim_onset, eeg_triggers.log[-1][2]])
 
-    # Send trial start trigger
-    eegTriggerSend(int(99),lab)
-    # Trial procedure
-    for i,stimpos in enumerate(stimpos_ls):
-        win.flip()
-        stim_clock.reset()
-        trigger = int(selectEEGStimulusTrigger(stimpos,pos=i)) # EEG trigger generation
-        drawStim(stimulus,stimpos,catch_ls[i],task=task)
-        wait = isi_dur[i]-stim_clock.getTime()      # Drawing the stimulus takes time, this compensates that
-        core.wait(wait)
-        stim_timing =trial_clock.getTime() * 1000
-        win.flip()
-        eegTriggerSend(trigger,lab)  # Send trigger
-        core.wait(stim_dur)
+    def clearStim(i):
         cross.color = cross_standard_col
-        win.flip()
-        stim_times.append(stim_timing)
 
-    trial_time = trial_clock.getTime()*1000
-    core.wait(iti_dur)
-    return stim_times, trial_time
+    def afterStim(i):
+        if eye_tracking:
+            gaze_monitor.poll() # keep the link queue drained, fixation breaks are counted after the trial
+
+    stim_times, trial_time, trial_start = presentTrial(win, lambda trigger: eegTriggerSend(trigger, lab), stim_frames,
+                                                       isi_frames, iti_dur, start_quad, direction, core.wait,
+                                                       core.monotonicClock.getTime,
+                                                       draw_stim=lambda stimpos, i: drawStim(stimulus,stimpos,catch_ls[i],task=task),
+                                                       clear_stim=clearStim, on_onset=onOnset, after_stim=afterStim)
+    return stim_times, np.asarray(planned_onsets) * 1000, trial_time, trial_start
 
 
 def displayMessage(msg= None, block_msg = False, lang= 0, block_num = None, hits = None, misses = None, wrong = None):
@@ -343,119 +281,22 @@ def displayMessage(msg= None, block_msg = False, lang= 0, block_num = None, hits
 
     start_key = event.waitKeys(keyList = ['space','escape'])
     if start_key == 'escape':
-        if eye_tracking:
-            terminate_task()
-        core.quit() #no event.clearEvents() necessary
-        win.close()
+        shutdown() #no event.clearEvents() necessary
     event.clearEvents()
 
     
-####################################################
-#Trial sequence functions
-####################################################
-
-def generatePredictionList(tr_block, n_odd):
-    """ 
-    Generate pseudo randomized properties of every trial (start quadrant and regular or odd trials)
-    """
-    if n_odd > tr_block/2:
-        raise ValueError("Invalid input parameters")
-    prediction_arr = np.zeros(tr_block , dtype=int)
-    # Set alternating 1's and 0's
-    prediction_arr[:n_odd * 2:2] = 1
-    # Shuffle the array to randomize the positions of 0's
-    np.random.shuffle(prediction_arr)
-    # Ensure no consecutive 1's
-    while any(prediction_arr[i-2] == 1 and (prediction_arr[i-1] == 1 or prediction_arr[i] == 1) for i in range(tr_block-1)):
-        np.random.shuffle(prediction_arr)
-    
-
-    return prediction_arr
-
-
-def generateBlockStarts(n_blocks,uniq_quadrant,sub_odd):
-    """
-    Generate a list with the start position for each block depending on the localised quadrant
-    """
-    # Roll depending on odd direction
-    if sub_odd == 'anticlockwise':
-        quad_li = np.roll(np.arange(4),-1)
-    elif sub_odd == 'clockwise':
-        quad_li = np.roll(np.arange(4),1)
-    # You have the main quad and the diagonal
-    start_quad = quad_li[uniq_quadrant]
-    diagon_quad = quad_li[(uniq_quadrant +2)%4]
-    # Create the arrays
-    half_blocks = int(np.ceil(n_blocks/2))
-    prime_quad_arr = np.full(half_blocks,start_quad)
-    diagon_quad_arr = np.full(half_blocks,diagon_quad)
-    
-    section_blocks = np.concatenate((prime_quad_arr,diagon_quad_arr))
-    block_list =  section_blocks[:n_blocks]
-    
-    return block_list
-    
-
-def generateCatchTrials(tr_block, ncatch):
-    """ 
-    Some trials are catch trials, this function generates a list to designate which trials are
-    """
-    # Make a list with normal trials (0) and a list with catch trials (1)
-    full_list = np.zeros(tr_block-ncatch,dtype=int)
-    c_list = np.ones(ncatch*4,dtype=int) # make a longer list and cut it short otherwise it won't work with ncatch <4
-    for i,one in enumerate(c_list):
-        c_list[i] = int(one + i%4)   # Just adding 0,1,2 or 3 to every element (again: if ncatch is divisible by 4 then it's balanced)
-    # Make correct length
-    np.random.shuffle(c_list)
-    c_list = c_list[:ncatch]
-
-    # Make one list
-    full_list = np.append(full_list,c_list)
-    # Shuffle
-    np.random.shuffle(full_list)
-
-    return full_list
-
-
-def generateTrialTimings(tr_block,isi_dur, jitter,randng=rng):
-    """ 
-    Generate a list of timings 4 per trial
-    """
-    block_tlist= []
-    for i in range(tr_block):
-        trial_tlist = []
-        for p in range(4):
-            stim_t = isi_dur + randng.uniform(low =-jitter,high=jitter)
-            trial_tlist.append(stim_t)
-        block_tlist.append(trial_tlist)
-    return block_tlist
-
-
 ####################################################
 #External measurement instruments
 ####################################################
 
 #EEGTriggerSend#
-def eegTriggerSend(eeg_trigger, lab): #need to elaborate
+def eegTriggerSend(eeg_trigger, lab, flip_time=None):
     """
     Sends trigger to EEG recording
+    The port is set right away (or at flip_time) and reset to 0 by the trigger thread, so this does not block
+    With lab = 'none' the triggers go to a FakePort that prints them
     """
-    if not lab == 'none':
-        gsr_port.setData(eeg_trigger)
-        core.wait(0.01)
-        gsr_port.setData(0)
-    else:
-        print(eeg_trigger)
-        trigger_time_list.append([core.getTime(),eeg_trigger])
-
-#SelectEEGStimulusTrigger#
-def selectEEGStimulusTrigger(start,pos):
-    """
-    distinguish EEG trigger for stimulus
-    """
-    eeg_stim_trigger = int((start+1)*10 + (pos+1))
-
-    return eeg_stim_trigger
+    eeg_triggers.send(eeg_trigger, flip_time=flip_time)
 
 
 #just setting up the EEG
@@ -463,6 +304,36 @@ if lab == 'actichamp':
     gsr_port = parallel.ParallelPort(address=0xCFB8)
 elif lab == 'biosemi':
     gsr_port = parallel.ParallelPort(address=0x3FB8)
+else:
+    gsr_port = FakePort(clock=core.monotonicClock.getTime)
+# Resets the port to 0 after trigger_pulse_width on a separate thread
+# (same clock as the win.flip() time stamps, so trigger and flip times can be compared)
+trigger_latencies = [] # [code, flip time, trigger time] per stimulus when trigger_diagnostics is True
+eeg_triggers = TriggerDispatcher(gsr_port, pulse_width=trigger_pulse_width, clock=core.monotonicClock.getTime)
+trial_log = None # the TrialWriter, opened before the experiment loop
+
+
+def shutdown(stop_tracker=True):
+    """
+    Every quit path ends here: close the trial log and write it out in the csv layout with one row per trial,
+    keep the trigger log, stop the eye tracker (stop_tracker) and quit
+    """
+    if trial_log is not None:
+        trial_log.close()
+        expandTrialLog(file_name + '_stream.csv', file_name + '.csv')
+    # Wait for the last trigger pulse and keep the set/reset times of all triggers
+    eeg_triggers.close()
+    eeg_triggers.saveLog(os.path.join(session_folder, session_identifier + '_triggers.csv'))
+    # Flip-to-trigger delays go next to the behavioural csv
+    if trigger_diagnostics:
+        print(writeTriggerLatencies(file_name + '_trigger_latency.csv', trigger_latencies))
+    # Disconnect, download the EDF file, then terminate the task
+    if eye_tracking and stop_tracker:
+        print(writeCalibrationTimes(os.path.join(session_folder, session_identifier + '_calibration.csv'),
+                                    calibration_times, blocking_beeps=calibration_blocking_beeps))
+        terminate_task()
+    win.close()
+    core.quit()
 
 ####################################################
 #Eye-tracker set-up
@@ -476,8 +347,7 @@ if eye_tracking:
         el_tracker = pylink.EyeLink("100.1.1.1")
     except RuntimeError as error:
         print('ERROR:', error)
-        core.quit()
-        sys.exit()
+        shutdown(stop_tracker=False)
 
 
     # Step 2: Open an EDF data file on the Host PC
@@ -488,8 +358,7 @@ if eye_tracking:
         # close the link if we have one open
         if el_tracker.isConnected():
             el_tracker.close()
-        core.quit()
-        sys.exit()
+        shutdown(stop_tracker=False)
 
     el_tracker.sendCommand("add_file_preamble_text 'Predatt Experiment'") #add personalized data file header (preamble text)
 
@@ -551,6 +420,10 @@ if eye_tracking:
     genv = EyeLinkCoreGraphicsPsychoPy(el_tracker, win)
     print(genv)  # print out the version number of the CoreGraphics library
 
+    # Link samples of the tracked eye, used for the fixation check (120 x 120 pixels around the screen centre)
+    gaze_monitor = GazeMonitor(el_tracker, eye_used=0, centre=(scn_width/2.0, scn_height/2.0), radius=60,
+                               sample_type=pylink.SAMPLE_TYPE, missing=pylink.MISSING_DATA)
+
     # Set background and foreground colors for the calibration target
     # in PsychoPy, (-1, -1, -1)=black, (1, 1, 1)=white, (0, 0, 0)=mid-gray
     foreground_color = (1, 1, 1)
@@ -572,6 +445,7 @@ if eye_tracking:
     #     error -- sound to play on failure or interruption
     # Each parameter could be ''--default sound, 'off'--no sound, or a wav file
     genv.setCalibrationSounds('', '', '')
+    genv.blockingBeeps = calibration_blocking_beeps
 
     # Request Pylink to use the PsychoPy window we opened above for calibration
     pylink.openGraphicsEx(genv)
@@ -583,6 +457,7 @@ def terminate_task():
 
     file_to_retrieve: The EDF on the Host that we would like to download
     win: the current window used by the experimental script
+    Returns the EdfTransfer thread that downloads and converts the EDF (None when the tracker is not connected)
     """
     el_tracker = pylink.getEYELINK()
     if el_tracker.isConnected():
@@ -607,93 +482,78 @@ def terminate_task():
         message.draw()
         win.flip()
         pylink.pumpDelay(500)
-        # Download the EDF data file from the Host PC to a local data folder
-        # parameters: source_file_on_the_host, destination_file_on_local_drive
+        # Download the EDF data file from the Host PC to a local data folder on a background thread,
+        # the link is closed and the EDF converted (edf_worker.py) when the download is done
+        # core.quit() waits for the download, the conversion runs in its own process
         local_edf = os.path.join(session_folder, session_identifier + '.EDF')
-        try:
-            el_tracker.receiveDataFile(edf_file, local_edf)
-        except RuntimeError as error:
-            print('ERROR:', error)
+        edf_transfer = EdfTransfer(el_tracker, edf_file, local_edf)
+        edf_transfer.start()
+        return edf_transfer
 
-        # Close the link to the tracker.
-        el_tracker.close()
+# Calibration/validation with timing
+calibration_times = [] # seconds per tracker setup, see writeCalibrationTimes()
+
+def trackerSetup():
+    """
+    Calibration/validation screen of the tracker (doTrackerSetup), the duration of every setup is kept in calibration_times
+    """
+    setup_start = core.getTime()
+    try:
+        el_tracker.doTrackerSetup()
+    except RuntimeError as err:
+        print('ERROR:', err)
+        el_tracker.exitCalibration()
+    calibration_times.append(core.getTime() - setup_start)
 
 def checkGazeOnFix():
-    # Here we implement a gaze trigger, so the target only comes up when
-    # the subject direct gaze to the fixation cross
+    """
+    Gaze trigger, the trial only starts when the participant fixates the cross for 300 ms
+    All link samples go through gaze_monitor so none are missed between polls
+    Returns 'yes' when the tracker should be recalibrated ('no' otherwise, or the error of isRecording())
+    and the dwell statistics of the check (with the 'wait' until it ended on every path)
+    """
     event.clearEvents()  # clear cached PsychoPy events
-    # determine which eye(s) is/are available
-    # 0- left, 1-right, 2-binocular
-    eye_used = el_tracker.eyeAvailable()
-    new_sample = None
-    old_sample = None
-    trigger_fired = False
-    in_hit_region = False
     should_recali = 'no'
     trigger_start_time = core.getTime()
     # fire the trigger following a 300-ms gaze
     minimum_duration = 0.3
-    gaze_start = -1
-    while not trigger_fired:
+    # determine which eye(s) is/are available
+    # 0- left, 1-right, 2-binocular
+    gaze_monitor.eye_used = el_tracker.eyeAvailable()
+    # Only samples from after the start of the check count
+    gaze_monitor.poll()
+    since = gaze_monitor.n_total
+    while True:
         # abort the current trial if the tracker is no longer recording
         error = el_tracker.isRecording()
         if error is not pylink.TRIAL_OK:
             el_tracker.sendMessage('tracker_disconnected')
-            return error
+            should_recali = error
+            break
 
-        # if the trigger did not fire in 30 seconds, abort trial
+        # if the trigger did not fire in 10 seconds, abort trial
         if core.getTime() - trigger_start_time >= 10.0:
             el_tracker.sendMessage('trigger_timeout_recal')
             # re-calibrate before trial
             should_recali = 'yes'
-            return should_recali
+            break
 
         # check for keyboard events, skip a trial if ESCAPE is pressed
-        # terminate the task is Ctrl-C is pressed
-        for keycode, modifier in event.getKeys(modifiers=True):
-            # Abort a trial and recalibrate if "ESCAPE" is pressed
-            if keycode == 'escape':
-                el_tracker.sendMessage('abort_and_recal')
-                # re-calibrate now trial
-                should_recali = 'yes'
-                return should_recali
-
-        # Do we have a sample in the sample buffer?
-        # and does it differ from the one we've seen before?
-        new_sample = el_tracker.getNewestSample()
-        if new_sample is not None:
-            if old_sample is not None:
-                if new_sample.getTime() != old_sample.getTime():
-                    # check if the new sample has data for the eye
-                    # currently being tracked; if so, we retrieve the current
-                    # gaze position and PPD (how many pixels correspond to 1
-                    # deg of visual angle, at the current gaze position)
-                    if eye_used == 1 and new_sample.isRightSample():
-                        g_x, g_y = new_sample.getRightEye().getGaze()
-                    if eye_used == 0 and new_sample.isLeftSample():
-                        g_x, g_y = new_sample.getLeftEye().getGaze()
-
-                    # break the while loop if the current gaze position is
-                    # in a 120 x 120 pixels region around the screen centered
-                    fix_x, fix_y = (scn_width/2.0, scn_height/2.0)
-                    if fabs(g_x - fix_x) < 60 and fabs(g_y - fix_y) < 60:
-                        # record gaze start time
-                        if not in_hit_region:
-                            if gaze_start == -1:
-                                gaze_start = core.getTime()
-                                in_hit_region = True
-                        # check the gaze duration and fire
-                        if in_hit_region:
-                            gaze_dur = core.getTime() - gaze_start
-                            if gaze_dur > minimum_duration:
-                                trigger_fired = True
-                    else:  # gaze outside the hit region, reset variables
-                        in_hit_region = False
-                        gaze_start = -1
-
-            # update the "old_sample"
-            old_sample = new_sample
-    return should_recali
+        if 'escape' in event.getKeys():
+            el_tracker.sendMessage('abort_and_recal')
+            # re-calibrate now trial
+            should_recali = 'yes'
+            break
+
+        # gaze has to stay in a 120 x 120 pixels region around the screen centre
+        gaze_monitor.poll()
+        if gaze_monitor.dwell(since)['dwell'] > minimum_duration:
+            break
+        core.wait(.001, hogCPUperiod=0) # yield the CPU until the next samples arrive
+
+    stats = gaze_monitor.dwell(since)
+    stats['wait'] = core.getTime() - trigger_start_time
+    return should_recali, stats
 
 
 ####################################################
@@ -701,53 +561,19 @@ def checkGazeOnFix():
 ####################################################
 
 # Generate main stimuli
-grid = generateStimCoordinates(gridcol=12, gridrow=10, jitter=linejitter_arr)
-stimset = generateStim(linelength=35,linewidth=2, coord_array=grid, colour='white',catch_colour= catch_colour,
+stimset = generateStim(linelength=35,linewidth=2, gridcol=12, gridrow=10, jitter=linejitter_arr, colour='white',catch_colour= catch_colour,
                         size=276, fixdistance=134)
 
-# Counterbalancing on subject number
-# Uneven nr.'s will have anticlockwise as oddball condition and vice versa
-subject_odd = 'anticlockwise'
-if int(info['Participant ID (***)']) % 2 == 0:
-    subject_odd = 'clockwise'
-
-# Different alternation scheme for attention section
-subject_section_order= ['stim','cross']
-attention_cond = ['attended','unattended']
-if int(info['Participant ID (***)']) % 4 < 2: # e.g. 0,0,1,1,0,0,1,1,...
-    subject_section_order = ['cross','stim']
-    attention_cond = ['unattended','attended']
-
-
-# Init empty condition arrays
-trial_list = [] # This is just for the trial handler
-tr_direction = np.empty([n_blocks,n_sections],dtype=object) # Full experiment oddball condition array
-trial_timings = np.empty([n_blocks,n_sections],dtype=object)# Full experiment catch condition array
-catch_trials = np.empty(n_sections,dtype=object)# Full experiment catch condition array
-recalibrated = np.zeros((n_trials,n_blocks,n_sections)) # Array for gaze deviations based on eye-tracker evaluation below
-
-for section in range(n_sections):
-    # List of catch trials and set order for attention sections
-    catch_trials[section] = generateCatchTrials(tr_block=n_trials*n_blocks,ncatch=n_catch)
-    for block in range(n_blocks):
-        trial_timings[block,section] = generateTrialTimings(tr_block=n_trials,isi_dur=isi_duration,jitter=stim_onset_jitter)
-        # Set the subject specific oddball condition
-        if subject_odd == 'anticlockwise':
-            tr_direction[block,section] = generatePredictionList(tr_block=n_trials,n_odd=n_odd) 
-        elif subject_odd == 'clockwise': 
-            tr_direction[block,section] = generatePredictionList(tr_block=n_trials,n_odd=n_odd)^1 # flips the bits
-
-        trial_list.append({'tr_direction': tr_direction[block]})
-
-# A list with the length of n_blocks containing the start position for each block
-start_pos = generateBlockStarts(n_blocks=n_blocks, uniq_quadrant= localised_quad ,sub_odd=subject_odd)
+# Trial log, rows are appended to <file_name>_stream.csv in small batches during the experiment
+# The session fields are only written once in the header
+session_header = {'lab': lab, 'mode': mode, 'eye_tracking': eye_tracking,
+                  'participant': info['Participant ID (***)'], 'gender': info['Gender'],
+                  'age': info['Age'], 'handed': info['Dominant hand'],
+                  'intruct_lang': info['Language'], 'loc_quad': info['Localised Quadrant'],
+                  'subject_odd': subject_odd}
+trial_log = TrialWriter(file_name + '_stream.csv', TRIAL_FIELDS, header=session_header)
 
-# ExperimentHandler and TrialHandler
-this_exp = data.ExperimentHandler(dataFileName = file_name)
-# this_exp = data.ExperimentHandler(dataFileName = os.getcwd() + '/data/' + 'pilot_predatt_participant_test')
-
-trials = data.TrialHandler(trialList = trial_list, nReps=1, method = 'sequential')
-this_exp.addLoop(trials)
+recalibrated = np.zeros((n_trials,n_blocks,n_sections)) # Array for gaze deviations based on eye-tracker evaluation below
 
 # Initilize counters
 trial_clock = core.Clock() #define trial clock
@@ -771,14 +597,12 @@ win.flip()
 
 start_key = event.waitKeys(keyList = ['space','escape'])
 if start_key == 'escape':
-    core.quit() #no event.clearEvents() necessary
+    shutdown() #no event.clearEvents() necessary
 event.clearEvents()
 
 for sec in range(n_sections):
     # Select the task of this section
     sec_task = subject_section_order[sec]
-    # Init the per section trial count for section wide indexing
-    sec_trial = 0
     # Select instruction and draw
     if sec_task == 'cross':
         sec_message = stim_unattend_instr[language]
@@ -792,11 +616,7 @@ for sec in range(n_sections):
         message.text = eye_tracking_instr[language] #show calibration message
         message.draw()
         win.flip()
-        try:
-            el_tracker.doTrackerSetup()
-        except RuntimeError as err:
-            print('ERROR:', err)
-            el_tracker.exitCalibration() #calibrate the tracker #once you are happy with the calibration and validation (!), you are ready to run the experiment. 
+        trackerSetup()
 
         el_tracker.setOfflineMode() #this is called before start_recording() to make sure the eye tracker has enough time to switch modes (to start recording)
         pylink.pumpDelay(100)
@@ -830,7 +650,7 @@ for sec in range(n_sections):
                 el_tracker.sendMessage('TRIALID %d' % (trial_count)) #send a message ("TRIALID") to mark the start of a trial
                 el_tracker.sendCommand("record_status_message 'trial %s block %s'" % (trial_count,block_count)) #to show the current task, block nr and trial nr #+1 because Python starts at 0
                 # Check if gaze is on fixation and if not start recallibration
-                should_recal = checkGazeOnFix()
+                should_recal, fix_stats = checkGazeOnFix()
                 if should_recal == 'yes':
                     recalibrated[ind,bl,sec] = 1
                     eegTriggerSend(int(254),lab=lab) # 201 is the stop-recording command in the biosemi config file
@@ -838,11 +658,7 @@ for sec in range(n_sections):
                     message.text = eye_tracking_instr[language]
                     message.draw()
                     win.flip()
-                    try:
-                        el_tracker.doTrackerSetup()
-                    except RuntimeError as err:
-                        print('ERROR:', err)
-                        el_tracker.exitCalibration()
+                    trackerSetup()
                     should_recal = 'no'
                     el_tracker.setOfflineMode() #this is called before start_recording() to make sure the eye tracker has enough time to switch modes (to start recording)
                     pylink.pumpDelay(100)
@@ -855,85 +671,72 @@ for sec in range(n_sections):
                 
                     eegTriggerSend(int(253),lab=lab) # 200 is the start-recording command in the biosemi config file
             event.clearEvents(eventType = 'keyboard')
-            stimulus_times,trial_stamp = stimPresentation(stimulus=stimset, stim_dur=stim_duration , 
-                                                        isi_dur= trial_timings[bl,sec][ind], iti_dur=iti_duration,
-                                                        start_quad=start_pos[bl], 
-                                                        direction=tr_direction[bl,sec][ind], 
-                                                        q_catch=int(catch_trials[sec][sec_trial]),
+            if eye_tracking:
+                gaze_monitor.poll()
+                gaze_mark = gaze_monitor.n_total # fixation breaks are counted from here
+            this_trial = design[trial_count-1] # the design is in presentation order
+            stimulus_times,planned_times,trial_stamp,trial_start = stimPresentation(stimulus=stimset, stim_frames=stim_frames,
+                                                        isi_frames=this_trial['isi_frames'], planned_onsets=this_trial['planned_onsets'],
+                                                        iti_dur=iti_duration,
+                                                        start_quad=this_trial['start_quad'], 
+                                                        direction=this_trial['direction'], 
+                                                        q_catch=int(this_trial['catch']),
                                                         task=sec_task)
             keys = event.getKeys(timeStamped=trial_clock)
             t_trial = trial_clock.getTime()*1000
-            # Calculate hit rate
-            adjusted_c_trials = catch_trials[sec][sec_trial] -1
-            if catch_trials[sec][sec_trial] > 0:
-                if keys:
-                    if (keys[-1][1]-stimulus_times[adjusted_c_trials]  < .5):
-                        hits += 1  
-                else:
-                    misses += 1
-            if catch_trials[sec][sec_trial] == 0:
-                if keys:
-                    false_fire += 1
+            # Calculate hit rate, the key press is compared to the stimulus onsets on the same clock (s)
+            seq_start = trial_clock.getTime() - (core.monotonicClock.getTime() - trial_start)
+            response = keys[-1][1] - seq_start if keys else None
+            outcome = scoreTrial(this_trial['catch'], response, np.asarray(stimulus_times)/1000)
+            if outcome == 'hit':
+                hits += 1
+            elif outcome == 'miss':
+                misses += 1
+            elif outcome == 'false_alarm':
+                false_fire += 1
 
             #store data
-            trials.addData('LocalTime_DDMMYY_HMS', 
-                        str(time.localtime()[2]) + '/' + str(time.localtime()[1]) + '/' + str(time.localtime()[0]) 
-                        + '_' + str(time.localtime()[3]) + ':' + str(time.localtime()[4]) + ':' + str(time.localtime()[5])) #HMS = hour min sec
-            trials.addData('lab', lab)
-            trials.addData('mode', mode)
-            trials.addData('eye_tracking', eye_tracking)
-            trials.addData('participant', info['Participant ID (***)'])
-            trials.addData('gender', info['Gender'])
-            trials.addData('age', info['Age'])
-            trials.addData('handed', info['Dominant hand'])
-            trials.addData('intruct_lang', info['Language'])
-            trials.addData('loc_quad', info['Localised Quadrant'])
-            trials.addData('subject_odd', subject_odd)
-            trials.addData('trial', (trial_count)) #Python starts indexing at 
-            trials.addData('start_position',start_pos[bl])
-            trials.addData('trial_direction',tr_direction[bl,sec][ind])
-            trials.addData('catch_trial',catch_trials[sec][sec_trial])
-            trials.addData('t_stim_1',stimulus_times[0])
-            trials.addData('t_stim_2',stimulus_times[1])
-            trials.addData('t_stim_3',stimulus_times[2])
-            trials.addData('t_stim_4',stimulus_times[3])
-            trials.addData('experiment_time_s',exp_clock.getTime())
+            local_time = time.localtime()
+            rec = trial_log.record()
+            rec['LocalTime_DDMMYY_HMS'] = '%d/%d/%d_%d:%d:%d' % (local_time[2], local_time[1], local_time[0],
+                                                                 local_time[3], local_time[4], local_time[5]) #HMS = hour min sec
+            rec['trial'] = trial_count
+            rec['start_position'] = this_trial['start_quad']
+            rec['trial_direction'] = this_trial['direction']
+            rec['catch_trial'] = this_trial['catch']
+            rec['t_stim_1'], rec['t_stim_2'], rec['t_stim_3'], rec['t_stim_4'] = stimulus_times
+            rec['t_stim_1_planned'], rec['t_stim_2_planned'], rec['t_stim_3_planned'], rec['t_stim_4_planned'] = planned_times
+            rec['frame_rate'] = frame_rate
+            rec['experiment_time_s'] = exp_clock.getTime()
             if keys:
-                trials.addData('key_pressed',keys[-1][0])
-                trials.addData('press_time',keys[-1][1]*1000)
+                rec['key_pressed'] = keys[-1][0]
+                rec['press_time'] = keys[-1][1]*1000
             else:
-                trials.addData('key_pressed',None)
-                trials.addData('press_time',None)
-
-            trials.addData('t_trial',t_trial)
-            trials.addData('block',block_count)
+                rec['press_time'] = np.nan
+            rec['t_trial'] = t_trial
+            rec['block'] = block_count
             if eye_tracking:
                 el_tracker.sendMessage('TRIAL_END') #this marks the end of the trial
-            # Save attention condition    
-            trials.addData('attention',attention_cond[sec])
-            # Save prediction condition
-            if subject_odd == 'anticlockwise':
-                if tr_direction[bl,sec][ind] == 0:
-                   trials.addData('expected','regular') 
-                elif tr_direction[bl,sec][ind] == 1:
-                    trials.addData('expected','odd')
-            elif subject_odd == 'clockwise':
-                if tr_direction[bl,sec][ind] == 0:
-                   trials.addData('expected','odd') 
-                elif tr_direction[bl,sec][ind] == 1:
-                    trials.addData('expected','regular')
-            trials.addData('recalibrated',recalibrated[ind,bl,sec])
+            # Save attention and prediction condition
+            rec['attention'] = this_trial['attention']
+            rec['expected'] = this_trial['expected']
+            rec['recalibrated'] = recalibrated[ind,bl,sec]
+            if eye_tracking:
+                gaze_monitor.poll()
+                fix_breaks = gaze_monitor.fixationBreaks(since=gaze_mark)
+                rec['fix_wait_s'] = fix_stats['wait']
+                rec['fix_breaks'] = fix_breaks['n_breaks']
+                rec['fix_outside_ms'] = fix_breaks['outside_ms']
+                rec['gaze_lost_ms'] = fix_breaks['lost_ms']
+            else:
+                rec['fix_wait_s'] = rec['fix_breaks'] = rec['fix_outside_ms'] = rec['gaze_lost_ms'] = np.nan
   
-            this_exp.nextEntry()
+            trial_log.commit()
             trial_count+= 1
-            sec_trial+= 1
             if len(keys)>= 1:
                 if keys[-1][0] == 'escape':
-                    print(trigger_time_list)
-                    if eye_tracking:
-                        terminate_task()
-                    win.close()
-                    core.quit()
+                    shutdown()
+        trial_log.flush() # write the rest of the block during the pause
         core.wait(1)
         block_count+= 1
         cross.autoDraw = False
@@ -942,12 +745,7 @@ for sec in range(n_sections):
         if eye_tracking:
             el_tracker.stopRecording() #this is typically done for each bloc
 
-# Disconnect, download the EDF file, then terminate the task
-if eye_tracking:
-    terminate_task()
-
-# Close the window
-win.close()
-core.quit()
+# Close the logs, stop the tracker and the window
+shutdown()
 
 
@@ -0,0 +1,867 @@
+"""
+Helper functions for the predatt experiment and the C1 localizer that do not need a window,
+so they can be imported by both scripts (and used offline)
+"""
+import numpy as np
+import os
+import sys
+import csv
+import time
+import queue
+import collections
+import threading
+
+
+####################################################
+#Functions for generating the stimulus grid
+####################################################
+
+# Cache of the stimulus positions, so regenerating a stimulus set between sections is a dict lookup
+_grid_cache = {}
+
+# Quadrant signs in the order used throughout the experiment (0 upper left, 1 upper right, 2 lower right, 3 lower left)
+QUADRANT_SET = np.array([[-1,1],[1,1],[1,-1],[-1,-1]], dtype=float)
+# Upper and lower visual field used by the localizer
+FIELD_SET = np.array([[0,1],[0,-1]], dtype=float)
+
+
+def generateStimCoordinates(gridcol, gridrow, jitter):
+    """
+    Generates coordinates used to draw the stimulus lines
+    Returns a float array of shape (gridcol, gridrow, 2, 4): every point (x,y) of the grid for every quadrant
+    """
+    # Grid points
+    cols = np.arange(gridcol) * (1.0 / gridcol)
+    rows = np.arange(gridrow) * (1.0 / gridrow)
+    # Flip the grids so that they have the 'orientation' corresponding to the quadrant
+    # (quadrant 0 is flipped over the columns, 2 over the rows and 3 over both)
+    flip_col = np.array([True, False, False, True])
+    flip_row = np.array([False, False, True, True])
+    grid_x = np.where(flip_col[:,None], cols[::-1], cols) * QUADRANT_SET[:,0,None]   # (4, gridcol)
+    grid_y = np.where(flip_row[:,None], rows[::-1], rows) * QUADRANT_SET[:,1,None]   # (4, gridrow)
+
+    coord_array = np.empty((gridcol,gridrow,2,4))
+    coord_array[:,:,0,:] = grid_x.T[:,None,:]
+    coord_array[:,:,1,:] = grid_y.T[None,:,:]
+    # Add jitter
+    coord_array += jitter[:gridcol,:gridrow,:,None]
+
+    return coord_array
+
+
+def generateLocalizerStimCoordinates(gridcol, gridrow, jitter):
+    """
+    Generates coordinates used to draw the localizer stimulus lines
+    This is the same as generateStimCoordinates() but for upper and lower visual field instead of quadrant
+    Returns a float array of shape (gridcol, gridrow, 2, 2)
+    """
+    # Grid points
+    cols = -1 + np.arange(gridcol) * (2.0 / gridcol)
+    rows = np.arange(gridrow) * (1.0 / gridrow)
+    # Only the upper field is flipped over the columns
+    grid_x = np.stack((cols[::-1], cols))   # (2, gridcol)
+    grid_y = rows[None,:] * FIELD_SET[:,1,None]   # (2, gridrow)
+
+    coord_array = np.empty((gridcol,gridrow,2,2))
+    coord_array[:,:,0,:] = grid_x.T[:,None,:]
+    coord_array[:,:,1,:] = grid_y.T[None,:,:]
+    # Add jitter
+    coord_array += jitter[:gridcol,:gridrow,:,None]
+
+    return coord_array
+
+
+def stimPositions(coord_array, size, fixdistance, localizer=False):
+    """
+    Converts a coordinate array into the pixel positions passed to ElementArrayStim
+    Returns an array of shape (sections, gridcol*gridrow, 2), lines are ordered row by row
+    """
+    if localizer:
+        dist = fixdistance
+        offsets = FIELD_SET
+    else:
+        # This is to calculate the distance to the fixation cross
+        dist = np.sqrt(np.square(fixdistance)/2) #pythagoras
+        offsets = QUADRANT_SET
+    sections = np.shape(coord_array)[3]
+    # (col, row, xy, section) -> (section, row, col, xy) so the lines are ordered per row
+    xys = np.transpose(coord_array, (3,1,0,2)).reshape(sections, -1, 2)
+    # Size and distance from fixation are all in here
+    return xys * size + offsets[:sections,None,:] * dist
+
+
+def cachedStimPositions(gridcol, gridrow, jitter, size, fixdistance, localizer=False):
+    """
+    Same as stimPositions() on a freshly generated grid, but the result is cached on
+    (gridcol, gridrow, jitter hash, size, fixdistance) so it is only computed once per session
+    """
+    jitter = np.ascontiguousarray(jitter, dtype=float)
+    key = (gridcol, gridrow, hash(jitter.tobytes()), jitter.shape, size, fixdistance, localizer)
+    if key not in _grid_cache:
+        if localizer:
+            coord_array = generateLocalizerStimCoordinates(gridcol, gridrow, jitter)
+        else:
+            coord_array = generateStimCoordinates(gridcol, gridrow, jitter)
+        xys = stimPositions(coord_array, size, fixdistance, localizer=localizer)
+        xys.flags.writeable = False   # shared between callers
+        _grid_cache[key] = xys
+
+    return _grid_cache[key]
+
+
+####################################################
+#Trial sequence functions
+####################################################
+
+def generatePredictionList(tr_block, n_odd, min_gap=2, rng=None):
+    """ 
+    Generate pseudo randomized properties of every trial (regular (0) or odd (1) trials)
+    Every odd trial is followed by at least min_gap regular trials before the next odd one
+    The positions are drawn directly (gap sampling) so every valid list is equally likely,
+    rng can be a numpy Generator or a seed
+    """
+    return generatePredictionLists(1, tr_block, n_odd, min_gap=min_gap, rng=rng)[0]
+
+
+def generatePredictionLists(n_lists, tr_block, n_odd, min_gap=2, rng=None):
+    """ 
+    Same as generatePredictionList() but for n_lists blocks at once, returns an (n_lists, tr_block) array
+    """
+    if n_odd < 0 or min_gap < 0 or n_odd + (n_odd-1)*min_gap > tr_block:
+        raise ValueError("Invalid input parameters")
+    rng = np.random.default_rng(rng)
+    prediction_arr = np.zeros((n_lists, tr_block), dtype=int)
+    if n_odd == 0:
+        return prediction_arr
+    # Take the obligatory gaps out, choose n_odd of the remaining slots and put the gaps back in
+    n_slots = tr_block - (n_odd-1)*min_gap
+    slots = np.sort(np.argpartition(rng.random((n_lists, n_slots)), n_odd-1, axis=1)[:, :n_odd], axis=1)
+    odd_pos = slots + np.arange(n_odd) * min_gap
+    prediction_arr[np.arange(n_lists)[:,None], odd_pos] = 1
+
+    return prediction_arr
+
+
+def generateBlockStarts(n_blocks,uniq_quadrant,sub_odd):
+    """
+    Generate a list with the start position for each block depending on the localised quadrant
+    """
+    # Roll depending on odd direction
+    if sub_odd == 'anticlockwise':
+        quad_li = np.roll(np.arange(4),-1)
+    elif sub_odd == 'clockwise':
+        quad_li = np.roll(np.arange(4),1)
+    # You have the main quad and the diagonal
+    start_quad = quad_li[uniq_quadrant]
+    diagon_quad = quad_li[(uniq_quadrant +2)%4]
+    # Create the arrays
+    half_blocks = int(np.ceil(n_blocks/2))
+    prime_quad_arr = np.full(half_blocks,start_quad)
+    diagon_quad_arr = np.full(half_blocks,diagon_quad)
+    
+    section_blocks = np.concatenate((prime_quad_arr,diagon_quad_arr))
+    block_list =  section_blocks[:n_blocks]
+    
+    return block_list
+    
+
+def generateCatchTrials(tr_block, ncatch, rng=None):
+    """ 
+    Some trials are catch trials, this function generates a list to designate which trials are
+    0 is a normal trial, 1 to 4 is the stimulus of the trial that is the catch stimulus
+    """
+    rng = np.random.default_rng(rng)
+    # Catch positions 1,2,3,4 repeated (if ncatch is divisible by 4 then it's balanced), cut to ncatch
+    c_list = rng.permutation(np.arange(ncatch*4) % 4 + 1)[:ncatch]
+    # Add the normal trials (0) and shuffle
+    full_list = rng.permutation(np.concatenate((np.zeros(tr_block-ncatch,dtype=int), c_list)))
+
+    return full_list
+
+
+def generateTrialTimings(tr_block,isi_dur, jitter,randng=None):
+    """ 
+    Generate a list of timings 4 per trial, returns an (tr_block, 4) array
+    """
+    randng = np.random.default_rng(randng)
+
+    return isi_dur + randng.uniform(low=-jitter, high=jitter, size=(tr_block,4))
+
+
+def generateQuadLocalizerTrials(quad_reps, asynchronous=False, isi=.500 , jitter=.050, rng=None):
+    """
+    Generate triallist for the C1 localizer in the beginning of the experiment this time for each quadrant
+    Also provides a list of timings to insert into presentation function when you want an asynchronous onset
+    """
+    rng = np.random.default_rng(rng)
+    # Make the proportions and randomize
+    localizer_prelist = [0,1,2,3]
+    localizer_list = rng.permutation(np.repeat(localizer_prelist,quad_reps))
+    # Timing lists
+    isi_list = np.repeat([isi],quad_reps*4)
+    jitter_list = rng.uniform(-jitter,jitter,quad_reps)
+    if asynchronous:
+        isi_list[:quad_reps] += jitter_list
+
+    return localizer_list, isi_list
+
+
+def scoreTrial(catch, response, stim_onsets, max_rt=.5):
+    """
+    Score the response of one trial
+    response is the time of the last key press and stim_onsets the onsets of the 4 stimuli (s, same clock)
+    or None when there was no key press
+    Returns 'hit', 'late', 'miss', 'false_alarm' or 'correct_rejection'
+    """
+    if catch > 0:
+        if response is None:
+            return 'miss'
+        if response - stim_onsets[catch-1] < max_rt:
+            return 'hit'
+        return 'late'
+    if response is not None:
+        return 'false_alarm'
+
+    return 'correct_rejection'
+
+
+####################################################
+#Session design
+####################################################
+
+# One record per trial of the session, in presentation order
+DESIGN_DTYPE = [('section','i4'), ('block','i4'), ('trial','i4'),
+                ('start_quad','i4'),   # start position of the trial (same for the whole block)
+                ('direction','i4'),    # 0 clockwise, 1 anticlockwise presentation
+                ('catch','i4'),        # 0 no catch, 1 to 4 the catch stimulus
+                ('soa','f8',(4,)),     # blank interval before every stimulus (s)
+                ('isi_frames','i4',(4,)), ('planned_onsets','f8',(4,)),   # filled in by scheduleSessionDesign()
+                ('task','U5'), ('attention','U10'), ('expected','U7')]
+
+
+def sessionCounterbalance(participant_id):
+    """
+    Counterbalancing on subject number, returns the odd direction, the order of the section tasks
+    and the matching attention conditions
+    """
+    # Uneven nr.'s will have anticlockwise as oddball condition and vice versa
+    subject_odd = 'anticlockwise'
+    if int(participant_id) % 2 == 0:
+        subject_odd = 'clockwise'
+
+    # Different alternation scheme for attention section
+    subject_section_order= ['stim','cross']
+    attention_cond = ['attended','unattended']
+    if int(participant_id) % 4 < 2: # e.g. 0,0,1,1,0,0,1,1,...
+        subject_section_order = ['cross','stim']
+        attention_cond = ['unattended','attended']
+
+    return subject_odd, subject_section_order, attention_cond
+
+
+def buildSessionDesign(n_sections, n_blocks, n_trials, n_odd, n_catch, isi_dur, jitter,
+                       localised_quad, subject_odd, section_order, attention_cond, rng=None):
+    """
+    Generate every trial of the session up front as one structured array (see DESIGN_DTYPE)
+    Trials are ordered section by section and block by block, so trial i of the session is design[i]
+    """
+    rng = np.random.default_rng(rng)
+    design = np.zeros((n_sections, n_blocks, n_trials), dtype=DESIGN_DTYPE)
+    design['section'] = np.arange(n_sections)[:,None,None]
+    design['block'] = np.arange(n_blocks)[None,:,None]
+    design['trial'] = np.arange(n_trials)[None,None,:]
+    # The start position for each block depending on the localised quadrant (same in both sections)
+    design['start_quad'] = generateBlockStarts(n_blocks=n_blocks, uniq_quadrant=localised_quad, sub_odd=subject_odd)[None,:,None]
+    # Subject specific oddball condition, odd trials (1) are the subject's odd direction
+    odd = generatePredictionLists(n_sections*n_blocks, tr_block=n_trials, n_odd=n_odd, rng=rng).reshape(n_sections,n_blocks,n_trials)
+    if subject_odd == 'anticlockwise':
+        design['direction'] = odd
+    elif subject_odd == 'clockwise':
+        design['direction'] = odd^1 # flips the bits
+    design['expected'] = np.where(odd == 1, 'odd', 'regular')
+    # Catch trials are spread over the whole section
+    for section in range(n_sections):
+        design['catch'][section] = generateCatchTrials(tr_block=n_trials*n_blocks, ncatch=n_catch, rng=rng).reshape(n_blocks,n_trials)
+    design['soa'] = generateTrialTimings(tr_block=n_sections*n_blocks*n_trials, isi_dur=isi_dur, jitter=jitter,
+                                         randng=rng).reshape(n_sections,n_blocks,n_trials,4)
+    design['task'] = np.asarray(section_order)[:,None,None]
+    design['attention'] = np.asarray(attention_cond)[:,None,None]
+
+    return design.reshape(-1)
+
+
+def validateSessionDesign(design, n_odd, n_catch, isi_dur, jitter, min_gap=2):
+    """
+    Check a design from buildSessionDesign(), raises a ValueError describing the first problem found
+    """
+    n_sections = len(np.unique(design['section']))
+    n_blocks = len(np.unique(design['block']))
+    blocks = design.reshape(n_sections, n_blocks, -1)
+    odd = blocks['expected'] == 'odd'
+    if not (odd.sum(axis=2) == n_odd).all():
+        raise ValueError("Not every block has %d odd trials" % n_odd)
+    trial_idx = np.broadcast_to(np.arange(odd.shape[2]), odd.shape)
+    for pos in np.where(odd, trial_idx, -1).reshape(-1, odd.shape[2]):
+        if (np.diff(pos[pos >= 0]) <= min_gap).any():
+            raise ValueError("Odd trials closer together than %d trials" % min_gap)
+    if not ((blocks['catch'] > 0).sum(axis=(1,2)) == n_catch).all():
+        raise ValueError("Not every section has %d catch trials" % n_catch)
+    if not np.isin(design['catch'], np.arange(5)).all() or not np.isin(design['start_quad'], np.arange(4)).all():
+        raise ValueError("Catch or start position out of range")
+    if not np.isin(design['direction'], [0,1]).all():
+        raise ValueError("Direction should be 0 or 1")
+    if (np.abs(design['soa'] - isi_dur) > jitter).any():
+        raise ValueError("Stimulus timing outside of %.3f +/- %.3f s" % (isi_dur, jitter))
+
+
+####################################################
+#Trial timing functions
+####################################################
+
+def frameSchedule(isi_durs, stim_dur, frame_rate):
+    """
+    Turns the stimulus timings of generateTrialTimings() into flip counts for the measured refresh rate
+    isi_durs can be the 4 timings of one trial or an (n_trials, 4) array for a whole block
+    Returns the number of blank frames before every stimulus, the number of frames a stimulus stays on
+    and the planned onset of every stimulus in seconds relative to the first flip of the trial
+    """
+    isi_frames = np.maximum(np.rint(np.asarray(isi_durs, dtype=float) * frame_rate).astype(int), 1)
+    stim_frames = max(int(np.rint(stim_dur * frame_rate)), 1)
+    # A stimulus comes up after its blank frames plus all the previous blanks and stimuli
+    n_stim = np.shape(isi_frames)[-1]
+    onset_frames = np.cumsum(isi_frames, axis=-1) + np.arange(n_stim) * stim_frames
+    planned_onsets = onset_frames / frame_rate
+
+    return isi_frames, stim_frames, planned_onsets
+
+
+def scheduleSessionDesign(design, stim_dur, frame_rate):
+    """
+    Fill in the flip counts and planned onsets of a session design for the measured refresh rate
+    Returns the number of frames a stimulus stays on
+    """
+    design['isi_frames'], stim_frames, design['planned_onsets'] = frameSchedule(design['soa'], stim_dur, frame_rate)
+
+    return stim_frames
+
+
+####################################################
+#Trial procedures
+####################################################
+
+# The flips, waits and triggers of a trial, used by the experiment scripts and headless_run.py
+# win only needs flip() and callOnFlip(), wait and clock are core.wait and core.monotonicClock.getTime
+# (or a virtual clock), drawing and eye tracking go in the callbacks
+
+def selectEEGStimulusTrigger(start,pos):
+    """
+    distinguish EEG trigger for stimulus
+    """
+    eeg_stim_trigger = int((start+1)*10 + (pos+1))
+
+    return eeg_stim_trigger
+
+
+def stimulusOrder(start_quad, direction):
+    """
+    Quadrants of the four stimuli of a trial, direction 0 is regular (clockwise) and 1 odd (anticlockwise)
+    """
+    dir_list = np.arange(4)
+    if direction == 0:
+        return np.roll(dir_list, -start_quad, axis=0)   # select the starting point of the stimulus
+
+    return np.roll(dir_list[::-1], 1+start_quad, axis=0)   # select the starting point and reverse direction
+
+
+def presentTrial(win, send_trigger, stim_frames, isi_frames, iti_dur, start_quad, direction, wait, clock,
+                 draw_stim=None, clear_stim=None, on_onset=None, after_stim=None):
+    """
+    One trial of the main experiment, timing is counted in flips (see frameSchedule())
+    draw_stim(stimpos, i) draws stimulus i before each of its frames, on_onset(trigger, onset) runs after its
+    onset flip, clear_stim(i) before the flip that removes it and after_stim(i) after that flip
+    Returns the achieved stimulus onsets (ms relative to the first flip of the trial),
+    the trial duration (ms) and the time stamp of the first flip
+    """
+    stim_times = []
+
+    # Send trial start trigger
+    send_trigger(99)
+    # Trial procedure, the first flip is frame 0 of the schedule
+    trial_start = win.flip()
+    for i,stimpos in enumerate(stimulusOrder(start_quad, direction)):
+        trigger = selectEEGStimulusTrigger(stimpos,pos=i) # EEG trigger generation
+        # Blank frames, the last one is the stimulus onset
+        for frame in range(isi_frames[i]-1):
+            win.flip()
+        # The stimulus is drawn into the back buffer before the flip that shows it
+        if draw_stim:
+            draw_stim(stimpos, i)
+        win.callOnFlip(send_trigger, trigger)  # Send trigger in the same call as the buffer swap
+        stim_onset = win.flip()
+        if on_onset:
+            on_onset(trigger, stim_onset)
+        for frame in range(stim_frames-1):
+            if draw_stim:
+                draw_stim(stimpos, i)
+            win.flip()
+        if clear_stim:
+            clear_stim(i)
+        win.flip()
+        stim_times.append((stim_onset - trial_start) * 1000)
+        if after_stim:
+            after_stim(i)
+
+    trial_time = (clock() - trial_start) * 1000
+    wait(iti_dur)
+
+    return stim_times, trial_time, trial_start
+
+
+def presentLocalizerTrial(win, send_trigger, field, stim_dur, isi_dur, wait, clock, draw_stim=None, on_onset=None):
+    """
+    One trial of the C1 localizer: the stimulus of field (0 upper, 1 lower) with trigger 80 + field
+    in the middle of isi_dur, draw_stim(field) draws it and on_onset(trigger, onset) runs after its onset flip
+    Returns the time (ms) from the onset to the flip that removes the stimulus
+    """
+    win.flip()
+    trial_start = clock()
+    # Set eeg trigger here 80 means upper field and 81 means lower field
+    trigger = int(80 + field)
+    if draw_stim:
+        draw_stim(field)
+    wait(isi_dur/2 - (clock() - trial_start))
+    win.callOnFlip(send_trigger, trigger)  # Send trigger in the same call as the buffer swap
+    stim_onset = win.flip()
+    stim_start = clock() # keep track of stim timing
+    if on_onset:
+        on_onset(trigger, stim_onset)
+    wait(stim_dur)
+    win.flip()
+    stim_timing = (clock() - stim_start) * 1000
+    wait(isi_dur/2)
+
+    return stim_timing
+
+
+def runLocalizerTrials(win, send_trigger, fields, isi_durs, stim_dur, wait, clock, draw_stim=None, on_onset=None,
+                       before_trial=None, after_trial=None):
+    """
+    Trial loop of the C1 localizer: a flip, before_trial() (gaze check), presentLocalizerTrial() and after_trial(),
+    the loop stops when after_trial() returns True (escape)
+    Returns the stimulus timings (ms) of the trials that ran
+    """
+    stim_timings = []
+    for field, isi_dur in zip(fields, isi_durs):
+        win.flip()
+        if before_trial:
+            before_trial()
+        stim_timings.append(presentLocalizerTrial(win, send_trigger, field, stim_dur, isi_dur, wait, clock,
+                                                  draw_stim, on_onset))
+        if after_trial and after_trial():
+            break
+
+    return stim_timings
+
+
+####################################################
+#External measurement instruments
+####################################################
+
+class FakePort:
+    """
+    Stand-in for parallel.ParallelPort when lab = 'none'
+    Keeps every setData call as [time, value] and prints the codes like eegTriggerSend used to
+    """
+    def __init__(self, clock=time.perf_counter, verbose=True):
+        self.clock = clock
+        self.verbose = verbose
+        self.calls = []
+
+    def setData(self, data):
+        self.calls.append([self.clock(), data])
+        if self.verbose and data:
+            print(data)
+
+
+class TriggerDispatcher:
+    """
+    Sends EEG triggers without blocking the presentation thread
+    A code goes on the port right away (or at its intended flip time) when the port is free and a worker thread
+    puts the port back to 0 after pulse_width seconds
+    A code that comes while the previous pulse is still high, or less than min_gap after its reset, waits in a
+    queue and is sent as soon as the port is free, so back-to-back codes (e.g. 253/200 and then the next code)
+    stay separate pulses for the amplifier. Codes are sent in the order they came in
+    Every pulse is logged as [code, intended time, set time, reset time]
+    With wait (the wait function of clock, e.g. a virtual clock) there is no worker thread: the port changes are
+    made by send() and poll(), and close() waits for the queued pulses with wait
+    """
+    def __init__(self, port, pulse_width=.01, clock=time.perf_counter, min_gap=.002, wait=None):
+        self.port = port
+        self.pulse_width = pulse_width
+        self.min_gap = min_gap
+        self.clock = clock
+        self.log = []
+        self._queue = collections.deque()   # pulses waiting for the port
+        self._current = None   # pulse that is on the port right now
+        self._free_at = -np.inf   # the port can take the next code from this time on
+        self._cond = threading.Condition()
+        self._running = True
+        self._wait = wait
+        self._worker = None
+        if wait is None:
+            self._worker = threading.Thread(target=self._run, name='eeg_triggers', daemon=True)
+            self._worker.start()
+
+    def send(self, code, flip_time=None):
+        """
+        Put a code on the port now (if it is free), or queue it for flip_time (same clock as the dispatcher)
+        Returns the log entry of the pulse, the set and reset times are filled in when they happen
+        """
+        pulse = [int(code), flip_time, None, None]
+        with self._cond:
+            self.log.append(pulse)
+            self._queue.append(pulse)
+            self._process()
+            self._cond.notify()
+        return pulse
+
+    def poll(self):
+        """
+        Make the port changes that are due now, returns the time of the next one (None when idle)
+        """
+        with self._cond:
+            return self._process()
+
+    def close(self):
+        """
+        Wait for the queued pulses to finish and stop the worker thread
+        """
+        if self._worker is None:
+            due = self.poll()
+            while due is not None:
+                self._wait(max(due - self.clock(), 0))
+                due = self.poll()
+            return
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._worker.join()
+
+    def saveLog(self, path):
+        """
+        Write the pulse log to a csv file
+        """
+        with open(path, 'w') as f:
+            f.write('code,intended_time,set_time,reset_time\n')
+            for code, intended, set_t, reset_t in self.log:
+                f.write(','.join([str(code)] + ['' if t is None else repr(float(t)) for t in (intended, set_t, reset_t)]) + '\n')
+
+    def _nextDue(self):
+        """
+        Time of the next port change (reset of the current pulse or set of the next code), None when idle
+        """
+        if self._current is not None:
+            return self._current[2] + self.pulse_width
+        if self._queue:
+            intended = self._queue[0][1]
+            return self._free_at if intended is None else max(self._free_at, intended)
+        return None
+
+    def _process(self):
+        """
+        Make every port change that is due, returns the time of the next one (call with the lock held)
+        """
+        while True:
+            due = self._nextDue()
+            if due is None or due > self.clock():
+                return due
+            if self._current is not None:
+                self.port.setData(0)
+                self._current[3] = self.clock()
+                self._free_at = self._current[3] + self.min_gap
+                self._current = None
+            else:
+                pulse = self._queue.popleft()
+                self.port.setData(pulse[0])
+                pulse[2] = self.clock()
+                self._current = pulse
+
+    def _run(self):
+        if sys.platform == 'win32':
+            # Raise the priority of this thread so the reset is not delayed by the presentation loop
+            import ctypes
+            kernel32 = ctypes.windll.kernel32
+            kernel32.SetThreadPriority(kernel32.GetCurrentThread(), 2)   # THREAD_PRIORITY_HIGHEST
+        with self._cond:
+            while True:
+                due = self._process()
+                if due is None:
+                    if not self._running:
+                        return
+                    self._cond.wait()
+                else:
+                    self._cond.wait(max(due - self.clock(), 0))
+
+
+def writeTriggerLatencies(path, latencies):
+    """
+    Write the flip-to-trigger delays collected in diagnostic mode ([code, flip time, trigger set time] per trigger)
+    to a csv file and return a summary of the delay distribution in ms
+    """
+    latencies = np.asarray(latencies, dtype=float).reshape(-1, 3)
+    delays = (latencies[:,2] - latencies[:,1]) * 1000
+    with open(path, 'w') as f:
+        f.write('code,flip_time,trigger_time,delay_ms\n')
+        for (code, flip_t, trig_t), delay in zip(latencies, delays):
+            f.write('%d,%.6f,%.6f,%.4f\n' % (code, flip_t, trig_t, delay))
+    if len(delays) == 0:
+        return {}
+    summary = {'n': len(delays), 'mean': float(delays.mean()), 'sd': float(delays.std()), 'min': float(delays.min()),
+               'median': float(np.median(delays)), 'p95': float(np.percentile(delays, 95)), 'max': float(delays.max())}
+
+    return summary
+
+
+class GazeMonitor:
+    """
+    Keeps the most recent link samples of the tracked eye in a fixed-size ring buffer
+    poll() drains every sample that arrived since the last call (not only the newest one),
+    the fixation criteria are then evaluated on the buffer with numpy
+    tracker is the pylink EyeLink object, centre the fixation point in screen pixels
+    Samples without gaze data (blinks, tracking loss or the other eye) are stored as NaN
+    """
+    def __init__(self, tracker, eye_used, centre, radius=60, size=8192, sample_type=200, missing=-32768):
+        self.tracker = tracker
+        self.eye_used = eye_used
+        self.centre = np.asarray(centre, dtype=float)
+        self.radius = radius
+        self.size = size
+        self.sample_type = sample_type   # pylink.SAMPLE_TYPE
+        self.missing = missing   # pylink.MISSING_DATA
+        self.n_total = 0   # number of samples seen since the start, the buffer holds the last size of them
+        self._t = np.zeros(size)
+        self._xy = np.full((size, 2), np.nan)
+
+    def poll(self):
+        """
+        Move all queued link samples into the buffer, returns the number of new samples
+        """
+        times, gaze = [], []
+        data_type = self.tracker.getNextData()
+        while data_type:
+            if data_type == self.sample_type:
+                sample = self.tracker.getFloatData()
+                times.append(sample.getTime())
+                # Binocular recordings are checked on the left eye
+                if self.eye_used == 1 and sample.isRightSample():
+                    gaze.append(sample.getRightEye().getGaze())
+                elif self.eye_used != 1 and sample.isLeftSample():
+                    gaze.append(sample.getLeftEye().getGaze())
+                else:
+                    gaze.append((np.nan, np.nan))
+            data_type = self.tracker.getNextData()
+        if times:
+            self._store(np.asarray(times, dtype=float), np.asarray(gaze, dtype=float))
+
+        return len(times)
+
+    def dwell(self, since=0):
+        """
+        Statistics of the samples after sample number since (see n_total)
+        dwell is how long (s) the gaze has been inside the fixation region without interruption,
+        in_region and lost are the fractions of samples inside the region and without gaze data
+        """
+        t, inside, valid = self._samples(since)
+        if len(t) == 0:
+            return {'n_samples': 0, 'dwell': 0., 'in_region': 0., 'lost': 0.}
+        # The current dwell starts after the last sample outside of the region
+        outside = np.flatnonzero(~inside)
+        dwell = 0.
+        if len(outside) == 0:
+            dwell = (t[-1] - t[0]) / 1000
+        elif outside[-1] < len(t) - 1:
+            dwell = (t[-1] - t[outside[-1]+1]) / 1000
+
+        return {'n_samples': len(t), 'dwell': float(dwell), 'in_region': float(inside.mean()), 'lost': float(1 - valid.mean())}
+
+    def fixationBreaks(self, since=0):
+        """
+        Fixation breaks in the samples after sample number since (e.g. during a trial)
+        Returns the number of times the gaze left the region and the time (ms) spent outside it,
+        samples without gaze data do not count as a break
+        """
+        t, inside, valid = self._samples(since)
+        if len(t) < 2:
+            return {'n_breaks': 0, 'outside_ms': 0., 'lost_ms': 0.}
+        dt = np.diff(t, append=t[-1] + np.median(np.diff(t)))
+        outside = valid & ~inside
+        n_breaks = int(np.count_nonzero(outside[1:] & ~outside[:-1]) + outside[0])
+
+        return {'n_breaks': n_breaks, 'outside_ms': float(dt[outside].sum()), 'lost_ms': float(dt[~valid].sum())}
+
+    def _store(self, times, gaze):
+        gaze[(gaze <= self.missing) | ~np.isfinite(gaze)] = np.nan
+        # Only the last size samples fit in the buffer
+        n_new = len(times)
+        times, gaze = times[-self.size:], gaze[-self.size:]
+        idx = (self.n_total + n_new - len(times) + np.arange(len(times))) % self.size
+        self._t[idx] = times
+        self._xy[idx] = gaze
+        self.n_total += n_new
+
+    def _samples(self, since):
+        n = min(self.n_total - since, self.n_total, self.size)
+        idx = (self.n_total - max(n, 0) + np.arange(max(n, 0))) % self.size
+        t, xy = self._t[idx], self._xy[idx]
+        valid = ~np.isnan(xy[:,0])
+        with np.errstate(invalid='ignore'):
+            inside = valid & np.all(np.abs(xy - self.centre) < self.radius, axis=1)
+
+        return t, inside, valid
+
+
+def writeCalibrationTimes(path, durations, blocking_beeps=False):
+    """
+    Write how long every tracker setup (calibration/validation) took (s) to a csv file
+    and return a summary, blocking_beeps is noted so sessions with and without waiting for the beeps can be compared
+    """
+    durations = np.asarray(durations, dtype=float)
+    with open(path, 'w') as f:
+        f.write('setup,duration_s,blocking_beeps\n')
+        for i, duration in enumerate(durations):
+            f.write('%d,%.3f,%d\n' % (i+1, duration, blocking_beeps))
+    if len(durations) == 0:
+        return {}
+    summary = {'n': len(durations), 'mean': float(durations.mean()), 'median': float(np.median(durations)),
+               'total': float(durations.sum()), 'blocking_beeps': blocking_beeps}
+
+    return summary
+
+
+####################################################
+#Data logging
+####################################################
+
+# Columns of the main experiment trial log, the session fields go in the header
+# The float fields are NaN until they are set (e.g. the eye tracking fields without eye tracker)
+TRIAL_FIELDS = [('LocalTime_DDMMYY_HMS','U20'), ('trial','i4'), ('start_position','i4'),
+                ('trial_direction','i4'), ('catch_trial','i4'),
+                ('t_stim_1','f8'), ('t_stim_2','f8'), ('t_stim_3','f8'), ('t_stim_4','f8'),
+                ('t_stim_1_planned','f8'), ('t_stim_2_planned','f8'), ('t_stim_3_planned','f8'), ('t_stim_4_planned','f8'),
+                ('frame_rate','f8'), ('experiment_time_s','f8'), ('key_pressed','U16'), ('press_time','f8'),
+                ('t_trial','f8'), ('block','i4'), ('attention','U10'), ('expected','U7'), ('recalibrated','f8'),
+                ('fix_wait_s','f8'), ('fix_breaks','f8'), ('fix_outside_ms','f8'), ('gaze_lost_ms','f8')]
+
+
+class TrialWriter:
+    """
+    Append-only trial log that is written in small batches from a background thread
+    The static session fields (header) are written once as '# key: value' lines at the top of the file,
+    every trial is a typed row of a preallocated numpy record array (fields = [(name, dtype), ...])
+    A crash loses at most the trials of one batch
+    """
+    def __init__(self, path, fields, header=None, batch_size=8):
+        self.path = path
+        self.header = dict(header or {})
+        self.names = [name for name, dtype in fields]
+        self._dtype = np.dtype(fields)
+        self._batch = np.zeros(batch_size, dtype=self._dtype)
+        self._blank = np.zeros(1, dtype=self._dtype)
+        for name in self.names:
+            if self._dtype[name].kind == 'f':
+                self._blank[name] = np.nan
+        self._n = 0
+        self._queue = queue.Queue()
+        # The file is opened once and only ever appended to
+        new_file = not os.path.isfile(path)
+        self._file = open(path, 'a', newline='')
+        self._csv = csv.writer(self._file)
+        if new_file:
+            for key, value in self.header.items():
+                self._file.write('# %s: %s\n' % (key, value))
+            self._csv.writerow(self.names)
+            self._file.flush()
+        self._worker = threading.Thread(target=self._run, name='trial_writer', daemon=True)
+        self._worker.start()
+
+    def record(self):
+        """
+        The blank record of the next trial (NaN floats, zero ints, empty text),
+        fill it in with record[name] = value and call commit()
+        """
+        self._batch[self._n:self._n+1] = self._blank
+        return self._batch[self._n]
+
+    def commit(self):
+        """
+        Store the current record, a full batch is handed to the writer thread
+        """
+        self._n += 1
+        if self._n == len(self._batch):
+            self.flush()
+
+    def flush(self):
+        """
+        Hand the committed records that are not written yet to the writer thread
+        """
+        if self._n:
+            self._queue.put(self._batch[:self._n].copy())
+            self._n = 0
+
+    def close(self):
+        """
+        Write the remaining records and close the file
+        """
+        self.flush()
+        self._queue.put(None)
+        self._worker.join()
+        self._file.close()
+
+    def _run(self):
+        while True:
+            rows = self._queue.get()
+            if rows is None:
+                return
+            self._csv.writerows([_formatValue(v) for v in row] for row in rows.tolist())
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+
+def _formatValue(value):
+    """
+    Empty cell for missing values (NaN floats), like TrialHandler does for None
+    """
+    if isinstance(value, float) and np.isnan(value):
+        return ''
+    return value
+
+
+def readTrialLog(path):
+    """
+    Read a TrialWriter file, returns the header dict, the column names and the rows (as strings)
+    """
+    header = {}
+    with open(path, newline='') as f:
+        line = f.readline()
+        while line.startswith('# '):
+            key, value = line[2:].rstrip('\n').split(': ', 1)
+            header[key] = value
+            line = f.readline()
+        names = next(csv.reader([line]))
+        rows = list(csv.reader(f))
+
+    return header, names, rows
+
+
+def expandTrialLog(log_path, csv_path):
+    """
+    Write a TrialWriter file as a plain csv with the header fields repeated on every row,
+    which is the layout the ExperimentHandler csv files had (and what the analysis notebooks read)
+    """
+    header, names, rows = readTrialLog(log_path)
+    static = list(header.values())
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(list(header.keys()) + names)
+        writer.writerows(static + row for row in rows)
+
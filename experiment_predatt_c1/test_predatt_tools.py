@@ -0,0 +1,211 @@
+"""
+Tests of the window-free helpers in predatt_tools.py (no psychopy needed)
+
+    python -m pytest test_predatt_tools.py
+"""
+import os
+import time
+import numpy as np
+import pytest
+from predatt_tools import (FakePort, TriggerDispatcher, generateStimCoordinates, generateLocalizerStimCoordinates,
+                           cachedStimPositions, generatePredictionList, generatePredictionLists,
+                           TRIAL_FIELDS, TrialWriter, readTrialLog)
+
+
+####################################################
+#Triggers
+####################################################
+
+def sendAndClose(codes, pulse_width=.01, min_gap=.002):
+    port = FakePort(verbose=False)
+    triggers = TriggerDispatcher(port, pulse_width=pulse_width, min_gap=min_gap)
+    for code in codes:
+        triggers.send(code)
+    triggers.close()
+    return port, triggers
+
+
+def test_back_to_back_codes_are_separate_pulses():
+    # The start/stop pairs of the scripts: 253 then the block code, 200 then 99
+    port, triggers = sendAndClose([253, 75, 200, 99])
+    assert [value for t, value in port.calls] == [253, 0, 75, 0, 200, 0, 99, 0]
+    for code, intended, set_t, reset_t in triggers.log:
+        assert reset_t - set_t >= triggers.pulse_width
+    for previous, pulse in zip(triggers.log[:-1], triggers.log[1:]):
+        assert pulse[2] >= previous[3] + triggers.min_gap
+
+
+def test_logged_reset_times_are_the_port_resets():
+    port, triggers = sendAndClose([253, 75, 99])
+    reset_times = [t for t, value in port.calls if value == 0]
+    assert len(reset_times) == len(triggers.log)
+    # The log time is taken right after the port call
+    for port_t, pulse in zip(reset_times, triggers.log):
+        assert 0 <= pulse[3] - port_t < .005
+
+
+def test_flip_time_is_kept_after_a_busy_port():
+    port = FakePort(verbose=False)
+    triggers = TriggerDispatcher(port, pulse_width=.01, min_gap=.002)
+    now = time.perf_counter()
+    triggers.send(99)
+    flip_pulse = triggers.send(11, flip_time=now + .05)
+    triggers.close()
+    assert flip_pulse[2] >= now + .05
+    assert [value for t, value in port.calls] == [99, 0, 11, 0]
+
+
+def test_injected_clock_drives_the_pulses():
+    # Without worker thread the port changes in send(), poll() and the waits of close(), on the given clock
+    now = [0.]
+
+    def wait(secs):
+        now[0] += secs
+
+    port = FakePort(clock=lambda: now[0], verbose=False)
+    triggers = TriggerDispatcher(port, pulse_width=.01, clock=lambda: now[0], min_gap=.002, wait=wait)
+    triggers.send(200)
+    triggers.send(99)
+    assert triggers.poll() == .01
+    triggers.close()
+    np.testing.assert_allclose([pulse[2:] for pulse in triggers.log], [[0., .01], [.012, .022]])
+    assert [value for t, value in port.calls] == [200, 0, 99, 0]
+
+
+####################################################
+#Stimulus grid
+####################################################
+
+# The coordinate generation of the scripts before the grid moved to predatt_tools.py (object arrays, one point
+# per loop) and the xys loop of their generateStim(), kept as the reference for the vectorised version
+
+def oldStimCoordinates(gridcol, gridrow, jitter):
+    x_spacing = 1.0 / (gridcol)
+    y_spacing = 1.0 / (gridrow)
+    coord_array = np.empty(shape = (gridcol,gridrow,2,4),dtype= 'object')
+    quadrant_set = [[-1,1],[1,1],[1,-1],[-1,-1]]
+    for i,quad in enumerate(quadrant_set):
+        for row in range(gridrow):
+            for col in range (gridcol):
+                coord_array[col,row,0,i] = col * x_spacing * quad[0]
+                coord_array[col,row,1,i] = row * y_spacing * quad[1]
+    coord_array[:,:,0,0] = np.flip(coord_array[:,:,0,0], axis=0)
+    coord_array[:,:,1,0] = np.flip(coord_array[:,:,1,0], axis=0)
+    coord_array[:,:,0,2] = np.flip(coord_array[:,:,0,2], axis=1)
+    coord_array[:,:,1,2] = np.flip(coord_array[:,:,1,2], axis=1)
+    coord_array[:,:,0,3] = np.flip(coord_array[:,:,0,3], axis=(0,1))
+    coord_array[:,:,1,3] = np.flip(coord_array[:,:,1,3], axis=(0,1))
+    for i in range(4):
+        coord_array[:,:,:,i] =  coord_array[:,:,:,i] + jitter[:gridcol,:gridrow,:]
+    return coord_array
+
+
+def oldLocalizerStimCoordinates(gridcol, gridrow, jitter):
+    x_spacing = 2.0 / (gridcol)
+    y_spacing = 1.0 / (gridrow)
+    coord_array = np.empty(shape = (gridcol,gridrow,2,2),dtype= 'object')
+    for i,field in enumerate([1,-1]):
+        for row in range(gridrow):
+            for col in range (gridcol):
+                coord_array[col,row,0,i] = -1 + col * x_spacing
+                coord_array[col,row,1,i] = row * y_spacing * field
+    coord_array[:,:,0,0] = np.flip(coord_array[:,:,0,0], axis=0)
+    coord_array[:,:,1,0] = np.flip(coord_array[:,:,1,0], axis=0)
+    for i in range(2):
+        coord_array[:,:,:,i] =  coord_array[:,:,:,i] + jitter[:gridcol,:gridrow,:]
+    return coord_array
+
+
+def oldStimPositions(coord_array, size, fixdistance, localizer=False):
+    if localizer:
+        sections, dist, quads = 2, fixdistance, [[0,1],[0,-1]]
+    else:
+        sections, dist, quads = 4, np.sqrt(np.square(fixdistance)/2), [[-1,1],[1,1],[1,-1],[-1,-1]]
+    gridcol, gridrow = np.shape(coord_array)[:2]
+    all_xys = np.empty((sections, gridcol*gridrow, 2))
+    for quad in range(sections):
+        it_count = 0
+        for row in range(gridrow):
+            for col in range(gridcol):
+                all_xys[quad,it_count,0] = (coord_array[col,row,0,quad] * size) + (quads[quad][0]*dist)
+                all_xys[quad,it_count,1] = (coord_array[col,row,1,quad] * size) + (quads[quad][1]*dist)
+                it_count += 1
+    return all_xys
+
+
+STIM_JITTER = np.load(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stim_jitter.npy'))
+GRIDS = [(12, 10, STIM_JITTER), (7, 3, np.random.default_rng(1).uniform(-.05, .05, (9, 4, 2))), (1, 1, np.zeros((1, 1, 2)))]
+
+
+@pytest.mark.parametrize('gridcol, gridrow, jitter', GRIDS)
+def test_coordinates_match_the_old_generation(gridcol, gridrow, jitter):
+    np.testing.assert_allclose(generateStimCoordinates(gridcol, gridrow, jitter),
+                               oldStimCoordinates(gridcol, gridrow, jitter).astype(float), rtol=0, atol=1e-12)
+    np.testing.assert_allclose(generateLocalizerStimCoordinates(gridcol, gridrow, jitter),
+                               oldLocalizerStimCoordinates(gridcol, gridrow, jitter).astype(float), rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('gridcol, gridrow, jitter', GRIDS)
+@pytest.mark.parametrize('localizer', [False, True])
+def test_cached_positions_match_the_old_generation(gridcol, gridrow, jitter, localizer):
+    old_coordinates = oldLocalizerStimCoordinates if localizer else oldStimCoordinates
+    expected = oldStimPositions(old_coordinates(gridcol, gridrow, jitter), 276, 134, localizer=localizer)
+    xys = cachedStimPositions(gridcol, gridrow, jitter, 276, 134, localizer=localizer)
+    np.testing.assert_allclose(xys, expected, rtol=0, atol=1e-9)
+    # The second call is the cached array
+    assert cachedStimPositions(gridcol, gridrow, jitter.copy(), 276, 134, localizer=localizer) is xys
+
+
+####################################################
+#Trial sequences
+####################################################
+
+def test_odd_trials_keep_their_gap():
+    lists = generatePredictionLists(500, tr_block=28, n_odd=7, min_gap=2, rng=0)
+    assert lists.shape == (500, 28)
+    assert (lists.sum(axis=1) == 7).all()
+    for prediction_list in lists:
+        assert (np.diff(np.flatnonzero(prediction_list)) > 2).all()
+
+
+def test_every_valid_list_is_equally_likely():
+    # 2 odd trials in 7 with 2 regular ones between them: 10 valid lists
+    lists = generatePredictionLists(20000, tr_block=7, n_odd=2, min_gap=2, rng=1)
+    valid = [(first, second) for first in range(7) for second in range(first + 3, 7)]
+    positions, counts = np.unique(np.argwhere(lists)[:,1].reshape(-1, 2), axis=0, return_counts=True)
+    assert [tuple(pair) for pair in positions] == valid
+    assert np.all(np.abs(counts / len(lists) - 1 / len(valid)) < .01)
+
+
+def test_full_block_has_one_list():
+    assert generatePredictionList(7, 3, min_gap=2, rng=2).tolist() == [1, 0, 0, 1, 0, 0, 1]
+    assert generatePredictionList(5, 0).tolist() == [0] * 5
+    with pytest.raises(ValueError):
+        generatePredictionList(6, 3, min_gap=2)
+
+
+def test_seed_reproduces_the_lists():
+    assert np.array_equal(generatePredictionLists(30, 28, 7, rng=5), generatePredictionLists(30, 28, 7, rng=5))
+
+
+####################################################
+#Trial log
+####################################################
+
+def test_unset_float_fields_are_empty_cells(tmp_path):
+    # Without eye tracker the gaze fields (fix_breaks included) stay NaN and are written as empty cells
+    trial_log = TrialWriter(str(tmp_path / 'log_stream.csv'), TRIAL_FIELDS, header={'participant': 1})
+    rec = trial_log.record()
+    rec['trial'] = 1
+    rec['t_trial'] = 2000.
+    trial_log.commit()
+    rec = trial_log.record()
+    rec['trial'] = 2
+    rec['fix_breaks'] = 3
+    trial_log.commit()
+    trial_log.close()
+    header, names, rows = readTrialLog(str(tmp_path / 'log_stream.csv'))
+    first, second = [dict(zip(names, row)) for row in rows]
+    assert first['fix_breaks'] == first['fix_outside_ms'] == first['press_time'] == ''
+    assert first['trial'] == '1' and first['t_trial'] == '2000.0'
+    assert float(second['fix_breaks']) == 3
@@ -0,0 +1,291 @@
+"""
+Epoch store for the group plots: the epochs of every subject are written once as a memory-mapped
+(epochs, channels, times) float32 .npy file with the metadata and events column by column in a .npz sidecar
+Opening the store only reads store.json, the data is mapped (not read) when a subject is used, so
+crop, channel selection and baseline are applied to the selected part at read time
+
+    store = EpochStore.build(store_directory, {sub: path for every main_eventset_mastoidref_XX-epo.fif})
+    store = EpochStore(store_directory)
+    rows = store.metadata.query('catch_trial == 0').index
+    evoked = store.evoked(rows, picks=['POz','Oz'], tmin=-0.1, tmax=0.5, baseline=(None,0))
+    epochs = store.toEpochs(rows, tmin=-0.1, tmax=0.5, baseline=(None,0))   # mne.EpochsArray of the selection
+
+A subject is only written again when its epoch file changed (size or modification time)
+"""
+
+import json
+import os
+import numpy as np
+import pandas as pd
+import mne
+
+
+STORE_VERSION = 2   # 2: missing values of the text columns are kept
+
+
+def _writeColumns(path, metadata, events):
+    """
+    Metadata columns ('metadata/<column>') and the events in one .npz file
+    The missing values (NaN/None) of a text column are kept as a mask ('missing/<column>'), not as 'nan'/'None'
+    """
+    columns = {'events': events}
+    if metadata is not None:
+        for name in metadata.columns:
+            column = metadata[name].to_numpy()
+            if column.dtype == object:   # strings (mixed columns are stored as text)
+                missing = pd.isna(column)
+                column = np.where(missing, '', column).astype(str)
+                if missing.any():
+                    columns['missing/' + name] = missing
+            columns['metadata/' + name] = column
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, **columns)
+    os.replace(tmp, path)
+
+
+def _readColumns(path):
+    with np.load(path) as npz:
+        metadata = pd.DataFrame({key.split('/', 1)[1]: npz[key] for key in npz.files if key.startswith('metadata/')})
+        for key in npz.files:
+            if key.startswith('missing/'):
+                name = key.split('/', 1)[1]
+                metadata[name] = metadata[name].astype(object).mask(npz[key], np.nan)
+        events = npz['events']
+    return metadata, events
+
+
+class EpochStore:
+    """
+    Memory-mapped epochs of several subjects with the same channels and times
+    Rows are numbered over all subjects in the order of store.json (the index of store.metadata)
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'store.json')) as f:
+            self.manifest = json.load(f)
+        self.ch_names = self.manifest['ch_names']
+        self.times = np.array(self.manifest['times'])
+        self.sfreq = self.manifest['sfreq']
+        self.event_id = self.manifest['event_id']
+        self.subjects = [int(sub) for sub in self.manifest['subjects']]
+        counts = [self.manifest['subjects'][str(sub)]['n_epochs'] for sub in self.subjects]
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(int)
+        self._data = {}
+        self._metadata = None
+        self._events = None
+        self._info = None
+
+    ####################################################
+    #Writing
+    ####################################################
+
+    @classmethod
+    def build(cls, directory, epoch_paths, clear_bads=True):
+        """
+        Write the epochs of every subject ({subject: path of the -epo.fif}) that is not in the store yet
+        or changed since, subjects that are not in epoch_paths are removed
+        Returns the opened store
+        """
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, 'store.json')
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') != STORE_VERSION:
+                manifest = {}
+        except FileNotFoundError:
+            manifest = {}
+        old_subjects = manifest.get('subjects', {})
+        subjects = {}
+
+        for sub, path in sorted(epoch_paths.items()):
+            stat = os.stat(path)
+            source = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            entry = old_subjects.get(str(sub))
+            if entry is not None and entry['source'] == source:
+                subjects[str(sub)] = entry
+                continue
+
+            epochs = mne.read_epochs(path, preload=True, verbose='error')
+            if clear_bads:
+                epochs.info['bads'] = []
+            if 'ch_names' not in manifest:
+                manifest.update({'ch_names': epochs.ch_names, 'times': epochs.times.tolist(),
+                                 'sfreq': epochs.info['sfreq'], 'event_id': {}})
+                mne.io.write_info(os.path.join(directory, 'info.fif'), epochs.info)
+            if not np.allclose(epochs.times, manifest['times']):
+                raise ValueError(f'the epochs of subject {sub} have other times than the store')
+            manifest['event_id'].update(epochs.event_id)
+
+            data_file, columns_file = f'sub_{sub:02}-epo.npy', f'sub_{sub:02}-columns.npz'
+            tmp = os.path.join(directory, data_file + '.tmp')
+            data = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32,
+                                             shape=(len(epochs), len(manifest['ch_names']), len(epochs.times)))
+            data[:] = epochs.get_data(picks=manifest['ch_names'])
+            data.flush()
+            del data
+            os.replace(tmp, os.path.join(directory, data_file))
+            _writeColumns(os.path.join(directory, columns_file), epochs.metadata, epochs.events)
+            subjects[str(sub)] = {'data': data_file, 'columns': columns_file, 'n_epochs': len(epochs), 'source': source}
+            print(f'subject {sub}: {len(epochs)} epochs written')
+
+        for sub, entry in old_subjects.items():
+            if sub not in subjects:
+                for name in [entry['data'], entry['columns']]:
+                    if os.path.isfile(os.path.join(directory, name)):
+                        os.remove(os.path.join(directory, name))
+        manifest.update({'version': STORE_VERSION, 'subjects': subjects})
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+        return cls(directory)
+
+    ####################################################
+    #Reading
+    ####################################################
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def data(self, sub):
+        """
+        The (epochs, channels, times) memmap of one subject, read-only
+        """
+        if sub not in self._data:
+            path = os.path.join(self.directory, self.manifest['subjects'][str(sub)]['data'])
+            self._data[sub] = np.load(path, mmap_mode='r')
+        return self._data[sub]
+
+    def _loadColumns(self):
+        metadata, events = [], []
+        for sub in self.subjects:
+            sub_metadata, sub_events = _readColumns(os.path.join(self.directory, self.manifest['subjects'][str(sub)]['columns']))
+            sub_metadata['store_subject'] = sub
+            metadata.append(sub_metadata)
+            events.append(sub_events)
+        self._metadata = pd.concat(metadata, ignore_index=True)
+        self._events = np.concatenate(events)
+
+    @property
+    def metadata(self):
+        """
+        Metadata of all rows (read on first use), store_subject is the subject the row belongs to
+        """
+        if self._metadata is None:
+            self._loadColumns()
+        return self._metadata
+
+    @property
+    def events(self):
+        if self._events is None:
+            self._loadColumns()
+        return self._events
+
+    @property
+    def info(self):
+        if self._info is None:
+            self._info = mne.io.read_info(os.path.join(self.directory, 'info.fif'), verbose='error')
+        return self._info
+
+    def _selection(self, picks=None, tmin=None, tmax=None):
+        """
+        Channel indices (a slice when possible) and time slice for picks and tmin/tmax
+        """
+        if picks is None:
+            channels = slice(None)
+        else:
+            picks = [picks] if isinstance(picks, str) else list(picks)
+            channels = np.array([self.ch_names.index(pick) for pick in picks])
+            if len(channels) and np.all(np.diff(channels) == 1):
+                channels = slice(channels[0], channels[-1] + 1)
+        start = 0 if tmin is None else int(np.searchsorted(self.times, tmin - 0.5 / self.sfreq))
+        stop = len(self.times) if tmax is None else int(np.searchsorted(self.times, tmax + 0.5 / self.sfreq))
+
+        return channels, slice(start, stop)
+
+    def _baselineSlice(self, times, baseline):
+        start = 0 if baseline[0] is None else int(np.searchsorted(times, baseline[0] - 0.5 / self.sfreq))
+        stop = len(times) if baseline[1] is None else int(np.searchsorted(times, baseline[1] + 0.5 / self.sfreq))
+        return slice(start, stop)
+
+    def _chunks(self, rows):
+        """
+        (subject, rows of that subject in its own file, positions in rows) for the requested store rows
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=int)
+        subject_ix = np.searchsorted(self.offsets, rows, side='right') - 1
+        for i in np.unique(subject_ix):
+            positions = np.flatnonzero(subject_ix == i)
+            yield self.subjects[i], rows[positions] - self.offsets[i], positions
+
+    def _read(self, sub, sub_rows, channels, times):
+        # Slices are views of the memmap, so only the selected channels and times of the rows are read
+        view = self.data(sub)[:, :, times]
+        if isinstance(channels, slice):
+            return view[:, channels][sub_rows]
+        return view[sub_rows][:, channels]
+
+    def get(self, rows=None, picks=None, tmin=None, tmax=None, baseline=None):
+        """
+        (rows, channels, times) float32 array of the selection, only the selected part is read from disk
+        The baseline is subtracted after the crop like epochs.crop().apply_baseline()
+        """
+        channels, times = self._selection(picks, tmin, tmax)
+        n_rows = len(self) if rows is None else len(rows)
+        n_channels = len(self.ch_names) if picks is None else len(np.arange(len(self.ch_names))[channels])
+        out = np.empty((n_rows, n_channels, times.stop - times.start), dtype=np.float32)
+        for sub, sub_rows, positions in self._chunks(rows):
+            out[positions] = self._read(sub, sub_rows, channels, times)
+        if baseline is not None:
+            base = self._baselineSlice(self.times[times], baseline)
+            out -= out[..., base].mean(axis=-1, keepdims=True)
+
+        return out
+
+    def mean(self, rows=None, picks=None, tmin=None, tmax=None, baseline=None):
+        """
+        Average (channels, times) of the selection, read one subject at a time
+        The baseline of the average equals the average of the baseline corrected epochs
+        """
+        channels, times = self._selection(picks, tmin, tmax)
+        total, n = 0., 0
+        for sub, sub_rows, positions in self._chunks(rows):
+            total = total + self._read(sub, sub_rows, channels, times).sum(axis=0, dtype=np.float64)
+            n += len(sub_rows)
+        average = total / n
+        if baseline is not None:
+            base = self._baselineSlice(self.times[times], baseline)
+            average = average - average[:, base].mean(axis=-1, keepdims=True)
+
+        return average
+
+    def evoked(self, rows=None, picks=None, tmin=None, tmax=None, baseline=None, comment=''):
+        """
+        mean() as an mne.EvokedArray
+        """
+        channels, times = self._selection(picks, tmin, tmax)
+        ch_names = list(np.array(self.ch_names)[channels])
+        info = mne.pick_info(self.info, mne.pick_channels(self.info['ch_names'], ch_names, ordered=True))
+        n = len(self) if rows is None else len(rows)
+
+        return mne.EvokedArray(self.mean(rows, picks, tmin, tmax, baseline), info, tmin=self.times[times][0],
+                               nave=n, comment=comment)
+
+    def toEpochs(self, rows=None, picks=None, tmin=None, tmax=None, baseline=None):
+        """
+        The selection as an mne.EpochsArray with its metadata and events (for the mne plotting functions)
+        """
+        channels, times = self._selection(picks, tmin, tmax)
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=int)
+        ch_names = list(np.array(self.ch_names)[channels])
+        info = mne.pick_info(self.info, mne.pick_channels(self.info['ch_names'], ch_names, ordered=True))
+        events = self.events[rows].copy()
+        # The samples of different subjects overlap, mne wants them unique (like mne.concatenate_epochs)
+        events[:,0] = np.arange(len(rows)) * len(self.times)
+        event_id = {name: code for name, code in self.event_id.items() if code in events[:,2]}
+        metadata = self.metadata.iloc[rows].reset_index(drop=True)
+
+        return mne.EpochsArray(self.get(rows, picks, tmin, tmax, baseline), info, events=events,
+                               tmin=self.times[times][0], event_id=event_id, metadata=metadata,
+                               baseline=baseline, verbose='error')
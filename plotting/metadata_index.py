@@ -0,0 +1,135 @@
+"""
+Index over the epoch metadata for selecting trials without chained pandas queries
+For every value of the indexed columns (and every event code) the matching rows are kept as a packed bitset,
+a condition like {'event': 'seq2', 'attention': 'attended', 'expected': 'regular', 'precedes_odd': 1}
+is the AND of its bitsets and gives the row numbers directly
+
+    index = MetadataIndex.fromStore(store)          # or MetadataIndex.fromEpochs(epochs)
+    rows = index.select({'event': 'seq2', 'attention': 'attended', 'participant': 4})
+    evokeds = index.averages(store, {'att_reg': {...}, 'att_odd': {...}}, by='participant', tmin=-0.1, tmax=0.5)
+
+'event' takes event names like epochs[...] does ('seq2' selects 'pos2/seq2', 'pos3/seq2', ...),
+a list of values selects any of them
+"""
+
+import numpy as np
+import pandas as pd
+
+
+INDEX_COLUMNS = ['participant', 'attention', 'expected', 'precedes_odd', 'start_position', 'catch_trial']
+
+
+class MetadataIndex:
+    """
+    Packed bitsets of the rows per value of every indexed column and per event code
+    """
+    def __init__(self, metadata, events=None, event_id=None, columns=INDEX_COLUMNS):
+        self.n_rows = len(metadata)
+        self.event_id = dict(event_id or {})
+        self.bitsets = {}
+        for column in columns:
+            if column in metadata:
+                self.bitsets[column] = self._bitsets(metadata[column].to_numpy())
+        if events is not None:
+            self.bitsets['event'] = self._bitsets(np.asarray(events)[:,2])
+
+    @classmethod
+    def fromEpochs(cls, epochs, columns=INDEX_COLUMNS):
+        return cls(epochs.metadata, epochs.events, epochs.event_id, columns)
+
+    @classmethod
+    def fromStore(cls, store, columns=INDEX_COLUMNS):
+        return cls(store.metadata, store.events, store.event_id, columns)
+
+    def _bitsets(self, values):
+        rows = np.arange(len(values))
+        if values.dtype == object:   # mixed columns can not be sorted, the missing values are left out like nan
+            rows = np.flatnonzero(~pd.isna(values))
+            values = values[rows].astype(str)
+        # Sorting once groups the rows of every value
+        ranks = np.argsort(values, kind='stable')
+        sorted_values = values[ranks]
+        order = rows[ranks]
+        starts = np.flatnonzero(np.r_[True, sorted_values[1:] != sorted_values[:-1]])
+        bitsets = {}
+        for start, stop in zip(starts, np.r_[starts[1:], len(values)]):
+            value = sorted_values[start]
+            if value != value:   # nan
+                continue
+            mask = np.zeros(self.n_rows, dtype=bool)
+            mask[order[start:stop]] = True
+            bitsets[value.item() if hasattr(value, 'item') else value] = np.packbits(mask)
+        return bitsets
+
+    def eventCodes(self, name):
+        """
+        Event codes of the event names that have all '/' tags of name (like epochs[name])
+        """
+        if name in self.event_id:
+            return [self.event_id[name]]
+        tags = set(name.split('/'))
+        return [code for event, code in self.event_id.items() if tags <= set(event.split('/'))]
+
+    def bits(self, column, value):
+        """
+        Bitset of the rows where column has value (or any of the values in a list)
+        """
+        values = value if isinstance(value, (list, tuple, set, np.ndarray)) else [value]
+        if column == 'event':
+            values = [code for value in values
+                      for code in (self.eventCodes(value) if isinstance(value, str) else [value])]
+        if column not in self.bitsets:
+            raise KeyError(f'{column} is not indexed')
+        empty = np.zeros((self.n_rows + 7) // 8, dtype=np.uint8)
+        return np.bitwise_or.reduce([self.bitsets[column].get(value, empty) for value in values] + [empty])
+
+    def mask(self, spec):
+        """
+        Packed AND of all conditions in spec ({column: value or list of values})
+        """
+        bits = np.packbits(np.ones(self.n_rows, dtype=bool))
+        for column, value in spec.items():
+            bits = bits & self.bits(column, value)
+        return bits
+
+    def select(self, spec):
+        """
+        Row numbers matching spec
+        """
+        return np.flatnonzero(np.unpackbits(self.mask(spec), count=self.n_rows))
+
+    def groupBy(self, spec, by='participant', groups=None):
+        """
+        {value of by: row numbers matching spec} for every value of by (or the given groups, in that order)
+        """
+        bits = self.mask(spec)
+        groups = list(self.bitsets[by]) if groups is None else groups
+        return {group: np.flatnonzero(np.unpackbits(bits & self.bits(by, group), count=self.n_rows))
+                for group in groups}
+
+    def averages(self, source, conditions, by='participant', groups=None, **read):
+        """
+        Evoked per condition ({name: spec}) and group: {name: [evoked of every group]}
+        source is the EpochStore or the Epochs the index was made from, read are the picks/crop/baseline
+        arguments of EpochStore.evoked(), applied the same way to the average of Epochs (crop, then baseline)
+        """
+        evokeds = {}
+        for name, spec in conditions.items():
+            evokeds[name] = []
+            for group, rows in self.groupBy(spec, by, groups).items():
+                if len(rows) == 0:
+                    raise ValueError(f'no epochs for {name} with {by} {group}')
+                if hasattr(source, 'evoked'):
+                    evokeds[name].append(source.evoked(rows, comment=name, **read))
+                else:
+                    evokeds[name].append(self._epochsEvoked(source, rows, comment=name, **read))
+        return evokeds
+
+    @staticmethod
+    def _epochsEvoked(epochs, rows, picks=None, tmin=None, tmax=None, baseline=None, comment=''):
+        evoked = epochs[rows].average(picks=picks)
+        evoked.crop(tmin, tmax)
+        if baseline is not None:
+            evoked.apply_baseline(baseline)
+        evoked.comment = comment
+        return evoked
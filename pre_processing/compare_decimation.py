@@ -0,0 +1,94 @@
+"""
+Compares the notebook chain (notch and band-pass at the BDF rate, decimation at the epoching) with the
+early decimation of decimateRaw() (anti-alias low-pass and decimation right after loading) on one recording
+Prints the time of every step of both chains and the difference between the epochs they give
+
+    python compare_decimation.py --data-directory C:/Users/mvmigem/Documents/data/project_1/ --subject 26
+
+The ICA fit is timed on both but not applied, so the difference is only that of the filtering and decimation
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+import mne
+from preprocessing_tools import (loadRejections, downsamplingParams, decimateRaw, notchFilter, bandpassFilter,
+                                 interpolateBads, annotateCalibrationGaps, fitIca, selectEventId, epochStimLocked)
+from preprocess_batch import loadRaw
+
+
+def runChain(raw, bads, event_id, early_decim, random_state=0):
+    """
+    Preprocess a copy of the loaded raw up to the epochs, returns the epochs, the events and the time of every step
+    """
+    decim, lowpass_freq = downsamplingParams(raw.info['sfreq'])
+    timings = {}
+
+    def step(name, compute):
+        t0 = time.perf_counter()
+        data = compute()
+        timings[name] = time.perf_counter() - t0
+        return data
+
+    raw = raw.copy()
+    if early_decim:
+        raw, events = step('decimate', lambda: decimateRaw(raw, decim, lowpass_freq))
+        raw = step('filter', lambda: bandpassFilter(notchFilter(raw), None))
+        decim = 1
+    else:
+        raw = step('filter', lambda: bandpassFilter(notchFilter(raw), lowpass_freq))
+    raw = step('interpolate', lambda: interpolateBads(raw, bads))
+    events = mne.find_events(raw)
+    annotateCalibrationGaps(raw, events)
+    step('ica_fit', lambda: fitIca(raw, random_state=random_state))
+    epochs = step('epoch', lambda: epochStimLocked(raw, events, event_id, decim))
+
+    return epochs, events, timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and compare early decimation with the notebook chain')
+    parser.add_argument('--data-directory', default='C:/Users/mvmigem/Documents/data/project_1/')
+    parser.add_argument('--subject', type=int, default=26)
+    parser.add_argument('--reference', nargs='+', default=['M1','M2'], help="reference channels or 'average'")
+    args = parser.parse_args()
+
+    mne.set_log_level('error')
+    data_directory = os.path.join(args.data_directory, '')
+    sub = args.subject
+    bads = loadRejections(data_directory + 'rejected_channels.npy').get(f'subject_{sub}', [])
+    behav_data = pd.read_csv(data_directory + f'raw_data/sub_{sub}/behav/predatt_participant_{sub}.csv')
+    reference = 'average' if args.reference == ['average'] else args.reference
+
+    t0 = time.perf_counter()
+    raw = loadRaw(data_directory + f'raw_data/sub_{sub}/eeg/main_{sub}.bdf', reference)
+    print(f'load: {time.perf_counter() - t0:.1f} s, {raw.n_times} samples at {raw.info["sfreq"]:.0f} Hz')
+
+    full, full_events, full_times = runChain(raw, bads, selectEventId(behav_data), early_decim=False)
+    early, early_events, early_times = runChain(raw, bads, selectEventId(behav_data), early_decim=True)
+
+    print('step            full rate    early')
+    for name in ['decimate', 'filter', 'interpolate', 'ica_fit', 'epoch']:
+        print('%-12s %10.1f s %8.1f s' % (name, full_times.get(name, 0.), early_times.get(name, 0.)))
+    total_full, total_early = sum(full_times.values()), sum(early_times.values())
+    print('%-12s %10.1f s %8.1f s (x%.1f)' % ('total', total_full, total_early, total_full / total_early))
+
+    # Event timing: the remapped events against the full rate events divided by decim
+    decim = int(round(raw.info['sfreq'] / early.info['sfreq']))
+    jitter = (early_events[:,0] - full_events[:,0] / decim) / early.info['sfreq'] * 1000
+    print(f'events: {len(full_events)} vs {len(early_events)}, '
+          f'remapping shift {np.abs(jitter).mean():.2f} ms mean, {np.abs(jitter).max():.2f} ms max')
+
+    # Epochs: same events and time points in both, the difference relative to the signal
+    full_data = full.get_data(picks='eeg') * 1e6
+    early_data = early.get_data(picks='eeg') * 1e6
+    n_times = min(full_data.shape[-1], early_data.shape[-1])
+    difference = early_data[..., :n_times] - full_data[..., :n_times]
+    rms = np.sqrt(np.mean(full_data**2))
+    print(f'epochs: {len(full)} vs {len(early)}, difference {np.abs(difference).max():.3f} uV max, '
+          f'{np.sqrt(np.mean(difference**2)):.3f} uV rms ({100 * np.sqrt(np.mean(difference**2)) / rms:.2f}% of the signal)')
+    evoked_difference = difference.mean(axis=0)
+    print(f'evoked (all epochs): difference {np.abs(evoked_difference).max():.3f} uV max, '
+          f'correlation {np.corrcoef(full_data[..., :n_times].mean(0).ravel(), early_data[..., :n_times].mean(0).ravel())[0,1]:.5f}')
@@ -0,0 +1,142 @@
+"""
+Running averages of epochs per condition without keeping the epochs
+EvokedAccumulator keeps the mean, the sum of squared deviations from it and the number of epochs per condition
+(channels x times), updated with Welford/Chan steps so the variance does not lose precision to the
+cancellation of sumsq/n - mean**2. The mean, the standard error and the GFP can be computed at any time and two
+accumulators (e.g. two subjects or two chunks of a recording) are merged with the same update
+
+    acc = EvokedAccumulator(epochs.ch_names, epochs.times)
+    acc.addEpochs(epochs)                     # one condition per event_id key
+    acc.add('position1', epoch_array)         # (epochs, channels, times) or one epoch
+    evoked = acc.evoked('position1', epochs.info)
+
+addEpochs() interpolates the bad channels of the epochs first, like mne.grand_average(interpolate_bads=True),
+add() takes the data as it is
+For a grand average like mne.grand_average (every subject weighs the same) add the mean of every subject
+to a second accumulator, its standard error is then the one between subjects
+
+    grand.add('position1', acc.mean('position1'))
+"""
+
+import numpy as np
+import mne
+
+
+class EvokedAccumulator:
+    """
+    Mean, sum of squared deviations and count per condition, the data is (channels, times) per epoch
+    """
+    def __init__(self, ch_names, times):
+        self.ch_names = list(ch_names)
+        self.times = np.asarray(times)
+        self.means = {}
+        self.deviations = {}   # sum of squared deviations from the mean
+        self.counts = {}
+
+    @property
+    def conditions(self):
+        return list(self.counts)
+
+    def _entry(self, condition):
+        if condition not in self.counts:
+            shape = (len(self.ch_names), len(self.times))
+            self.means[condition] = np.zeros(shape)
+            self.deviations[condition] = np.zeros(shape)
+            self.counts[condition] = 0
+
+    def _update(self, condition, n, mean, deviations):
+        """
+        Combine the condition with n epochs of the given mean and sum of squared deviations (Chan et al.)
+        """
+        self._entry(condition)
+        total = self.counts[condition] + n
+        delta = mean - self.means[condition]
+        self.means[condition] += delta * (n / total)
+        self.deviations[condition] += deviations + delta**2 * (self.counts[condition] * n / total)
+        self.counts[condition] = total
+
+    def add(self, condition, data):
+        """
+        Add one epoch (channels, times) or several (epochs, channels, times) to a condition
+        """
+        data = np.asarray(data, dtype=float)
+        if data.ndim == 2:
+            data = data[np.newaxis]
+        if len(data):
+            mean = data.mean(axis=0)
+            centred = data - mean
+            self._update(condition, len(data), mean, np.einsum('ect,ect->ct', centred, centred))
+        else:
+            self._entry(condition)
+
+        return self
+
+    def addEpochs(self, epochs, conditions=None, prefix='', interpolate_bads=True):
+        """
+        Add mne Epochs, conditions are the selections to use (default the event_id keys, 'pos1' also
+        selects 'pos1/seq2' like epochs['pos1']), stored as prefix + condition
+        With interpolate_bads the bad channels are interpolated first like mne.grand_average,
+        otherwise their data is added as it is
+        """
+        conditions = list(epochs.event_id) if conditions is None else conditions
+        for condition in conditions:
+            selection = epochs[condition]
+            if len(selection):
+                if interpolate_bads and selection.info['bads']:
+                    selection = selection.load_data().interpolate_bads(reset_bads=True, verbose='error')
+                self.add(prefix + condition, selection.get_data(picks=self.ch_names))
+
+        return self
+
+    def merge(self, other):
+        """
+        Add the epochs of another accumulator (same channels and times)
+        """
+        if other.ch_names != self.ch_names or not np.array_equal(other.times, self.times):
+            raise ValueError('accumulators with different channels or times can not be merged')
+        for condition in other.conditions:
+            if other.counts[condition]:
+                self._update(condition, other.counts[condition], other.means[condition], other.deviations[condition])
+            else:
+                self._entry(condition)
+
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def count(self, condition):
+        return self.counts.get(condition, 0)
+
+    def mean(self, condition):
+        """
+        Average (channels, times), nan without epochs
+        """
+        if not self.count(condition):
+            return np.full((len(self.ch_names), len(self.times)), np.nan)
+        return self.means[condition].copy()
+
+    def se(self, condition):
+        """
+        Standard error of the mean (channels, times), nan with less than 2 epochs
+        """
+        n = self.count(condition)
+        if n < 2:
+            return np.full((len(self.ch_names), len(self.times)), np.nan)
+        variance = self.deviations[condition] / (n - 1)
+
+        return np.sqrt(variance / n)
+
+    def gfp(self, condition):
+        """
+        Global field power of the average, the standard deviation over channels (times,) like mne for EEG
+        """
+        return self.mean(condition).std(axis=0)
+
+    def evoked(self, condition, info, comment=None):
+        """
+        The average as an mne.EvokedArray (info with the same channels, e.g. epochs.info)
+        """
+        info = mne.pick_info(info, mne.pick_channels(info['ch_names'], self.ch_names, ordered=True))
+        return mne.EvokedArray(self.mean(condition), info, tmin=self.times[0], nave=self.count(condition),
+                               comment=comment or condition)
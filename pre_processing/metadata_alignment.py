@@ -0,0 +1,215 @@
+"""
+Alignment of the behavioural data with the epochs of the main experiment (the hand edits of metadata_adjust.ipynb)
+Every trial in the behavioural csv should give the codes 99, then (position+1)*10 + (stimulus+1) for its four
+stimuli, the positions follow from start_position and trial_direction like stimPresentation() in the experiment
+The expected codes of all trials are aligned with the codes of the epochs by dynamic programming (edit distance
+with dropped and extra events, no substitutions), so every epoch gets the row of its own trial instead of assuming
+the lost stimuli (e.g. at a block cut-off) are the last of a trial
+The codes alone can not tell which of identical neighbouring trials lost an event, those ties are resolved with the
+timing: the event samples are fitted on the trial times of the behavioural data (experiment_time_s, t_stim_*) and
+a second pass prefers the alignment with the smallest timing errors. Without the timing columns the drops of
+identical trials are put at the end of the run
+
+    metadata, dropped = alignMetadata(epochs.events, behav_data)
+    report = alignSubjects([1, 2, 26], raw_data_dir, cleaned_data_dir)    # reads, aligns and saves every subject
+
+Metadata columns added to the behavioural ones: precedes_odd, stimulus (0 is the trial start, 1-4 the stimuli),
+expected_code, aligned (False for an epoch with a code that is not in the behavioural data) and
+n_dropped / trial_complete (stimuli of the trial that have no epoch)
+"""
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import mne
+
+
+START_CODE = 99
+N_STIMULI = 4
+MATCH, DROPPED, EXTRA = 0, 1, 2
+
+
+def trialCodes(start_position, trial_direction):
+    """
+    (trials, 5) expected event codes: the start code and the codes of the four stimuli
+    direction 0 goes up from the start position, direction 1 goes down (stimPresentation())
+    """
+    start_position = np.asarray(start_position, dtype=int)[:, np.newaxis]
+    step = np.where(np.asarray(trial_direction, dtype=int) == 1, -1, 1)[:, np.newaxis]
+    stimulus = np.arange(N_STIMULI)[np.newaxis]
+    positions = (start_position + step * stimulus) % 4
+    codes = (positions + 1) * 10 + stimulus + 1
+
+    return np.hstack([np.full((len(codes), 1), START_CODE), codes])
+
+
+def alignCodes(expected, observed, gap=1, expected_times=None, observed_times=None, tolerance=0.5):
+    """
+    Edit distance alignment of the expected and the observed codes, an expected code without epoch is dropped,
+    an observed code without expected one is extra, equal codes match (a mismatch is a drop and an extra)
+    Every row of the cost table is computed at once: the extra codes only depend on the same row and are a
+    running minimum, cost[j] = min_k(best[k] + (j - k) * gap)
+    With the times of both (expected in s, observed in any linear scale, e.g. samples) the observed times are
+    fitted on the expected ones of a first alignment (medians, so a misaligned run of identical trials in it does
+    not count) and a second pass adds the timing error of every match
+    (capped at tolerance s, all errors together cost less than one edit), so timing only decides between
+    alignments with the same number of edits
+    Returns the matched index of every observed code in expected (-1 for extra codes) and the dropped expected indices
+    On equal cost a drop goes before a match, so of identical trials without timing the last ones are dropped
+    """
+    expected, observed = np.asarray(expected), np.asarray(observed)
+    matched, dropped = _traceback(_alignmentMoves(expected, observed, gap))
+    if expected_times is None or observed_times is None:
+        return matched, dropped
+
+    expected_times = np.asarray(expected_times, dtype=float)
+    observed_times = np.asarray(observed_times, dtype=float)
+    pairs = np.flatnonzero(matched >= 0)
+    pairs = pairs[np.isfinite(expected_times[matched[pairs]])]
+    if len(pairs) < 2:
+        return matched, dropped
+    # Rate and clock offset of the observed times from medians, so the pairs a first misalignment put off
+    # (a run of identical trials) do not count, then refitted on the pairs within tolerance for the drift
+    steps = np.diff(pairs) == 1
+    rates = np.diff(observed_times[pairs])[steps] / np.diff(expected_times[matched[pairs]])[steps]
+    rates = rates[np.isfinite(rates) & (rates > 0)]
+    if not len(rates):
+        return matched, dropped
+    slope = np.median(rates)
+    intercept = np.median(observed_times[pairs] - slope * expected_times[matched[pairs]])
+    errors = np.abs((observed_times[pairs] - intercept) / slope - expected_times[matched[pairs]])
+    if (errors <= tolerance).sum() >= 2:
+        keep = pairs[errors <= tolerance]
+        slope, intercept = np.polyfit(expected_times[matched[keep]], observed_times[keep], 1)
+    observed_s = (observed_times - intercept) / slope
+
+    def timingCost(i):
+        # NaN times cost the cap
+        return np.fmin(np.abs(observed_s - expected_times[i]) / tolerance, 1) / (len(observed) + 1)
+
+    return _traceback(_alignmentMoves(expected, observed, gap, timingCost))
+
+
+def _alignmentMoves(expected, observed, gap, match_cost=None):
+    """
+    (n + 1, m + 1) table of the last move of the cheapest alignment of every prefix pair
+    match_cost(i) gives the extra cost of matching expected code i with each observed code
+    """
+    n, m = len(expected), len(observed)
+    moves = np.empty((n + 1, m + 1), dtype=np.int8)
+    moves[0] = EXTRA
+    columns = np.arange(m + 1) * gap
+    previous = columns.astype(float)
+    match = np.full(m + 1, np.inf)
+    extra = np.full(m + 1, np.inf)
+    for i in range(1, n + 1):
+        cost = 0 if match_cost is None else match_cost(i - 1)
+        match[1:] = np.where(observed == expected[i - 1], previous[:-1] + cost, np.inf)
+        drop = previous + gap
+        best = np.minimum(match, drop)
+        # Cheapest alignment that ends with extra codes, from any earlier column of this row
+        extra[1:] = np.minimum.accumulate(best - columns)[:-1] + columns[1:]
+        moves[i] = np.where(best <= extra, np.where(drop <= match, DROPPED, MATCH), EXTRA)
+        previous = np.minimum(best, extra)
+
+    return moves
+
+
+def _traceback(moves):
+    """
+    Matched expected index of every observed code and the dropped expected indices of a move table
+    """
+    n, m = moves.shape[0] - 1, moves.shape[1] - 1
+    matched = np.full(m, -1)
+    dropped = []
+    i, j = n, m
+    while i > 0 or j > 0:
+        move = moves[i, j]
+        if move == MATCH:
+            matched[j - 1] = i - 1
+            i, j = i - 1, j - 1
+        elif move == DROPPED:
+            dropped.append(i - 1)
+            i -= 1
+        else:
+            j -= 1
+
+    return matched, np.array(dropped[::-1], dtype=int)
+
+
+def trialTimes(behav_data):
+    """
+    (trials, 5) expected times (s, experiment clock) of the codes of trialCodes(), None without the timing columns
+    The stimulus onsets (t_stim_*) are relative to the trial start and the trial is logged (experiment_time_s)
+    a fixed inter-trial interval after the fourth stimulus
+    """
+    columns = [f't_stim_{stimulus + 1}' for stimulus in range(N_STIMULI)]
+    if 'experiment_time_s' not in behav_data or not set(columns) <= set(behav_data):
+        return None
+    onsets = np.hstack([np.zeros((len(behav_data), 1)), behav_data[columns].to_numpy(dtype=float)]) / 1000
+
+    return behav_data['experiment_time_s'].to_numpy(dtype=float)[:, np.newaxis] + onsets - onsets[:, -1:]
+
+
+def alignMetadata(events, behav_data):
+    """
+    Per epoch metadata (one row per event) from the behavioural data of a subject (one row per trial)
+    The event samples are aligned on the trial times when behav_data has them (trialTimes())
+    Returns the metadata and the dropped events (trial row, stimulus, expected code)
+    """
+    behav_data = behav_data.reset_index(drop=True).copy()
+    behav_data['precedes_odd'] = behav_data['expected'].shift(-1).eq('odd').astype(int)
+    expected = trialCodes(behav_data['start_position'], behav_data['trial_direction'])
+    times = trialTimes(behav_data)
+    events = np.asarray(events)
+    matched, dropped = alignCodes(expected.ravel(), events[:, 2], expected_times=None if times is None else times.ravel(),
+                                  observed_times=events[:, 0])
+
+    trial_rows, stimulus = np.divmod(np.arange(expected.size), N_STIMULI + 1)
+    n_dropped = np.bincount(trial_rows[dropped], minlength=len(behav_data))
+    aligned = matched >= 0
+    metadata = behav_data.reindex(np.where(aligned, trial_rows[matched], -1)).reset_index(drop=True)
+    metadata['stimulus'] = np.where(aligned, stimulus[matched], -1)
+    metadata['expected_code'] = np.where(aligned, expected.ravel()[matched], -1)
+    metadata['aligned'] = aligned
+    metadata['n_dropped'] = np.where(aligned, n_dropped[trial_rows[matched]], -1)
+    metadata['trial_complete'] = metadata['n_dropped'] == 0
+    dropped = pd.DataFrame({'trial_row': trial_rows[dropped], 'stimulus': stimulus[dropped],
+                            'expected_code': expected.ravel()[dropped]})
+
+    return metadata, dropped
+
+
+def alignSubjects(subjects, raw_data_dir, cleaned_data_dir, save=True):
+    """
+    alignMetadata() for the unpaired epochs of every subject, saved as main_eventset_mastoidref_<sub>-epo.fif
+    Returns a report per subject (trials, epochs, dropped stimuli, extra epochs)
+    """
+    report = []
+    for sub in subjects:
+        behav_data = pd.read_csv(os.path.join(raw_data_dir, f'sub_{sub}/behav/predatt_participant_{sub}.csv'))
+        epoch = mne.read_epochs(os.path.join(cleaned_data_dir, f'unpaired/main_clean_mastoidref_{sub:02}-epo.fif'),
+                                verbose='error')
+        metadata, dropped = alignMetadata(epoch.events, behav_data)
+        epoch.metadata = metadata
+        if save:
+            epoch.save(os.path.join(cleaned_data_dir, f'main_eventset_mastoidref_{sub:02}-epo.fif'), overwrite=True)
+        report.append({'subject': sub, 'trials': len(behav_data), 'epochs': len(epoch),
+                       'dropped': len(dropped), 'extra': int((~metadata['aligned']).sum()),
+                       'dropped_stimuli': list(zip(dropped['trial_row'], dropped['stimulus']))})
+        print(f'subject {sub}: {len(epoch)} epochs, {len(dropped)} dropped, '
+              f'{report[-1]["extra"]} without behavioural row')
+
+    return pd.DataFrame(report)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add the aligned behavioural metadata to the epochs of every subject')
+    parser.add_argument('--raw-data-dir', default='C:/Users/mvmigem/Documents/data/project_1/raw_data/')
+    parser.add_argument('--cleaned-data-dir', default='C:/Users/mvmigem/Documents/data/project_1/preprocessed/mastoid_ref/')
+    parser.add_argument('--subjects', type=int, nargs='*', default=[sub for sub in range(1, 27) if sub != 20])
+    parser.add_argument('--dry-run', action='store_true', help='only print the report')
+    args = parser.parse_args()
+
+    alignSubjects(args.subjects, args.raw_data_dir, args.cleaned_data_dir, save=not args.dry_run)
@@ -0,0 +1,416 @@
+"""
+Streaming version of online_preprocess.ipynb for the C1 localiser
+Follows the BDF while ActiView is still writing it (or a replay of a recorded BDF over a local socket),
+re-references, filters and decimates every chunk with causal filters and keeps running averages per
+position (triggers 80-83) as the trials come in
+When the localiser ends (trigger 201) the recommended quadrant is printed as soon as the epochs of the last
+trials are complete (or the stream stops), it is the value for the 'Localised Quadrant' field of predatt_exp_psychopy.py
+
+    python online_localiser.py                          # waits for the next BDF in the localiser_dat folder
+    python online_localiser.py --bdf C:/Users/mvmigem/Documents/data/project_1/localiser_dat/loc_12.bdf
+    python online_localiser.py --replay loc_12.bdf --speed 8
+
+The recommendation is the quadrant with the largest mean absolute amplitude 50-100 ms after onset
+over the occipital channels of the notebook plots, check the printed averages before using it
+The causal filters delay the signal by a few ms compared to the notebook, all positions the same
+"""
+
+import argparse
+import glob
+import os
+import socket
+import threading
+import time
+import numpy as np
+from scipy import signal
+import mne
+from evoked_accumulator import EvokedAccumulator
+
+
+# Localiser triggers (80 + quadrant, see fieldLocalizer() in c1_localizer.py)
+POSITION_CODES = {80: 0, 81: 1, 82: 2, 83: 3}
+END_CODE = 201   # end of the recording
+# Channels of the notebook plots
+C1_PICKS = ['Pz', 'POz', 'Oz', 'PO3', 'PO4', 'O1', 'O2']
+
+
+####################################################
+#BDF stream
+####################################################
+
+class BdfStream:
+    """
+    Decodes a BDF that arrives in pieces (growing file or socket)
+    feed() takes the next bytes and returns the complete data records among them as
+    (data (channels, samples) in physical units (uV for the EEG), status (samples,) trigger codes)
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self.header = None
+        self.n_samples = 0   # samples per channel decoded so far
+
+    def _parseHeader(self):
+        if len(self._buffer) < 256:
+            return False
+        header_bytes = int(self._buffer[184:192].decode('ascii'))
+        if len(self._buffer) < header_bytes:
+            return False
+        n_channels = int(self._buffer[252:256].decode('ascii'))
+
+        def field(offset, width):
+            values = self._buffer[offset:offset + n_channels*width].decode('ascii', 'replace')
+            return [values[i*width:(i+1)*width].strip() for i in range(n_channels)], offset + n_channels*width
+
+        offset = 256
+        labels, offset = field(offset, 16)
+        offset += n_channels * (80 + 8)   # transducer, physical dimension
+        phys_min, offset = field(offset, 8)
+        phys_max, offset = field(offset, 8)
+        dig_min, offset = field(offset, 8)
+        dig_max, offset = field(offset, 8)
+        offset += n_channels * 80   # prefilter
+        samples_per_record, offset = field(offset, 8)
+        samples_per_record = np.array(samples_per_record, dtype=int)
+        if np.any(samples_per_record != samples_per_record[0]):
+            raise ValueError('channels with different sampling rates are not supported')
+
+        phys_min, phys_max = np.array(phys_min, dtype=float), np.array(phys_max, dtype=float)
+        dig_min, dig_max = np.array(dig_min, dtype=float), np.array(dig_max, dtype=float)
+        gain = (phys_max - phys_min) / (dig_max - dig_min)
+        record_duration = float(self._buffer[244:252].decode('ascii'))
+        self.header = {'labels': labels, 'n_channels': n_channels,
+                       'samples_per_record': int(samples_per_record[0]),
+                       'sfreq': samples_per_record[0] / record_duration,
+                       'gain': gain, 'offset': phys_min - dig_min*gain,
+                       'status': labels.index('Status') if 'Status' in labels else None}
+        self.record_bytes = n_channels * samples_per_record[0] * 3
+        del self._buffer[:header_bytes]
+        return True
+
+    def feed(self, data):
+        self._buffer += data
+        if self.header is None and not self._parseHeader():
+            return None
+        n_records = len(self._buffer) // self.record_bytes
+        if n_records == 0:
+            return None
+
+        raw_bytes = np.frombuffer(bytes(self._buffer[:n_records*self.record_bytes]), dtype=np.uint8)
+        del self._buffer[:n_records*self.record_bytes]
+        # Records hold the samples of one channel after the other, 24 bit little endian
+        raw_bytes = raw_bytes.reshape(n_records, self.header['n_channels'], self.header['samples_per_record'], 3).astype(np.int32)
+        values = raw_bytes[..., 0] | (raw_bytes[..., 1] << 8) | (raw_bytes[..., 2] << 16)
+        values = values.transpose(1, 0, 2).reshape(self.header['n_channels'], -1)
+        signed = np.where(values >= 2**23, values - 2**24, values)
+        data = signed * self.header['gain'][:, np.newaxis] + self.header['offset'][:, np.newaxis]
+        # The triggers are the lower 16 bits of the status channel
+        status = None
+        if self.header['status'] is not None:
+            status = values[self.header['status']] & 0xFFFF
+        self.n_samples += data.shape[1]
+
+        return data, status
+
+
+def tailFile(path, poll=.05, idle=10., chunk_size=2**20):
+    """
+    Yields the bytes of a file as it is written, stops when it has not grown for idle seconds
+    """
+    last_growth = time.time()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk:
+                last_growth = time.time()
+                yield chunk
+                continue
+            if idle is not None and time.time() - last_growth > idle:
+                return
+            time.sleep(poll)
+
+
+def socketChunks(host='localhost', port=8765, chunk_size=2**16):
+    """
+    Yields the bytes sent over a TCP connection until it is closed
+    """
+    with socket.create_connection((host, port)) as connection:
+        while True:
+            chunk = connection.recv(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def replayBdf(path, port=8765, speed=1., chunk_s=.0625):
+    """
+    Serve a recorded BDF over a local TCP socket at speed x real time (one connection),
+    the header first and then the data records in chunks of chunk_s seconds
+    Returns the server thread
+    """
+    server = socket.create_server(('localhost', port))
+
+    def serve():
+        with open(path, 'rb') as f, server:
+            connection, address = server.accept()
+            header = f.read(256)
+            header += f.read(int(header[184:192]) - 256)
+            connection.sendall(header)
+            stream = BdfStream()
+            stream.feed(header)
+            record_s = stream.header['samples_per_record'] / stream.header['sfreq']
+            n_records = max(int(round(chunk_s / record_s)), 1)
+            t0 = time.perf_counter()
+            sent_s = 0.
+            while True:
+                chunk = f.read(n_records * stream.record_bytes)
+                if not chunk:
+                    break
+                connection.sendall(chunk)
+                sent_s += n_records * record_s
+                time.sleep(max(t0 + sent_s / speed - time.perf_counter(), 0))
+            connection.close()
+
+    thread = threading.Thread(target=serve, name='bdf_replay', daemon=True)
+    thread.start()
+    return thread
+
+
+def waitForNewFile(directory, started, poll=.5, pattern='*.bdf'):
+    """
+    Path of the first BDF created in directory after started (time.time())
+    """
+    print(f'waiting for a new BDF in {directory}')
+    while True:
+        new_files = [path for path in glob.glob(os.path.join(directory, pattern)) if os.path.getctime(path) > started]
+        if new_files:
+            return max(new_files, key=os.path.getctime)
+        time.sleep(poll)
+
+
+####################################################
+#Online processing
+####################################################
+
+class OnlineLocaliser:
+    """
+    Causal preprocessing of the localiser chunks and running averages per position
+    Same steps as online_preprocess.ipynb: mastoid reference, anti-alias low-pass and decimation to about
+    256 Hz, 50 Hz notch and 0.1 Hz high-pass, epochs from tmin to tmax with baseline correction
+    Epochs with a vertical eog range over reject_eog_uv (blinks) are left out
+    """
+    def __init__(self, header, desired_sfreq=256, tmin=-0.1, tmax=0.5, reject_eog_uv=150.):
+        labels = header['labels']
+        self.decim = int(np.round(header['sfreq'] / desired_sfreq))
+        self.sfreq = header['sfreq'] / self.decim
+        lowpass_freq = self.sfreq / 3.
+        self.ch_names = mne.channels.make_standard_montage('biosemi64').ch_names
+        self._cap = np.arange(64)
+        self._mastoids = [labels.index('EXG5'), labels.index('EXG6')]
+        self._eog = [labels.index('EXG1'), labels.index('EXG2')]   # eye above, eye below
+        self.times = np.arange(int(round(tmin * self.sfreq)), int(round(tmax * self.sfreq)) + 1) / self.sfreq
+        self._first = int(round(tmin * self.sfreq))
+        self._baseline = self.times <= 0
+        self.reject_eog_uv = reject_eog_uv
+
+        # Causal filters, the state is kept between chunks
+        self._lowpass = signal.butter(4, lowpass_freq, 'lowpass', fs=header['sfreq'], output='sos')
+        notch = signal.tf2sos(*signal.iirnotch(50., 30., fs=self.sfreq))
+        self._highpass = np.vstack([signal.butter(2, 0.1, 'highpass', fs=self.sfreq, output='sos'), notch])
+        self._lowpass_zi = self._highpass_zi = None
+
+        self._phase = 0   # full rate samples to skip before the next kept sample
+        self._n_full = 0   # full rate samples processed
+        self._data = np.zeros((65, 0))   # decimated cap channels and vertical eog, from sample _start
+        self._start = 0
+        self._last_code = 0
+        self._pending = []   # (decimated sample, position) of the events not epoched yet
+        self.accumulator = EvokedAccumulator(self.ch_names, self.times)   # uV, conditions 'position1' to 'position4'
+        self.rejected = np.zeros(4, dtype=int)
+        self.finished = False   # the end code came in, the epochs of the last events can still be waiting for data
+
+    def process(self, data, status):
+        """
+        Add a chunk (channels, samples) of the stream, returns the number of new epochs
+        """
+        reference = data[self._mastoids].mean(axis=0)
+        chunk = np.vstack([data[self._cap] - reference, data[self._eog[0]] - data[self._eog[1]]])
+        if self._lowpass_zi is None:
+            # Start the filters as if the first sample had always been there (no step at the start)
+            self._lowpass_zi = signal.sosfilt_zi(self._lowpass)[:, np.newaxis] * chunk[:, 0][np.newaxis, :, np.newaxis]
+        chunk, self._lowpass_zi = signal.sosfilt(self._lowpass, chunk, zi=self._lowpass_zi)
+        chunk = chunk[:, self._phase::self.decim]
+        self._phase = (self._phase - data.shape[1]) % self.decim
+        if chunk.shape[1]:
+            if self._highpass_zi is None:
+                self._highpass_zi = signal.sosfilt_zi(self._highpass)[:, np.newaxis] * chunk[:, 0][np.newaxis, :, np.newaxis]
+            chunk, self._highpass_zi = signal.sosfilt(self._highpass, chunk, zi=self._highpass_zi)
+            self._data = np.hstack([self._data, chunk])
+
+        if status is not None:
+            # Onsets are the samples where the trigger code changes to a new non zero value
+            codes = np.concatenate([[self._last_code], status])
+            onsets = np.flatnonzero((codes[1:] != codes[:-1]) & (codes[1:] != 0))
+            for onset in onsets:
+                code = int(status[onset])
+                if code in POSITION_CODES:
+                    sample = (self._n_full + onset + self.decim // 2) // self.decim
+                    self._pending.append((sample, POSITION_CODES[code]))
+                elif code == END_CODE:
+                    self.finished = True
+            self._last_code = status[-1]
+        self._n_full += data.shape[1]
+
+        return self._epoch()
+
+    def _epoch(self):
+        n_new = 0
+        end = self._start + self._data.shape[1]
+        pending = []
+        for sample, position in self._pending:
+            first = sample + self._first - self._start
+            if first + len(self.times) > end - self._start:
+                pending.append((sample, position))
+                continue
+            n_new += 1
+            if first < 0:   # before the start of the stream
+                self.rejected[position] += 1
+                continue
+            epoch = self._data[:, first:first + len(self.times)]
+            epoch = epoch - epoch[:, self._baseline].mean(axis=1, keepdims=True)
+            if np.ptp(epoch[-1]) > self.reject_eog_uv:
+                self.rejected[position] += 1
+                continue
+            self.accumulator.add(f'position{position+1}', epoch[:-1])
+        self._pending = pending
+
+        # Only keep what the pending and next epochs still need
+        # (an event in the next chunk can be rounded to the last sample of this one)
+        keep_from = min([sample + self._first for sample, position in pending] + [end + self._first - 1])
+        if keep_from > self._start:
+            self._data = self._data[:, keep_from - self._start:]
+            self._start = keep_from
+
+        return n_new
+
+    @property
+    def complete(self):
+        """
+        True when the localiser ended and every event before the end code has been epoched
+        """
+        return self.finished and not self._pending
+
+    def flush(self):
+        """
+        End of the stream: epochs every pending event with a full window in the data, the events without one
+        (the recording stopped less than tmax after them) are counted as rejected
+        Returns the number of new epochs
+        """
+        n_new = self._epoch()
+        for sample, position in self._pending:
+            self.rejected[position] += 1
+        self._pending = []
+
+        return n_new
+
+    @property
+    def counts(self):
+        return np.array([self.accumulator.count(f'position{position+1}') for position in range(4)])
+
+    def evokeds(self):
+        """
+        Running average per position (4, channels, times) in uV, nan for positions without epochs
+        """
+        return np.array([self.accumulator.mean(f'position{position+1}') for position in range(4)])
+
+    def scores(self, picks=C1_PICKS, window=(0.05, 0.1)):
+        """
+        Mean absolute amplitude (uV) in the C1 window over picks per position
+        """
+        channels = [self.ch_names.index(pick) for pick in picks]
+        in_window = (self.times >= window[0]) & (self.times <= window[1])
+        amplitude = self.evokeds()[:, channels][:, :, in_window].mean(axis=2)
+
+        return np.abs(amplitude).mean(axis=1)
+
+    def recommendation(self, min_epochs=5):
+        """
+        Quadrant with the largest C1 score among the positions with at least min_epochs epochs (None if there is none)
+        """
+        scores = np.where(self.counts >= min_epochs, self.scores(), -np.inf)
+        if not np.isfinite(scores).any():
+            return None
+        return int(np.argmax(scores))
+
+    def evokedArrays(self):
+        """
+        The running averages as mne.EvokedArray per position, for mne.viz.plot_compare_evokeds
+        """
+        info = mne.create_info(self.ch_names, self.sfreq, 'eeg')
+        info.set_montage('biosemi64')
+        return {f'position{position+1}': mne.EvokedArray(self.evokeds()[position] * 1e-6, info, tmin=self.times[0],
+                                                          nave=int(self.counts[position]))
+                for position in range(4) if self.counts[position]}
+
+
+def printStatus(localiser):
+    scores = localiser.scores()
+    print('  '.join(f'pos{position+1}: {localiser.counts[position]:3d} ep ({localiser.rejected[position]} rej) '
+                    f'{scores[position]:5.2f} uV' for position in range(4)))
+
+
+def runLocaliser(chunks, report_every=8):
+    """
+    Process a stream of BDF bytes until the localiser ends and the last epochs are complete (or the stream stops)
+    Returns the OnlineLocaliser with the running averages
+    """
+    stream = BdfStream()
+    localiser = None
+    n_epochs = 0
+    for chunk in chunks:
+        decoded = stream.feed(chunk)
+        if decoded is None:
+            continue
+        if localiser is None:
+            localiser = OnlineLocaliser(stream.header)
+            print(f'{stream.header["n_channels"]} channels at {stream.header["sfreq"]:.0f} Hz, '
+                  f'processed at {localiser.sfreq:.0f} Hz')
+        new = localiser.process(*decoded)
+        if (n_epochs + new) // report_every > n_epochs // report_every:
+            printStatus(localiser)
+        n_epochs += new
+        if localiser.complete:
+            break
+    if localiser is not None:
+        localiser.flush()
+
+    return localiser
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Follow the C1 localiser BDF and recommend the quadrant')
+    parser.add_argument('--directory', default='C:/Users/mvmigem/Documents/data/project_1/localiser_dat/',
+                        help='folder where ActiView writes the localiser BDF')
+    parser.add_argument('--bdf', default=None, help='follow this BDF instead of waiting for a new one')
+    parser.add_argument('--replay', default=None, help='replay a recorded BDF over a local socket')
+    parser.add_argument('--speed', type=float, default=1., help='replay speed (x real time)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--idle', type=float, default=10., help='stop when the BDF has not grown for this many s')
+    parser.add_argument('--min-epochs', type=int, default=5)
+    args = parser.parse_args()
+
+    started = time.time()
+    if args.replay:
+        replayBdf(args.replay, args.port, args.speed)
+        chunks = socketChunks(port=args.port)
+    else:
+        path = args.bdf or waitForNewFile(args.directory, started)
+        print(f'following {path}')
+        chunks = tailFile(path, idle=args.idle)
+
+    localiser = runLocaliser(chunks)
+    if localiser is None:
+        raise RuntimeError('no data records received')
+    printStatus(localiser)
+    quadrant = localiser.recommendation(args.min_epochs)
+    print(f'{"localiser ended" if localiser.finished else "stream stopped"} after {time.time() - started:.1f} s')
+    print(f'Localised Quadrant: {quadrant}')
@@ -0,0 +1,219 @@
+"""
+Batch version of preprocessing_proj1.ipynb for the main experiment
+Runs rename -> re-reference -> montage -> notch -> high-pass -> interpolate -> blink and gap annotation
+-> ICA -> epoch
+for every subject in the manifest (rejected_channels.npy / <reference>_rejected_ica.npy) in a process pool
+and prints the time every step took
+
+    python preprocess_batch.py --data-directory C:/Users/mvmigem/Documents/data/project_1/ --jobs 4
+    python preprocess_batch.py --subjects 3 4 26 --reference average
+
+Like the notebook the continuous data is filtered and saved at the recorded rate and only the epochs are
+decimated, deconvolution.jl, overlap_correction.py and the overlap corrected plots read the cleaned raw at that rate
+--early-decim low-passes and decimates the raw to 256 Hz right after loading (decimateRaw()), the filters and ICA
+then run on 2x less samples of a 512 Hz recording, but the saved raw is at 256 Hz and the deconvolution
+has to be told so
+
+The bad channels and ICA components are chosen in the notebook, this script does not plot anything
+The ICA components in the manifest are only applied with the ICA they were chosen on (saved by the notebook in
+preprocessed/<reference>_ica/), a new fit has other components. A subject without saved ICA fails, with
+--fit-missing-ica its ICA is fitted and saved in preprocessed/<reference>_ica/review/ for the notebook and
+nothing else is written, the cleaned files are never made with a refitted ICA
+With --cache-dir the output of every step is cached (stage_cache.py), e.g. a new ICA exclusion list
+only reruns the ICA apply and epoching
+
+    python preprocess_batch.py --cache-dir C:/Users/mvmigem/Documents/data/project_1/cache/ --cache-gb 200
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+import mne
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from preprocessing_tools import (loadManifest, renameChannels, rereference, setMontage, downsamplingParams,
+                                 decimateRaw, notchFilter, bandpassFilter, interpolateBads, annotateBlinks,
+                                 annotateCalibrationGaps, fitIca, applyIca, selectEventId, epochStimLocked)
+from stage_cache import StageCache, NoCache, mergeStats, printStats
+
+
+# Reference settings as used in the notebook
+REFERENCES = {'mastoid': {'ref_channels': ['M1','M2'], 'ica_file': 'mastoid_rejected_ica.npy',
+                          'raw_out': 'preprocessed/mastoid_raw/main_clean_mastoidref_{sub:02}-raw.fif',
+                          'epochs_out': 'preprocessed/mastoid_ref/unpaired/main_clean_mastoidref_{sub:02}-epo.fif'},
+              'average': {'ref_channels': 'average', 'ica_file': 'average_rejected_ica.npy',
+                          'raw_out': 'preprocessed/average_raw/main_clean_averageref_{sub:02}-raw.fif',
+                          'epochs_out': 'preprocessed/average_ref/unpaired/main_clean_averageref_{sub:02}-epo.fif'}}
+
+STAGES = ['load', 'decimate', 'filter', 'clean', 'ica_fit', 'ica_apply', 'epoch', 'save']
+
+
+def loadRaw(bdf_path, ref_channels):
+    """
+    BDF with renamed channels, the new reference and the montage
+    """
+    raw = mne.io.read_raw_bdf(bdf_path, preload = True)
+    renameChannels(raw)
+    rereference(raw, ref_channels)
+    setMontage(raw)
+
+    return raw
+
+
+def processSubject(sub, data_directory, bads, exclude_ica, reference='mastoid', random_state=None,
+                   cache_directory=None, cache_gb=100., early_decim=False, fit_missing_ica=False):
+    """
+    Preprocess one subject from the BDF to the saved raw and epoch files
+    Every subject is independent, so this can run in its own process
+    exclude_ica is applied with the saved ICA of the subject only, without one the subject fails or with
+    fit_missing_ica a new ICA is fitted and saved for review and no raw or epoch file is written
+    With a cache_directory the output of every step is kept (see stage_cache.py) and only the steps
+    after a changed input or parameter are recomputed
+    With early_decim the raw data is decimated before the notch filter instead of at the epoching, the saved
+    raw is then at the decimated rate
+    Returns the subject number, the duration (s) of every step and the cache stats
+    """
+    mne.set_log_level('error')
+    settings = REFERENCES[reference]
+    cache = StageCache(cache_directory, max_gb=cache_gb) if cache_directory else NoCache()
+    bdf_path = data_directory + f'raw_data/sub_{sub}/eeg/main_{sub}.bdf'
+    behav_data = pd.read_csv(data_directory + f'raw_data/sub_{sub}/behav/predatt_participant_{sub}.csv')
+    ica_path = data_directory + f'preprocessed/{reference}_ica/sub_{sub:02}-ica.fif'
+    # Only the header is needed for the filter settings
+    decim, lowpass_freq = downsamplingParams(mne.io.read_raw_bdf(bdf_path, preload = False).info['sfreq'])
+
+    # Keys of every step (hash of the input and the parameters of all steps before it),
+    # a step only loads the steps before it when it is not in the cache
+    params = {'load': {'reference': settings['ref_channels']},
+              'decimate': {'decim': int(decim), 'h_freq': lowpass_freq},
+              'filter': {'notch': 50, 'l_freq': 0.1, 'h_freq': lowpass_freq},
+              'ica_fit': {'bads': sorted(bads), 'blinks': {'before': 0.25, 'duration': 0.5},
+                          'gap_threshold_ms': 1000, 'n_components': 0.99},
+              'ica_apply': {'exclude': sorted(exclude_ica)},
+              'epoch': {'event_id': selectEventId(behav_data), 'tmin': -0.5, 'tmax': 0.5, 'decim': int(decim)}}
+    parents = {'load': 'bdf', 'decimate': 'load', 'filter': 'load', 'ica_fit': 'filter', 'ica_apply': 'ica_fit', 'epoch': 'ica_apply'}
+    if early_decim:
+        # The low-pass is part of the decimation, the epochs are already at the final rate
+        params['filter']['h_freq'] = None
+        params['epoch']['decim'] = 1
+        parents['filter'] = 'decimate'
+    keys = {'bdf': cache.fileKey(bdf_path)}
+    results = {}
+
+    def key(stage):
+        if stage not in keys:
+            keys[stage] = cache.key(stage, key(parents[stage]), params[stage])
+        return keys[stage]
+
+    def result(stage, kind, compute):
+        if stage not in results:
+            results[stage] = cache.run(stage, key(parents[stage]), params[stage], kind, compute)[0]
+        return results[stage]
+
+    def loaded():
+        return result('load', 'raw', lambda: loadRaw(bdf_path, settings['ref_channels']))
+
+    def decimated():
+        return result('decimate', 'raw', lambda: decimateRaw(loaded().copy(), decim, lowpass_freq)[0])
+
+    def filtered():
+        before = decimated if early_decim else loaded
+        return result('filter', 'raw', lambda: bandpassFilter(notchFilter(before().copy()), params['filter']['h_freq']))
+
+    def cleaned():
+        # Interpolation and blink/gap annotation are cheap, their settings are part of the ICA keys
+        if 'clean' not in results:
+            def clean():
+                raw = annotateBlinks(interpolateBads(filtered().copy(), bads))
+                return annotateCalibrationGaps(raw, mne.find_events(raw))
+            results['clean'] = cache.timed('clean', clean)
+        return results['clean']
+
+    # The component numbers of the manifest only mean something for the ICA they were chosen on,
+    # a new fit is saved apart for the notebook and never applied
+    if not os.path.isfile(ica_path):
+        if not fit_missing_ica:
+            raise FileNotFoundError(f'no saved ICA for subject {sub} ({ica_path}), the manifest components '
+                                    'can not be applied to a new fit (--fit-missing-ica fits one for review)')
+        review_path = data_directory + f'preprocessed/{reference}_ica/review/sub_{sub:02}-ica.fif'
+        ica = cache.timed('ica_fit', lambda: fitIca(cleaned(), random_state=random_state))
+        os.makedirs(os.path.dirname(review_path), exist_ok=True)
+        ica.save(review_path, overwrite=True)
+        print(f'subject {sub}: new ICA in {review_path}, choose its components in the notebook and save it '
+              f'as {ica_path}')
+        timings = {stage: values['seconds'] for stage, values in cache.stats.items()}
+        return sub, timings, cache.stats
+    params['ica_fit']['saved_ica'] = cache.fileKey(ica_path)
+
+    def fitted():
+        return result('ica_fit', 'ica', lambda: mne.preprocessing.read_ica(ica_path))
+
+    raw = result('ica_apply', 'raw', lambda: applyIca(cleaned().copy(), fitted(), exclude_ica))
+    epochs_stimlock = result('epoch', 'epochs', lambda: epochStimLocked(raw, mne.find_events(raw),
+                                                                        params['epoch']['event_id'],
+                                                                        params['epoch']['decim']))
+
+    def save():
+        for data, out in [(raw, settings['raw_out']), (epochs_stimlock, settings['epochs_out'])]:
+            out_path = data_directory + out.format(sub=sub)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            data.save(out_path, overwrite=True)
+    cache.timed('save', save)
+    timings = {stage: values['seconds'] for stage, values in cache.stats.items()}
+
+    return sub, timings, cache.stats
+
+
+def printTimings(timings):
+    """
+    Table with the duration (s) of every step per subject and the total per step
+    """
+    print('sub  ' + ' '.join('%9s' % stage[:9] for stage in STAGES) + '     total')
+    for sub, stages in sorted(timings.items()):
+        print('%3d  ' % sub + ' '.join('%9.1f' % stages.get(stage, np.nan) for stage in STAGES)
+              + '%10.1f' % sum(stages.values()))
+    totals = [sum(stages.get(stage, 0) for stages in timings.values()) for stage in STAGES]
+    print('sum  ' + ' '.join('%9.1f' % total for total in totals) + '%10.1f' % sum(totals))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocess the main experiment EEG of all subjects in parallel')
+    parser.add_argument('--data-directory', default='C:/Users/mvmigem/Documents/data/project_1/')
+    parser.add_argument('--subjects', type=int, nargs='*', help='subject numbers (default: all in the manifest)')
+    parser.add_argument('--reference', choices=list(REFERENCES), default='mastoid')
+    parser.add_argument('--jobs', type=int, default=2,
+                        help='number of processes (every one holds a full BDF in memory)')
+    parser.add_argument('--random-state', type=int, default=None, help='seed for ICA fits that are not saved yet')
+    parser.add_argument('--fit-missing-ica', action='store_true',
+                        help='fit the ICA of subjects without saved ICA and save it for review (nothing else is written)')
+    parser.add_argument('--cache-dir', default=None, help='keep the output of every step here (default: no cache)')
+    parser.add_argument('--cache-gb', type=float, default=100., help='size limit of the cache')
+    parser.add_argument('--early-decim', action='store_true',
+                        help='decimate the raw before the filters (the saved raw is then at 256 Hz)')
+    args = parser.parse_args()
+
+    data_directory = os.path.join(args.data_directory, '')
+    manifest = loadManifest(data_directory, REFERENCES[args.reference]['ica_file'])
+    subjects = args.subjects or list(manifest)
+    missing = [sub for sub in subjects if sub not in manifest]
+    if missing:
+        raise ValueError(f'no rejected channels/ICA components in the manifest for subjects {missing}')
+
+    timings, stats = {}, []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(processSubject, sub, data_directory, manifest[sub]['bads'], manifest[sub]['exclude_ica'],
+                               args.reference, args.random_state, args.cache_dir, args.cache_gb,
+                               args.early_decim, args.fit_missing_ica): sub for sub in subjects}
+        for future in as_completed(futures):
+            try:
+                sub, timings[sub], sub_stats = future.result()
+                stats.append(sub_stats)
+                print(f'subject {sub} done ({sum(timings[sub].values()):.1f} s)')
+            except Exception as error:
+                print(f'subject {futures[future]} failed: {error!r}')
+    printTimings(timings)
+    if args.cache_dir:
+        printStats(mergeStats(stats))
+    print(f'{len(timings)}/{len(subjects)} subjects in {time.perf_counter() - start:.1f} s with {args.jobs} processes')
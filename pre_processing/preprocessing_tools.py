@@ -0,0 +1,257 @@
+"""
+The steps of preprocessing_proj1.ipynb as functions, so the main experiment data can be
+preprocessed without the notebook (see preprocess_batch.py)
+The channels and ICA components to reject are the ones chosen in the notebook
+(rejected_channels.npy and <reference>_rejected_ica.npy in the data directory)
+"""
+
+import numpy as np
+import mne
+
+
+####################################################
+#Settings of the main experiment
+####################################################
+
+# External electrodes of the biosemi cap
+FIX_CHANS = {'EXG1':'eye_above','EXG2':'eye_below',
+             'EXG3':'eye_left','EXG4':'eye_right',
+             'EXG5':'M1','EXG6':'M2'}
+CHANNEL_TYPES = {'M1':'eeg', 'M2':'eeg',
+                 'eye_above':'eog', 'eye_below':'eog',
+                 'eye_left':'eog', 'eye_right': 'eog'}
+
+# Event dicts, the sequences of a subject depend on the localised quadrant (start position)
+EVENT_ID_EVEN = {'start_trial':99, 'pos1/seq':11, 'pos1/seq3':13,
+                 'pos2/seq2':22, 'pos2/seq4':24,
+                 'pos3/seq1':31, 'pos3/seq3':33,
+                 'pos4/seq2':42, 'pos4/seq4':44}   # start positions 0 and 2
+EVENT_ID_ODD = {'start_trial':99, 'pos1/seq2':12, 'pos1/seq4':14,
+                'pos2/seq1':21, 'pos2/seq3':23,
+                'pos3/seq2':32, 'pos3/seq4':34,
+                'pos4/seq1':41, 'pos4/seq3':43}   # start positions 1 and 3
+
+
+####################################################
+#Manifest
+####################################################
+
+def loadRejections(path):
+    """
+    Load one of the rejection files (dict saved with np.save, keys 'subject_<nr>')
+    """
+    return np.load(path, allow_pickle=True)[..., np.newaxis][0]
+
+
+def loadManifest(data_directory, rejected_ica_file='mastoid_rejected_ica.npy'):
+    """
+    Bad channels and rejected ICA components per subject number
+    Only subjects that have both are returned
+    """
+    rejected_channels = loadRejections(data_directory + 'rejected_channels.npy')
+    rejected_ica = loadRejections(data_directory + rejected_ica_file)
+    manifest = {}
+    for key, exclude_ica in rejected_ica.items():
+        if key in rejected_channels:
+            sub = int(key.split('subject_')[1])
+            manifest[sub] = {'bads': list(rejected_channels[key]), 'exclude_ica': list(exclude_ica)}
+
+    return dict(sorted(manifest.items()))
+
+
+####################################################
+#Preprocessing steps
+####################################################
+
+def renameChannels(raw):
+    """
+    Rename the external electrodes, drop the unused ones (EXG7, EXG8) and set the channel types
+    """
+    raw.rename_channels(FIX_CHANS)
+    raw.drop_channels(['EXG7', 'EXG8'])
+    raw.set_channel_types(CHANNEL_TYPES)
+
+    return raw
+
+
+def rereference(raw, reference=['M1','M2']):
+    """
+    Rereference ('average' or a list of channels), the mastoids are dropped afterwards
+    """
+    raw.set_eeg_reference(ref_channels = reference)
+    raw.drop_channels(['M1','M2'])
+
+    return raw
+
+
+def setMontage(raw):
+    """
+    Rename the 64 cap channels to the biosemi64 names and set the montage
+    """
+    montage = mne.channels.make_standard_montage('biosemi64')
+    rename_channels = dict(zip(raw.info['ch_names'][:64], montage.ch_names))
+    raw.rename_channels(rename_channels)
+    raw.set_montage(montage)
+
+    return raw
+
+
+def downsamplingParams(sfreq, desired_sfreq=256):
+    """
+    Decimation factor for the epochs and the matching low-pass frequency
+    (logic -> https://mne.tools/stable/auto_tutorials/preprocessing/30_filtering_resampling.html#best-practices)
+    """
+    decim = np.round(sfreq / desired_sfreq).astype(int)
+    obtained_sfreq = sfreq / decim
+    lowpass_freq = obtained_sfreq / 3.
+
+    return decim, lowpass_freq
+
+
+def decimateRaw(raw, decim, lowpass_freq, events=None):
+    """
+    Anti-alias low-pass (lowpass_freq) and decimate the continuous data by decim, so the notch, high-pass,
+    interpolation, ICA and epoching run on the reduced data (epoch with decim=1 afterwards)
+    The events (found in raw when None) are remapped to the new sampling rate and written back into the
+    stim channel, so mne.find_events() on the decimated raw gives the same events
+    Returns the decimated raw and the remapped events
+    """
+    if events is None:
+        events = mne.find_events(raw)
+    raw.filter(l_freq=None, h_freq=lowpass_freq)
+    # The data has nothing left above the new nyquist frequency, the resampling only drops samples
+    raw, events = raw.resample(raw.info['sfreq'] / decim, events=events)
+    # Events closer than a pulse at the new rate end up on one sample (or a pulse find_events() skips),
+    # one of them would be lost without notice
+    close = np.flatnonzero(np.diff(events[:,0]) < 2)
+    if len(close):
+        raise ValueError(f'events less than 2 samples apart after decimating by {decim} ({len(close)}x, '
+                         f'first at sample {events[close[0],0]}: codes {events[close[0],2]} and '
+                         f'{events[close[0] + 1,2]}), decimate at the epoching instead')
+
+    # The resampled stim channel can move an event by a sample, write the remapped events instead
+    # (2 samples per pulse, mne.find_events() skips shorter ones)
+    stim = np.zeros(raw.n_times)
+    samples = events[:,0] - raw.first_samp
+    ends = np.minimum(np.append(samples[1:], raw.n_times), samples + 2)
+    for sample, end, code in zip(samples, ends, events[:,2]):
+        stim[sample:end] = code
+    stim_picks = mne.pick_types(raw.info, meg=False, stim=True)
+    if len(stim_picks):
+        raw[stim_picks[0], :] = stim
+
+    return raw, events
+
+
+def notchFilter(raw, freqs=50):
+    return raw.notch_filter(freqs = freqs, fir_design = 'firwin')
+
+
+def bandpassFilter(raw, lowpass_freq, highpass_freq=0.1):
+    """
+    Band-pass, lowpass_freq None only high-passes (after decimateRaw() the low-pass is already done)
+    """
+    return raw.filter(l_freq=highpass_freq, h_freq=lowpass_freq)
+
+
+def interpolateBads(raw, bads):
+    """
+    Mark the rejected channels as bad and interpolate them (they stay marked as bad)
+    """
+    raw.info['bads'] = list(bads)
+    if bads:
+        raw.interpolate_bads(reset_bads = False)
+
+    return raw
+
+
+def annotateBlinks(raw, before=0.25, duration=0.5):
+    """
+    Annotate the blinks found in the eog channels as 'bad blink', starting before s before the eog peak
+    The annotations are added to the ones of raw
+    """
+    eog_events = mne.preprocessing.find_eog_events(raw)
+    onsets = eog_events[:, 0] / raw.info['sfreq'] - before
+    if raw.annotations.orig_time is None:
+        onsets = onsets - raw.first_time
+    blink_annot = mne.Annotations(onsets, [duration] * len(eog_events), ['bad blink'] * len(eog_events),
+                                  orig_time = raw.annotations.orig_time)
+    raw.set_annotations(raw.annotations + blink_annot)
+
+    return raw
+
+
+def calibrationGapAnnotations(raw, events, threshold_ms=1000, trial_end=0.52):
+    """
+    bad_calibration_gap annotations for the gaps between events longer than threshold_ms (calibrations, breaks)
+    The gap starts trial_end s after the last event before it and ends one sample before the next event
+    All gaps are found at once and returned as one Annotations with the orig_time of raw (can be empty)
+    """
+    sfreq = raw.info['sfreq']
+    threshold_samples = int(threshold_ms / 1000 * sfreq)
+    event_times = events[:, 0]
+    gaps = np.flatnonzero(np.diff(event_times) > threshold_samples)
+    start_samples = event_times[gaps] + trial_end*sfreq
+    end_samples = event_times[gaps + 1] - 1
+    onsets = start_samples / sfreq
+    if raw.annotations.orig_time is None:   # onsets are relative to the first sample instead of the recording start
+        onsets = onsets - raw.first_time
+
+    return mne.Annotations(onset=onsets, duration=(end_samples - start_samples) / sfreq,
+                           description=['bad_calibration_gap'] * len(gaps), orig_time=raw.annotations.orig_time)
+
+
+def annotateCalibrationGaps(raw, events, threshold_ms=1000, trial_end=0.52):
+    """
+    Add the calibrationGapAnnotations() to the annotations of raw (e.g. the blinks are kept)
+    """
+    gap_annot = calibrationGapAnnotations(raw, events, threshold_ms, trial_end)
+    if len(gap_annot) == 0:
+        print("No gaps exceeding the threshold were found.")
+        return raw
+    raw.set_annotations(raw.annotations + gap_annot)
+
+    return raw
+
+
+def fitIca(raw, n_components=0.99, random_state=None, keep=('bad blink',)):
+    """
+    ICA fit without the bad spans of raw, except the annotations in keep: the blinks are what the ICA has to find,
+    so only the calibration gaps (and hand marked spans) are left out, like the fits the components were chosen on
+    The annotations of raw are the same afterwards
+    """
+    ica = mne.preprocessing.ICA(n_components = n_components, random_state=random_state)
+    annotations = raw.annotations
+    raw.set_annotations(annotations[~np.isin(annotations.description, keep)])
+    try:
+        ica.fit(raw, decim=2, verbose='error', reject_by_annotation=True)
+    finally:
+        raw.set_annotations(annotations)
+
+    return ica
+
+
+def applyIca(raw, ica, exclude_ica):
+    ica.exclude = list(exclude_ica)
+    ica.apply(raw)
+
+    return raw
+
+
+def selectEventId(behav_data):
+    """
+    Event dict of a subject, based on the start positions in the behavioural data
+    """
+    if behav_data['start_position'].isin([0, 2]).any():
+        return EVENT_ID_EVEN
+
+    return EVENT_ID_ODD
+
+
+def epochStimLocked(raw, events, event_id, decim, tmin=-0.5, tmax=0.5):
+    """
+    Epoch data around stim onset
+    """
+    return mne.Epochs(raw, events, event_id = event_id,
+                      tmin = tmin, tmax = tmax, proj = False, baseline = (None,0), decim=decim,
+                      detrend = None, verbose = True, reject_by_annotation= False, preload = True)
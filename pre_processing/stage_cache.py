@@ -0,0 +1,213 @@
+"""
+Cache for the outputs of the preprocessing steps (raw load, filter, ICA fit, ICA apply, epoching)
+Every output is saved as FIF under a key made from the key of its input (for the first step the hash
+of the BDF) and the parameters of the step, so a step is only recomputed when something before it changed
+e.g. a new ICA exclusion list reuses the filtered raw and the fitted ICA
+
+    cache = StageCache('C:/Users/mvmigem/Documents/data/project_1/cache/', max_gb=100)
+    raw, key = cache.run('load', cache.fileKey(bdf_path), {'reference': ['M1','M2']}, 'raw', loadRaw)
+    raw, key = cache.run('filter', key, {'l_freq': 0.1, 'h_freq': 28.4}, 'raw', lambda: filterRaw(raw))
+
+The least recently used entries are removed when the cache grows over max_gb
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import mne
+
+
+# Change this when a step computes something different with the same parameters, so old entries are not used
+# (2: the raw and epochs entries are saved as float64, 1 was mne's default float32)
+CACHE_VERSION = 2
+
+# File name (mne wants the -raw/-ica/-epo ending), reader and save arguments per kind of output
+# raw and epochs are saved in double precision, so a cached step gives the same data as computing it again
+KINDS = {'raw': ('data-raw.fif', lambda path: mne.io.read_raw_fif(path, preload=True), {'fmt': 'double'}),
+         'ica': ('data-ica.fif', mne.preprocessing.read_ica, {}),
+         'epochs': ('data-epo.fif', lambda path: mne.read_epochs(path, preload=True), {'fmt': 'double'})}
+
+
+class StageCache:
+    """
+    Content-addressed store of preprocessing outputs, one folder per key
+    hits, misses and the time spent per step are kept in stats
+    """
+    def __init__(self, directory, max_gb=100.):
+        self.directory = directory
+        self.max_bytes = max_gb * 1e9
+        self.stats = {}
+        self._nested = []   # time spent in the steps run by the compute() of a step, not counted for that step
+        os.makedirs(directory, exist_ok=True)
+
+    def fileKey(self, path, chunk_size=2**24):
+        """
+        sha1 of the content of an input file
+        The hash is remembered for the same path, size and modification time, so a BDF is only read once
+        Every source has its own hash file (written to a temporary file and renamed), so processes hashing
+        other files at the same time do not overwrite each other
+        """
+        stat = os.stat(path)
+        file_id = '%s|%d|%d' % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        hash_path = os.path.join(self.directory, 'file_hash_%s.txt' % hashlib.sha1(file_id.encode()).hexdigest())
+        try:
+            with open(hash_path) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            pass
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha.update(chunk)
+        tmp = '%s.tmp%d' % (hash_path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(sha.hexdigest())
+        os.replace(tmp, hash_path)
+
+        return sha.hexdigest()
+
+    def key(self, stage, parent_key, params):
+        """
+        Key of a step output: its name, the key of its input and its parameters
+        """
+        description = json.dumps({'version': CACHE_VERSION, 'stage': stage, 'parent': parent_key, 'params': params},
+                                 sort_keys=True, default=str)
+
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def run(self, stage, parent_key, params, kind, compute):
+        """
+        Return the output of a step and its key, loaded from the cache or computed with compute()
+        and stored (kind is 'raw', 'ica' or 'epochs')
+        """
+        key = self.key(stage, parent_key, params)
+        file_name, read, save_kwargs = KINDS[kind]
+        entry = os.path.join(self.directory, key)
+        t0 = self._start(stage)
+        if os.path.isfile(os.path.join(entry, file_name)):
+            try:
+                data = read(os.path.join(entry, file_name))
+                os.utime(entry)   # mark as recently used
+                self.stats[stage]['hits'] += 1
+                self._stop(stage, t0)
+                return data, key
+            except (OSError, ValueError):   # removed or half written by another process, compute it again
+                pass
+
+        data = compute()
+        # Write in a temporary folder first, so an entry is either complete or not there
+        tmp = entry + '.tmp%d' % os.getpid()
+        os.makedirs(tmp, exist_ok=True)
+        data.save(os.path.join(tmp, file_name), overwrite=True, **save_kwargs)
+        with open(os.path.join(tmp, 'params.json'), 'w') as f:
+            json.dump({'stage': stage, 'parent': parent_key, 'params': params}, f, indent=1, default=str)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp, entry)
+        self.stats[stage]['misses'] += 1
+        self._stop(stage, t0)
+        self.evict(keep=key)
+
+        return data, key
+
+    def timed(self, stage, compute):
+        """
+        Run a step that is not cached and add its duration to stats
+        """
+        t0 = self._start(stage)
+        data = compute()
+        self._stop(stage, t0)
+
+        return data
+
+    def _start(self, stage):
+        self.stats.setdefault(stage, {'hits': 0, 'misses': 0, 'seconds': 0.})
+        self._nested.append(0.)
+        return time.perf_counter()
+
+    def _stop(self, stage, t0):
+        elapsed = time.perf_counter() - t0
+        self.stats[stage]['seconds'] += elapsed - self._nested.pop()
+        if self._nested:
+            self._nested[-1] += elapsed
+
+    def entries(self):
+        """
+        (last use, size in bytes, path) of every entry
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(path) or '.tmp' in name:
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                entries.append((os.stat(path).st_mtime, size, path))
+            except FileNotFoundError:   # evicted by another process
+                continue
+
+        return entries
+
+    def size(self):
+        return sum(size for last_use, size, path in self.entries())
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache is smaller than max_bytes
+        Returns the number of removed entries
+        """
+        entries = sorted(self.entries())
+        total = sum(size for last_use, size, path in entries)
+        removed = 0
+        for last_use, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if os.path.basename(path) == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+
+        return removed
+
+
+class NoCache(StageCache):
+    """
+    Same interface without storing anything, every step is computed (the stats only have the times)
+    """
+    def __init__(self):
+        self.stats = {}
+        self._nested = []
+
+    def fileKey(self, path):
+        return os.path.abspath(path)
+
+    def run(self, stage, parent_key, params, kind, compute):
+        key = self.key(stage, parent_key, params)
+        data = self.timed(stage, compute)
+        self.stats[stage]['misses'] += 1
+
+        return data, key
+
+
+def mergeStats(all_stats):
+    """
+    Add up the stats of several caches (e.g. one per subject process)
+    """
+    merged = {}
+    for stats in all_stats:
+        for stage, values in stats.items():
+            total = merged.setdefault(stage, {'hits': 0, 'misses': 0, 'seconds': 0.})
+            for name, value in values.items():
+                total[name] += value
+
+    return merged
+
+
+def printStats(stats):
+    print('stage            hits  misses   seconds  hit rate')
+    for stage, values in stats.items():
+        n = values['hits'] + values['misses']
+        print('%-14s %6d %7d %9.1f %8.0f%%' % (stage, values['hits'], values['misses'], values['seconds'],
+                                               100 * values['hits'] / n if n else 0))
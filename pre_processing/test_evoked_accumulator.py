@@ -0,0 +1,53 @@
+"""
+Tests of the running averages in evoked_accumulator.py against numpy on all the data at once
+
+    python -m pytest test_evoked_accumulator.py
+"""
+import numpy as np
+import pytest
+from evoked_accumulator import EvokedAccumulator
+
+
+CH_NAMES = ['Fz', 'Cz', 'Pz', 'Oz']
+TIMES = np.linspace(-.1, .5, 50)
+
+
+def simulatedEpochs(n_epochs, offset=1e-5, seed=0):
+    # EEG sized values on an offset, the case where sumsq/n - mean**2 cancels
+    rng = np.random.default_rng(seed)
+    return offset + 1e-6 * rng.standard_normal((n_epochs, len(CH_NAMES), len(TIMES)))
+
+
+def test_merged_chunks_match_numpy():
+    data = simulatedEpochs(97)
+    accumulators = []
+    for chunk in np.array_split(data, [1, 10, 40, 41]):
+        accumulators.append(EvokedAccumulator(CH_NAMES, TIMES).add('a', chunk))
+    merged = accumulators[0]
+    for accumulator in accumulators[1:]:
+        merged += accumulator
+    assert merged.count('a') == len(data)
+    assert np.allclose(merged.mean('a'), data.mean(axis=0), rtol=1e-12, atol=0)
+    assert np.allclose(merged.se('a'), data.std(axis=0, ddof=1) / np.sqrt(len(data)), rtol=1e-9, atol=0)
+
+
+def test_epoch_by_epoch_matches_numpy():
+    data = simulatedEpochs(30, seed=1)
+    accumulator = EvokedAccumulator(CH_NAMES, TIMES)
+    for epoch in data:
+        accumulator.add('a', epoch)
+    assert np.allclose(accumulator.mean('a'), data.mean(axis=0), rtol=1e-12, atol=0)
+    assert np.allclose(accumulator.se('a'), data.std(axis=0, ddof=1) / np.sqrt(len(data)), rtol=1e-9, atol=0)
+    assert np.allclose(accumulator.gfp('a'), data.mean(axis=0).std(axis=0))
+
+
+def test_empty_conditions_are_nan():
+    accumulator = EvokedAccumulator(CH_NAMES, TIMES).add('a', simulatedEpochs(1)).add('b', np.empty((0, 4, 50)))
+    assert np.isnan(accumulator.se('a')).all()
+    assert np.isnan(accumulator.mean('b')).all() and accumulator.count('b') == 0
+    assert np.isnan(accumulator.mean('c')).all()
+
+
+def test_other_channels_are_not_merged():
+    with pytest.raises(ValueError):
+        EvokedAccumulator(CH_NAMES, TIMES).merge(EvokedAccumulator(CH_NAMES[::-1], TIMES))
@@ -0,0 +1,74 @@
+"""
+Tests of the alignment of the behavioural data with the epochs in metadata_alignment.py
+
+    python -m pytest test_metadata_alignment.py
+"""
+import numpy as np
+import pandas as pd
+from metadata_alignment import alignCodes, alignMetadata, trialCodes, trialTimes
+
+
+def behaviour(directions, seed=0):
+    # Behavioural rows with the timing columns of the experiment, trials of 2.5 to 3.5 s
+    rng = np.random.default_rng(seed)
+    n = len(directions)
+    behav_data = pd.DataFrame({'start_position': [1] * n, 'trial_direction': directions, 'expected': ['regular'] * n})
+    for stimulus in range(4):
+        behav_data[f't_stim_{stimulus + 1}'] = 300. + 400 * stimulus + rng.uniform(0, 60, n)
+    behav_data['experiment_time_s'] = 10 + np.cumsum(2.5 + rng.uniform(0, 1, n))
+    return behav_data
+
+
+def recordedEvents(behav_data, lost=(), sfreq=512, offset=3.7):
+    # The events the EEG would have, on another clock and without the lost codes
+    samples = np.round((trialTimes(behav_data).ravel() + offset) * sfreq).astype(int)
+    codes = trialCodes(behav_data['start_position'], behav_data['trial_direction']).ravel()
+    keep = np.ones(len(codes), dtype=bool)
+    keep[list(lost)] = False
+    return np.column_stack([samples[keep], np.zeros(keep.sum(), dtype=int), codes[keep]])
+
+
+def test_trial_codes_follow_the_direction():
+    assert trialCodes([1, 1], [0, 1]).tolist() == [[99, 21, 32, 43, 14], [99, 21, 12, 43, 34]]
+
+
+def test_lost_stimulus_is_found_within_the_trial():
+    expected = trialCodes([0, 1, 2], [0, 0, 1]).ravel()
+    observed = np.delete(expected, 7)
+    matched, dropped = alignCodes(expected, observed)
+    assert dropped.tolist() == [7]
+    assert matched.tolist() == [index for index in range(15) if index != 7]
+
+
+def test_extra_code_is_not_matched():
+    expected = trialCodes([0, 1], [0, 0]).ravel()
+    observed = np.insert(expected, 3, 55)
+    matched, dropped = alignCodes(expected, observed)
+    assert matched[3] == -1 and not len(dropped)
+
+
+def test_truncated_last_of_identical_trials_is_dropped():
+    # Ten identical trials without timing, the end of the last one is cut off
+    expected = trialCodes([0] * 10, [0] * 10).ravel()
+    for n_lost in range(1, 6):
+        matched, dropped = alignCodes(expected, expected[:-n_lost])
+        assert (dropped // 5).tolist() == [9] * n_lost
+        assert matched.tolist() == list(range(50 - n_lost))
+
+
+def test_truncated_identical_trials_keep_their_rows():
+    behav_data = behaviour([0] * 10)
+    metadata, dropped = alignMetadata(recordedEvents(behav_data, lost=[49]), behav_data)
+    assert dropped.values.tolist() == [[9, 4, 14]]
+    assert np.array_equal(metadata['experiment_time_s'].to_numpy()[::5], behav_data['experiment_time_s'])
+
+
+def test_timing_finds_the_lost_one_of_identical_trials():
+    # Trials 3 to 6 are identical, trial 4 has no events, only the timing tells it from trial 6
+    behav_data = behaviour([0, 1, 0, 1, 1, 1, 1, 0, 1, 0, 1, 0, 0, 1, 0, 1, 0, 1, 1, 0])
+    metadata, dropped = alignMetadata(recordedEvents(behav_data, lost=range(20, 25)), behav_data)
+    assert dropped['trial_row'].unique().tolist() == [4]
+    trial_rows = [row for row in range(20) if row != 4]
+    assert np.array_equal(metadata['experiment_time_s'].to_numpy()[::5],
+                          behav_data['experiment_time_s'].to_numpy()[trial_rows])
+    assert metadata['trial_complete'].all()